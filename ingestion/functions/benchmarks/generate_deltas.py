@@ -0,0 +1,100 @@
+"""
+Benchmark of the deltas computed by retrieval.generate_deltas.
+
+Compares the previous implementation, which sorted both files and ran comm
+twice, with retrieval.write_deltas on a synthetic CSV source in which a
+fraction of the rows change between two retrievals.
+
+Run from ingestion/functions:
+
+    python benchmarks/generate_deltas.py [--rows N] [--changed FRACTION] [--memory BYTES]
+"""
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+FUNCTIONS_DIR = Path(__file__).resolve().parent.parent
+sys.path.extend([str(FUNCTIONS_DIR), str(FUNCTIONS_DIR / "common")])
+
+from retrieval import retrieval  # noqa: E402
+
+HEADER = "id,date_confirmed,age,gender,location,outcome\n"
+
+
+def write_source(file_name, rows):
+    with open(file_name, "w") as f:
+        f.write(HEADER)
+        f.writelines(rows)
+
+
+def synthetic_sources(tempdir, num_rows, changed):
+    rng = random.Random(0)
+    rows = [f"{i},2021-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d},"
+            f"{rng.randint(0, 99)},{rng.choice('MF')},place {rng.randint(0, 999)},"
+            f"{rng.choice(['recovered', 'death', ''])}\n" for i in range(num_rows)]
+    early = os.path.join(tempdir, "early.csv")
+    write_source(early, rows)
+    for i in rng.sample(range(num_rows), int(num_rows * changed)):
+        rows[i] = rows[i].replace(",\n", ",recovered\n")
+    rows.extend(f"{i},2021-12-31,30,F,place 0,\n"
+                for i in range(num_rows, num_rows + int(num_rows * changed)))
+    rng.shuffle(rows)
+    later = os.path.join(tempdir, "later.csv")
+    write_source(later, rows)
+    return early, later
+
+
+def sort_and_comm(early, later, add_name, del_name):
+    """Previous implementation, running sort and comm in subprocesses."""
+    sorted_names = []
+    for name in (early, later):
+        sorted_names.append(name + ".sorted")
+        with open(sorted_names[-1], "w") as outfile:
+            outfile.write(HEADER)
+            outfile.flush()
+            body = subprocess.Popen(["tail", "--lines", "+2", name], stdout=subprocess.PIPE)
+            subprocess.run(["sort"], stdin=body.stdout, stdout=outfile, check=True,
+                           env={**os.environ, "LC_ALL": "C"})
+            body.wait()
+    for flag, out_name in (("-13", add_name), ("-23", del_name)):
+        with open(out_name, "w") as outfile:
+            subprocess.run(["comm", flag, *sorted_names], stdout=outfile, check=True)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    arg_parser.add_argument("--rows", type=int, default=1_000_000,
+                            help="number of rows of the synthetic source")
+    arg_parser.add_argument("--changed", type=float, default=0.01,
+                            help="fraction of rows changed and added")
+    arg_parser.add_argument("--memory", type=int, default=retrieval.DELTAS_MEMORY_BYTES,
+                            help="memory available to compute deltas, in bytes")
+    args = arg_parser.parse_args()
+    with tempfile.TemporaryDirectory() as tempdir:
+        early, later = synthetic_sources(tempdir, args.rows, args.changed)
+        outputs = {}
+        start = time.perf_counter()
+        outputs["sort+comm"] = [os.path.join(tempdir, f"comm.{x}") for x in ("add", "del")]
+        sort_and_comm(early, later, *outputs["sort+comm"])
+        timings = {"sort+comm": time.perf_counter() - start}
+        outputs["write_deltas"] = [os.path.join(tempdir, f"native.{x}") for x in ("add", "del")]
+        start = time.perf_counter()
+        with open(outputs["write_deltas"][0], "wb") as add_file, \
+                open(outputs["write_deltas"][1], "wb") as del_file:
+            retrieval.write_deltas(early, later, add_file, del_file, args.memory)
+        timings["write_deltas"] = time.perf_counter() - start
+        for legacy, native in zip(*outputs.values()):
+            with open(legacy, "rb") as f1, open(native, "rb") as f2:
+                assert f1.read() == f2.read(), f"{legacy} and {native} differ"
+        print(f"{args.rows} rows, {args.changed:.1%} changed, {args.memory} bytes of memory")
+        for name, seconds in timings.items():
+            print(f"{name:<14}{seconds:>8.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Microbenchmark of parsing_lib.remove_nested_none_and_empty.
+
+Compares the current implementation with the previous one, which rebuilt
+every dict and list, on the output of the brazil_srag, colombia and USA
+parsers for their sample data.
+
+Run from ingestion/functions:
+
+    python benchmarks/remove_nested_none_and_empty.py [--repeat N]
+"""
+import argparse
+import copy
+import sys
+import timeit
+from pathlib import Path
+
+FUNCTIONS_DIR = Path(__file__).resolve().parent.parent
+sys.path.extend([str(FUNCTIONS_DIR), str(FUNCTIONS_DIR / "common")])
+
+import parsing_lib  # noqa: E402
+from parsing.brazil_srag import srag  # noqa: E402
+from parsing.colombia import colombia  # noqa: E402
+from parsing.USA import USA  # noqa: E402
+
+PARSERS = {
+    "srag": (srag, "brazil_srag"),
+    "colombia": (colombia, "colombia"),
+    "USA": (USA, "USA"),
+}
+
+
+def rebuild_nested_none_and_empty(d):
+    """Previous implementation, which copies every container."""
+    if not isinstance(d, (dict, list)):
+        return d
+    if isinstance(d, list):
+        return [v for v in (rebuild_nested_none_and_empty(v)
+                            for v in d) if v is not None and v != ""]
+    return {k: v for k, v in ((k, rebuild_nested_none_and_empty(v))
+                              for k, v in d.items()) if v is not None and v != ""}
+
+
+def sample_cases(parser, folder):
+    sample = FUNCTIONS_DIR / "parsing" / folder / "sample_data.csv"
+    return list(parser.parse_cases(str(sample), "source_id", "source_url"))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    arg_parser.add_argument("--repeat", type=int, default=2000,
+                            help="number of times each sample is pruned")
+    args = arg_parser.parse_args()
+    print(f"{'source':<10}{'cases':>6}{'rebuild (us/case)':>20}{'current (us/case)':>20}")
+    for name, (parser, folder) in PARSERS.items():
+        cases = sample_cases(parser, folder)
+        # Prune copies so that the inputs are identical for both versions
+        inputs = [copy.deepcopy(cases) for _ in range(2)]
+        for case in cases:
+            assert (parsing_lib.remove_nested_none_and_empty(case)
+                    == rebuild_nested_none_and_empty(case))
+        timings = []
+        for prune, data in zip(
+                [rebuild_nested_none_and_empty, parsing_lib.remove_nested_none_and_empty],
+                inputs):
+            seconds = timeit.timeit(lambda: [prune(c) for c in data], number=args.repeat)
+            timings.append(seconds / (args.repeat * len(data)) * 1e6)
+        print(f"{name:<10}{len(cases):>6}{timings[0]:>20.2f}{timings[1]:>20.2f}")
+
+
+if __name__ == "__main__":
+    main()
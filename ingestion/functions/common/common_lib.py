@@ -11,9 +11,12 @@ import os
 import re
 import sys
 import json
+import datetime
 import tempfile
 import requests
+import requests.adapters
 import functools
+import threading
 from enum import Enum
 from pathlib import Path
 from typing import Any
@@ -23,6 +26,7 @@ from typing import Dict
 import google
 import google.auth.transport.requests
 from google.oauth2 import service_account
+from urllib3.util.retry import Retry
 
 try:
     import ingestion_logging as logging
@@ -44,6 +48,25 @@ _SERVICE_ACCOUNT_CRED_FILE = "covid-19-map-277002-0943eeb6776b.json"
 _METADATA_BUCKET = "gdh-credentials"
 MIN_SOURCE_ID_LENGTH, MAX_SOURCE_ID_LENGTH = 24, 24
 
+# Maximum number of connections kept alive to each host by the shared session.
+HTTP_POOL_SIZE = int(os.environ.get("EPID_INGESTION_HTTP_POOL_SIZE", 10))
+# Transport-level retries of the shared session. Requests that failed to
+# connect are retried whatever the method, but only idempotent GETs are
+# retried on gateway errors: batch upserts have their own backoff.
+HTTP_RETRY = Retry(
+    total=None, connect=3, read=0, other=0, status=3,
+    status_forcelist=[502, 503, 504], allowed_methods=["GET"],
+    backoff_factor=0.5, raise_on_status=False)
+
+# Cached API credentials are refreshed this long before their token expires.
+CREDENTIALS_EXPIRY_MARGIN_SECONDS = float(
+    os.environ.get("EPID_INGESTION_CREDENTIALS_EXPIRY_MARGIN_SECONDS", 300))
+
+_session = None
+_session_lock = threading.Lock()
+_api_credentials = None
+_api_credentials_lock = threading.Lock()
+
 logger = logging.getLogger(__name__)
 logger.setLevel("INFO")
 
@@ -59,14 +82,45 @@ class UploadError(Enum):
     VALIDATION_ERROR = 8
 
 
+def new_session(pool_size: int = HTTP_POOL_SIZE, retry: Retry = HTTP_RETRY) -> requests.Session:
+    """Creates an HTTP session with a keep-alive connection pool."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session() -> requests.Session:
+    """
+    Returns the HTTP session shared by all requests to the G.h API.
+
+    Connections are reused across requests instead of paying for a TCP and
+    TLS handshake each time.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = new_session()
+        return _session
+
+
+def set_session(session: requests.Session | None):
+    """Replaces the shared HTTP session, or resets it if None is given."""
+    global _session
+    with _session_lock:
+        _session = session
+
+
 def create_upload_record(env, source_id, headers, cookies):
     """Creates an upload resource via the G.h Source API."""
     post_api_url = f"{get_source_api_url(env)}/sources/{source_id}/uploads"
     logger.info(f"Creating upload via {post_api_url}")
-    res = requests.post(post_api_url,
-                        json={"status": "IN_PROGRESS", "summary": {}},
-                        cookies=cookies,
-                        headers=headers)
+    res = get_session().post(post_api_url,
+                             json={"status": "IN_PROGRESS", "summary": {}},
+                             cookies=cookies,
+                             headers=headers)
     if res and res.status_code == 201:
         res_json = res.json()
         return res_json["_id"]
@@ -77,8 +131,14 @@ def create_upload_record(env, source_id, headers, cookies):
 
 def finalize_upload(
         env, source_id, upload_id, headers, cookies, count_created=None,
-        count_updated=None, count_error=None, error=None, deltas=None):
-    """Records the results of an upload via the G.h Source API."""
+        count_updated=None, count_error=None, error=None, deltas=None, profile=None,
+        unchanged=False):
+    """
+    Records the results of an upload via the G.h Source API.
+
+    A profile of the ingestion, if given, is stored with the upload. Uploads
+    skipped because the source content is unchanged are marked as such.
+    """
     put_api_url = f"{get_source_api_url(env)}/sources/{source_id}/uploads/{upload_id}"
     logger.info(f"Updating upload via {put_api_url}")
     update = {"summary": {}}
@@ -95,11 +155,15 @@ def finalize_upload(
         update["summary"]["numError"] = count_error
     if deltas:
         update["deltas"] = deltas
+    if profile:
+        update["profile"] = profile
+    if unchanged:
+        update["unchanged"] = True
 
-    res = requests.put(put_api_url,
-                       json=update,
-                       headers=headers,
-                       cookies=cookies)
+    res = get_session().put(put_api_url,
+                            json=update,
+                            headers=headers,
+                            cookies=cookies)
     return res.status_code, res.text
 
 
@@ -141,31 +205,127 @@ def login(email: str):
     return res.cookies
 
 
-def obtain_api_credentials(s3_client):
+class ApiCredentials:
+    """
+    Service account credentials for the G.h Source API, shared by the threads
+    of a process.
+
+    The service account file is only downloaded from S3 once. Its token is
+    refreshed in the background CREDENTIALS_EXPIRY_MARGIN_SECONDS before it
+    expires, and on demand if it is about to expire or was rejected.
+    """
+
+    def __init__(self, s3_client, margin_seconds: float = CREDENTIALS_EXPIRY_MARGIN_SECONDS):
+        self.s3_client = s3_client
+        self.margin = datetime.timedelta(seconds=margin_seconds)
+        self._credentials = None
+        self._headers = None
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def headers(self, rejected_headers: dict | None = None) -> dict:
+        """
+        Returns headers with a valid token. If rejected_headers are given,
+        and still those cached, the token is refreshed first.
+        """
+        with self._lock:
+            if (self._headers is None or self._expiring()
+                    or (rejected_headers and rejected_headers == self._headers)):
+                self._refresh()
+            return dict(self._headers)
+
+    def _load(self) -> service_account.Credentials:
+        fd, local_creds_file_name = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd) as _:
+                logger.info(
+                    "Retrieving service account credentials from "
+                    f"s3://{_METADATA_BUCKET}/{_SERVICE_ACCOUNT_CRED_FILE}")
+                self.s3_client.download_file(_METADATA_BUCKET,
+                                             _SERVICE_ACCOUNT_CRED_FILE,
+                                             local_creds_file_name)
+                return service_account.Credentials.from_service_account_file(
+                    local_creds_file_name, scopes=["email"])
+        finally:
+            os.remove(local_creds_file_name)
+
+    def _expiring(self) -> bool:
+        # google-auth expiries are naive UTC datetimes
+        expiry = self._credentials.expiry
+        return expiry is not None and _utcnow() >= expiry - self.margin
+
+    def _refresh(self):
+        if self._credentials is None:
+            self._credentials = self._load()
+        logger.info("Refreshing API credentials")
+        self._credentials.refresh(google.auth.transport.requests.Request())
+        headers = {}
+        self._credentials.apply(headers)
+        self._headers = headers
+        self._schedule_refresh()
+
+    def _schedule_refresh(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if self._credentials.expiry is None:
+            return
+        delay = (self._credentials.expiry - self.margin - _utcnow()).total_seconds()
+        if delay > 0:
+            self._timer = threading.Timer(delay, self._refresh_in_background)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _refresh_in_background(self):
+        try:
+            with self._lock:
+                self._refresh()
+        except Exception as e:
+            # the next call refreshes the token if it is still needed
+            logger.warning(f"Background refresh of API credentials failed: {e}")
+
+
+def _utcnow() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def obtain_api_credentials(s3_client, rejected_headers: dict | None = None):
     """
     Creates HTTP headers credentialed for access to the Global.health Source API.
+
+    Credentials are cached by the process, see ApiCredentials. Callers whose
+    headers were rejected pass them as rejected_headers to get a new token,
+    which is only requested once however many callers were rejected.
     """
+    global _api_credentials
     try:
-        fd, local_creds_file_name = tempfile.mkstemp()
-        with os.fdopen(fd) as _:
-            logger.info(
-                "Retrieving service account credentials from "
-                f"s3://{_METADATA_BUCKET}/{_SERVICE_ACCOUNT_CRED_FILE}")
-            s3_client.download_file(_METADATA_BUCKET,
-                                    _SERVICE_ACCOUNT_CRED_FILE,
-                                    local_creds_file_name)
-            credentials = service_account.Credentials.from_service_account_file(
-                local_creds_file_name, scopes=["email"])
-            headers = {}
-            request = google.auth.transport.requests.Request()
-            credentials.refresh(request)
-            credentials.apply(headers)
-            return headers
+        with _api_credentials_lock:
+            if _api_credentials is None:
+                _api_credentials = ApiCredentials(s3_client)
+            credentials = _api_credentials
+        return credentials.headers(rejected_headers)
     except Exception as e:
         logger.error(e)
         raise e
 
 
+def set_api_credentials(credentials: ApiCredentials | None):
+    """Replaces the cached API credentials, or resets them if None is given."""
+    global _api_credentials
+    with _api_credentials_lock:
+        _api_credentials = credentials
+
+
+def checkpoint_key(source_id: str, upload_id: str) -> str:
+    """Returns the S3 key of the checkpoint of an upload, in the ingestion bucket."""
+    return f"{source_id}/checkpoints/{upload_id}.json"
+
+
+def spool_prefix(source_id: str, upload_id: str) -> str:
+    """Returns the S3 prefix of the spooled cases of an upload, in the ingestion bucket."""
+    return f"{source_id}/spool/{upload_id}/"
+
+
 def get_source_api_url(env):
     """
     Returns the URL at which to reach the Source API for the provided environment.
@@ -1,3 +1,4 @@
+import datetime
 import pytest
 import requests
 
@@ -82,6 +83,19 @@ def test_finalize_upload_invokes_update_api(
     assert requests_mock.request_history[0].url == update_upload_url
 
 
+def test_finalize_upload_attaches_profile(
+        requests_mock, mock_source_api_url_fixture):
+    update_upload_url = f"{_SOURCE_API_URL}/sources/{_SOURCE_ID}/uploads/{_UPLOAD_ID}"
+    requests_mock.put(update_upload_url, json={})
+    profile = {"wall_seconds": 1.5, "stages": {}}
+
+    common_lib.finalize_upload(
+        "env", _SOURCE_ID, _UPLOAD_ID, {}, {}, 42, 0, profile=profile)
+
+    assert requests_mock.request_history[0].json() == {
+        "status": "SUCCESS", "summary": {"numCreated": 42}, "profile": profile}
+
+
 def test_finalize_upload_raises_error_for_failed_request(
         requests_mock, mock_source_api_url_fixture):
     update_upload_url = f"{_SOURCE_API_URL}/sources/{_SOURCE_ID}/uploads/{_UPLOAD_ID}"
@@ -148,3 +162,66 @@ def test_get_parser_module():
     exp = "parsing.japan.japan"
     act = common_lib.get_parser_module(parser)
     assert exp == act
+
+
+def test_get_session_returns_shared_session():
+    try:
+        assert common_lib.get_session() is common_lib.get_session()
+        session = common_lib.new_session()
+        common_lib.set_session(session)
+        assert common_lib.get_session() is session
+    finally:
+        common_lib.set_session(None)
+    assert common_lib.get_session() is not session
+
+
+class FakeCredentials:
+    """Service account credentials whose token lasts lifetime seconds."""
+
+    def __init__(self, lifetime):
+        self.lifetime = lifetime
+        self.expiry = None
+        self.refreshes = 0
+
+    def refresh(self, request):
+        self.refreshes += 1
+        self.expiry = common_lib._utcnow() + datetime.timedelta(seconds=self.lifetime)
+
+    def apply(self, headers):
+        headers["authorization"] = f"Bearer {self.refreshes}"
+
+
+def test_obtain_api_credentials_caches_token_until_rejected():
+    credentials = FakeCredentials(3600)
+    try:
+        with patch.object(common_lib.ApiCredentials, "_load") as load:
+            load.return_value = credentials
+            headers = common_lib.obtain_api_credentials(None)
+            assert common_lib.obtain_api_credentials(None) == headers
+            assert load.call_count == 1 and credentials.refreshes == 1
+            # concurrent callers rejected with the same headers refresh once
+            new_headers = common_lib.obtain_api_credentials(None, rejected_headers=headers)
+            assert common_lib.obtain_api_credentials(None, rejected_headers=headers) == new_headers
+            assert new_headers != headers and credentials.refreshes == 2
+            assert load.call_count == 1
+    finally:
+        common_lib.set_api_credentials(None)
+
+
+def test_api_credentials_refresh_before_expiry():
+    credentials = FakeCredentials(60)
+    api_credentials = common_lib.ApiCredentials(None, margin_seconds=50)
+    with patch.object(common_lib.ApiCredentials, "_load") as load:
+        load.return_value = credentials
+        assert api_credentials.headers() == {"authorization": "Bearer 1"}
+        # a background refresh is scheduled 50s before expiry
+        timer = api_credentials._timer
+        assert timer.daemon and 9 < timer.interval <= 10
+        timer.cancel()
+        timer.function()
+        assert api_credentials.headers() == {"authorization": "Bearer 2"}
+        api_credentials._timer.cancel()
+        # refreshed on demand if about to expire
+        api_credentials.margin = datetime.timedelta(seconds=60)
+        assert api_credentials.headers() == {"authorization": "Bearer 3"}
+        assert api_credentials._timer is None
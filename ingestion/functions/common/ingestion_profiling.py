@@ -0,0 +1,102 @@
+"""
+Per-stage profiling of an ingestion.
+
+Stages of an ingestion are interleaved: the parser, prepare_cases, date
+filtering and serialization are chained generators, pulled one case at a time
+by the upload loop. Profile times each call into a stage, and stages entered
+while another one is running (for instance, prepare_cases pulling the next
+case from the parser) are only counted against the innermost one. Stage times
+are therefore exclusive, and show which stage the time went to.
+"""
+
+import collections
+import contextlib
+import resource
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator
+
+
+class Profile:
+    """Wall time, CPU time and item counts of the stages of an ingestion."""
+
+    def __init__(self):
+        self._start = time.perf_counter()
+        # Stage name -> [wall seconds, CPU seconds, count]
+        self._stages = collections.defaultdict(lambda: [0.0, 0.0, 0])
+        self._lock = threading.Lock()
+        # Stages entered by each thread, innermost last
+        self._local = threading.local()
+
+    def _enter(self, name: str):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        self._local.stack.append([name, time.perf_counter(), time.thread_time(), 0.0, 0.0])
+
+    def _exit(self, count: int):
+        stack = self._local.stack
+        name, wall, cpu, inner_wall, inner_cpu = stack.pop()
+        wall = time.perf_counter() - wall
+        cpu = time.thread_time() - cpu
+        if stack:
+            stack[-1][3] += wall
+            stack[-1][4] += cpu
+        with self._lock:
+            totals = self._stages[name]
+            totals[0] += wall - inner_wall
+            totals[1] += cpu - inner_cpu
+            totals[2] += count
+
+    @contextlib.contextmanager
+    def stage(self, name: str, count: int = 1):
+        """Times the enclosed block as count items of stage name."""
+        self._enter(name)
+        try:
+            yield
+        finally:
+            self._exit(count)
+
+    def iterate(self, name: str, items: Iterable) -> Iterator:
+        """Yields from items, timing the production of each item as stage name."""
+        items = iter(items)
+        while True:
+            self._enter(name)
+            count = 0
+            try:
+                item = next(items)
+                count = 1
+            except StopIteration:
+                return
+            finally:
+                self._exit(count)
+            yield item
+
+    def timed(self, name: str, func: Callable) -> Callable:
+        """Returns func, timing each call as an item of stage name."""
+        def timed_func(*args, **kwargs):
+            with self.stage(name):
+                return func(*args, **kwargs)
+        return timed_func
+
+    def report(self) -> Dict:
+        """
+        Returns the time and items of each stage, the total wall time, and the
+        peak resident set size of this process and of its reaped children
+        (such as parsing workers), in MiB.
+
+        Stages running on other threads, such as concurrent uploads, overlap
+        with the others, so stage times can add up to more than the total.
+        """
+        with self._lock:
+            stages = {
+                name: {"wall_seconds": round(wall, 3), "cpu_seconds": round(cpu, 3),
+                       "count": count}
+                for name, (wall, cpu, count) in self._stages.items()}
+        return {
+            "wall_seconds": round(time.perf_counter() - self._start, 3),
+            "stages": stages,
+            # ru_maxrss is in KiB on Linux
+            "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024,
+            "peak_children_rss_mib":
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // 1024,
+        }
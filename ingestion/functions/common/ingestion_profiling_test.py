@@ -0,0 +1,52 @@
+import threading
+import time
+
+from . import ingestion_profiling
+
+
+def slow_items(n, seconds):
+    for i in range(n):
+        time.sleep(seconds)
+        yield i
+
+
+def test_iterate_counts_items_and_times_innermost_stage():
+    profile = ingestion_profiling.Profile()
+    inner = profile.iterate("parse", slow_items(3, 0.02))
+    outer = profile.iterate("prepare", (i * 2 for i in inner))
+    assert list(outer) == [0, 2, 4]
+    stages = profile.report()["stages"]
+    assert stages["parse"]["count"] == 3
+    assert stages["prepare"]["count"] == 3
+    assert stages["parse"]["wall_seconds"] >= 0.06
+    assert stages["prepare"]["wall_seconds"] < 0.02
+
+
+def test_stage_and_timed_accumulate_across_threads():
+    profile = ingestion_profiling.Profile()
+    sleep = profile.timed("http", time.sleep)
+    threads = [threading.Thread(target=sleep, args=(0.02,)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with profile.stage("finalize", count=0):
+        pass
+    report = profile.report()
+    assert report["stages"]["http"]["count"] == 4
+    assert report["stages"]["http"]["wall_seconds"] >= 0.08
+    assert report["stages"]["finalize"]["count"] == 0
+    assert report["peak_rss_mib"] > 0
+
+
+def test_stage_is_recorded_when_it_raises():
+    profile = ingestion_profiling.Profile()
+    try:
+        list(profile.iterate("parse", map(int, ["1", "x"])))
+    except ValueError:
+        pass
+    with profile.stage("filter"):
+        pass
+    stages = profile.report()["stages"]
+    assert stages["parse"]["count"] == 1
+    assert stages["filter"]["count"] == 1
@@ -1,18 +1,37 @@
+import csv
 import datetime
+import gzip
 import json
+import math
+import multiprocessing
 import os
+import shutil
 import sys
 import tempfile
 import collections
+import concurrent.futures
 import contextlib
+import functools
+import itertools
+import operator
+import queue
+import re
+import threading
 import time
 from pathlib import Path
-from typing import Callable, Dict, Generator, List
+from typing import Callable, Collection, Dict, Generator, Iterable, Iterator, List, Tuple
 
 import boto3
+import botocore.exceptions
 import requests
 import requests.exceptions
 import iso3166
+import urllib3.exceptions
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 try:
     import common_lib
@@ -24,6 +43,11 @@ try:
 except ModuleNotFoundError:
     import ingestion_logging as logging
 
+try:
+    import common.ingestion_profiling as ingestion_profiling
+except ModuleNotFoundError:
+    import ingestion_profiling
+
 ENV_FIELD = "env"
 SOURCE_URL_FIELD = "sourceUrl"
 S3_BUCKET_FIELD = "s3Bucket"
@@ -47,6 +71,60 @@ DATE_FORMATS = ["%m/%d/%YZ", "%m/%d/%Y"]
 # usage on the server-side and is known to cause OOMs so increase with caution.
 CASES_BATCH_SIZE = 250
 
+# Number of batches that can be in flight to the server at any one time.
+# With the default of 1, each batch is uploaded before the next is parsed.
+UPLOAD_CONCURRENCY = int(os.environ.get("EPID_INGESTION_UPLOAD_CONCURRENCY", 1))
+
+# Whether to gzip batch upsert request bodies, which are otherwise several MB
+# of JSON per batch.
+COMPRESS_UPLOADS = os.environ.get("EPID_INGESTION_COMPRESS_UPLOADS", "true").lower() == "true"
+
+# Adaptive batching sizes batches by their serialized size rather than by a
+# fixed number of cases, and grows or shrinks them with the server's response
+# times, see BatchSizer.
+ADAPTIVE_BATCHING = os.environ.get("EPID_INGESTION_ADAPTIVE_BATCHING", "false").lower() == "true"
+BATCH_MAX_BYTES = int(os.environ.get("EPID_INGESTION_BATCH_MAX_BYTES", 4 * 1024 * 1024))
+BATCH_TARGET_SECONDS = float(os.environ.get("EPID_INGESTION_BATCH_TARGET_SECONDS", 5))
+MIN_CASES_BATCH_SIZE = 10
+MAX_CASES_BATCH_SIZE = 5000
+
+# Seconds between checkpoints of the progress of an upload, which let an
+# interrupted ingestion resume after the last acknowledged batch, see
+# Checkpoint. 0 disables checkpoints.
+CHECKPOINT_SECONDS = float(os.environ.get("EPID_INGESTION_CHECKPOINT_SECONDS", 60))
+# S3 object tag of checkpoints, for the lifecycle rule expiring them
+CHECKPOINT_TAG = "ingestion=checkpoint"
+
+# Number of processes parsing the source file of row-independent parsers, see
+# parse_in_parallel, and the size of the line-aligned ranges they parse.
+PARSING_WORKERS = int(os.environ.get("EPID_INGESTION_PARSING_WORKERS", 1))
+PARSING_RANGE_BYTES = int(os.environ.get("EPID_INGESTION_PARSING_RANGE_BYTES", 8 * 1024 * 1024))
+# Rows read at a time by parsers converting columns rather than rows, see read_csv_columns
+COLUMNS_CHUNK_ROWS = 10000
+# Distinct (date, format) pairs memoized by parse_date
+DATE_CACHE_SIZE = 1 << 16
+
+# Whether to attach the profile of each ingestion to its upload record, in
+# addition to logging it, see ingestion_profiling.
+PROFILE_UPLOADS = os.environ.get("EPID_INGESTION_PROFILE_UPLOADS", "false").lower() == "true"
+
+# Whether parsers read the raw data file from a named pipe, fed from S3 while
+# they parse it, rather than after it is downloaded, see RawDataStream.
+STREAM_RAW_DATA = os.environ.get("EPID_INGESTION_STREAM_RAW_DATA", "false").lower() == "true"
+STREAM_CHUNK_BYTES = 1024 * 1024
+STREAM_MAX_ATTEMPTS = 3
+
+# Directory in which parsed cases are spooled before upload, see CaseSpool.
+# Spooling is disabled if not set.
+SPOOL_DIR = os.environ.get("EPID_INGESTION_SPOOL_DIR")
+SPOOL_SEGMENT_CASES = 10000
+# How long closing a spool waits for the parser to stop
+SPOOL_CLOSE_SECONDS = 10
+
+# JSON library used to serialize cases for upload, see CASE_SERIALIZERS.
+# orjson is not a dependency, so it is only used if installed and chosen here.
+JSON_BACKEND = os.environ.get("EPID_INGESTION_JSON_BACKEND", "json")
+
 logger = logging.getLogger(__name__)
 logger.setLevel("INFO")
 
@@ -128,6 +206,92 @@ def retrieve_raw_data_file(s3_bucket: str, s3_key: str, out_file):
         common_lib.complete_with_error(e)
 
 
+class RawDataStream:
+    """
+    Streams an S3 object into a named pipe, which a parser reads as its raw
+    data file while the object is being downloaded.
+
+    The parsing function must read its file once, from start to end. If the
+    download fails part-way, it is resumed from where it stopped, up to
+    STREAM_MAX_ATTEMPTS times, after which parse raises the download error.
+    Resumed downloads must match the ETag of the first response: if the
+    object was replaced meanwhile, parse raises the PreconditionFailed error
+    instead of feeding the parser parts of two objects.
+    """
+
+    def __init__(self, s3_bucket: str, s3_key: str,
+                 profile: ingestion_profiling.Profile = None):
+        self.s3_bucket = s3_bucket
+        self.s3_key = s3_key
+        self.error = None
+        self._dir = tempfile.mkdtemp()
+        self.file_name = os.path.join(self._dir, "raw_data")
+        os.mkfifo(self.file_name)
+        write = profile.timed("download", self._write) if profile else self._write
+        self._thread = threading.Thread(target=write, daemon=True)
+        self._thread.start()
+
+    def _write(self):
+        written = 0
+        etag = None
+        try:
+            # Blocks until the parser opens the pipe
+            with open(self.file_name, "wb") as pipe:
+                for attempt in range(1, STREAM_MAX_ATTEMPTS + 1):
+                    # Empty objects can't be requested with a range. The rest
+                    # must come from the same version of the object.
+                    resume = {"Range": f"bytes={written}-", "IfMatch": etag} if written else {}
+                    try:
+                        response = s3_client.get_object(
+                            Bucket=self.s3_bucket, Key=self.s3_key, **resume)
+                        etag = etag or response.get("ETag")
+                        for chunk in response["Body"].iter_chunks(STREAM_CHUNK_BYTES):
+                            pipe.write(chunk)
+                            written += len(chunk)
+                        self.error = None
+                        return
+                    except (botocore.exceptions.BotoCoreError,
+                            botocore.exceptions.ClientError,
+                            urllib3.exceptions.ProtocolError,
+                            urllib3.exceptions.ReadTimeoutError) as e:
+                        logger.warning(f"Streaming s3://{self.s3_bucket}/{self.s3_key} failed "
+                                       f"after {written} bytes (attempt {attempt}): {e}")
+                        self.error = e
+                        if (isinstance(e, botocore.exceptions.ClientError)
+                                and e.response["Error"]["Code"] == "PreconditionFailed"):
+                            # The object was replaced since the stream started
+                            return
+        except BrokenPipeError:
+            pass  # The parser stopped reading
+        except Exception as e:
+            self.error = e
+        finally:
+            logger.info(f"Streamed {written} bytes from s3://{self.s3_bucket}/{self.s3_key}")
+
+    def parse(self, parsing_function: Callable[[str, str, str], Generator[Dict, None, None]],
+              source_id: str, source_url: str) -> Generator[Dict, None, None]:
+        """Yields the cases parsed from the stream, raising any download error."""
+        try:
+            yield from parsing_function(self.file_name, source_id, source_url)
+        except Exception as e:
+            # The parser may have failed on data truncated by a failed download
+            if self.error:
+                raise self.error from e
+            raise
+        self._thread.join()
+        if self.error:
+            raise self.error
+
+    def close(self):
+        while self._thread.is_alive():
+            # Open and close the pipe for reading, to unblock a writer waiting for
+            # the parser to open it; it then fails to write as there is no reader.
+            with contextlib.suppress(OSError):
+                os.close(os.open(self.file_name, os.O_RDONLY | os.O_NONBLOCK))
+            self._thread.join(timeout=0.1)
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+
 def retrieve_excluded_case_ids(source_id: str, date_filter: Dict, date_range: Dict, env: str,
                                headers=None, cookies=None):
     if env == "locale2e":
@@ -155,11 +319,13 @@ def retrieve_excluded_case_ids(source_id: str, date_filter: Dict, date_range: Di
     excluded_case_ids_endpoint_url = (
         f"{common_lib.get_source_api_url(env)}"
         f"/excludedCaseIds?sourceId={source_id}{date_limits}")
-    res = requests.get(excluded_case_ids_endpoint_url, headers=headers, cookies=cookies)
+    res = common_lib.get_session().get(
+        excluded_case_ids_endpoint_url, headers=headers, cookies=cookies)
     if res and res.status_code == 200:
-        res_json = res.json()
-        logger.info("Excluded cases: Returning excluded cases.")
-        return res_json["cases"]
+        # The API returns all IDs at once, hash them for constant time lookups
+        excluded_case_ids = set(res.json()["cases"])
+        logger.info(f"Excluded cases: Returning {len(excluded_case_ids)} excluded cases.")
+        return excluded_case_ids
     logger.info("Excluded cases: Returning None.")
     return None
 
@@ -167,6 +333,18 @@ def retrieve_excluded_case_ids(source_id: str, date_filter: Dict, date_range: Di
 # This structure is needed for the partial name matching below.
 countries_index = {c.name.upper(): c.alpha2 for c in iso3166.countries}
 
+
+def _trigrams(name: str) -> set:
+    return {name[i:i + 3] for i in range(len(name) - 2)}
+
+
+# Country names by each three-character substring of theirs: a name of three
+# characters or more can only be part of the names that have all its trigrams.
+countries_by_trigram = collections.defaultdict(set)
+for _name in countries_index:
+    for _trigram in _trigrams(_name):
+        countries_by_trigram[_trigram].add(_name)
+
 country_to_iso_fixes = {
     "CZECH REPUBLIC": "CZ",
     "UNITED STATES": "US",
@@ -188,7 +366,28 @@ def iso3166_country_code(country_name: str) -> str:
 
     This is only used in cases where the parser supplies the location info: typically we would
     expect the parser to give a location query which is later geocoded anyway.
+
+    Partial matches are only searched among the names that have all the three-character
+    substrings of country_name, see countries_by_trigram. Lookups, including failed ones,
+    are memoized: see iso3166_country_code_cache_info.
     """
+    if (code := _iso3166_country_code(country_name)) is None:
+        raise KeyError(country_name)
+    return code
+
+
+def _partially_matching_countries(ucase_name: str) -> List[str]:
+    """Returns the codes of the countries whose upper case name contains ucase_name."""
+    if len(ucase_name) >= 3:
+        candidates = set.intersection(
+            *(countries_by_trigram.get(trigram, set()) for trigram in _trigrams(ucase_name)))
+    else:
+        candidates = countries_index
+    return [countries_index[name] for name in candidates if ucase_name in name]
+
+
+@functools.lru_cache(maxsize=4096)
+def _iso3166_country_code(country_name: str) -> str | None:
     if len(country_name) == 2 and country_name.isalpha():
         return country_name.upper()
     if (ucase_name := country_name.upper()) in country_to_iso_fixes:
@@ -198,40 +397,183 @@ def iso3166_country_code(country_name: str) -> str:
     if country is not None:
         return country.alpha2
     # Didn't find an exact match, so try a partial match
-    matched_countries = [countries_index[k] for k in countries_index.keys() if ucase_name in k]
+    matched_countries = _partially_matching_countries(ucase_name)
     if len(matched_countries) == 1:
         return matched_countries[0]
     # Found 0 or many partial matches
-    raise KeyError
+    return None
+
 
+def iso3166_country_code_cache_info():
+    """Returns the hits and misses of the iso3166_country_code memo, for profiling."""
+    return _iso3166_country_code.cache_info()
 
-def prepare_cases(cases: Generator[Dict, None, None], upload_id: str, excluded_case_ids: list):
+
+def read_csv_columns(
+        file_name: str, columns: Iterable[str], chunk_rows: int = COLUMNS_CHUNK_ROWS,
+        **reader_options) -> Generator[Dict[str, List[str]], None, None]:
+    """
+    Reads columns of a CSV file with a header line, chunk_rows rows at a time,
+    yielding for each chunk a dict of column name to the list of its values.
+
+    Missing values of short rows are None, as with csv.DictReader. Parsers
+    then convert a column at a time, see map_column, instead of a row at a
+    time. reader_options are passed on to csv.reader, e.g. delimiter.
+    """
+    columns = list(columns)
+    with open(file_name, newline="") as f:
+        reader = csv.reader(f, **reader_options)
+        header = next(reader, [])
+        if missing := [c for c in columns if c not in header]:
+            raise ValueError(f"Columns missing from {file_name}: {', '.join(missing)}")
+        indices = [header.index(c) for c in columns]
+        # like csv.DictReader, skip empty lines
+        non_empty = (row for row in reader if row)
+        while rows := list(itertools.islice(non_empty, chunk_rows)):
+            if min(map(len, rows)) < len(header):
+                rows = [row + [None] * (len(header) - len(row)) for row in rows]
+            # transpose in C, rather than a value at a time
+            values = list(zip(*rows))
+            yield {c: list(values[i]) for c, i in zip(columns, indices)}
+
+
+def map_column(func: Callable, *columns: List, cache: Dict | None = None) -> List:
+    """
+    Returns the values of func for each row of one or more columns of the same
+    length, as read by read_csv_columns, calling func once per distinct value
+    (or combination of values, for several columns).
+
+    Dates, codes and flags have few distinct values, so this saves most of
+    the calls of parsers converting them row by row. Results are memoized in
+    cache, if given, so that it can be shared between chunks or columns.
+    They are shared by the rows with the same values: copy those that are
+    modified later, such as the location of a case, which prepare_cases
+    modifies.
+    """
+    cache = {} if cache is None else cache
+    keys = columns[0] if len(columns) == 1 else list(zip(*columns))
+    for key in dict.fromkeys(keys):
+        if key not in cache:
+            cache[key] = func(key) if len(columns) == 1 else func(*key)
+    return list(map(cache.__getitem__, keys))
+
+
+def prepare_cases(cases: Generator[Dict, None, None], upload_id: str,
+                  excluded_case_ids: Collection[str] | None):
     """
     Populates standard required fields for the G.h Case API.
 
+    Cases whose sourceEntryId is in excluded_case_ids are dropped.
+
     TODO: Migrate source_id/source_url to this method.
     """
+    if excluded_case_ids is not None and not isinstance(excluded_case_ids, (set, frozenset)):
+        excluded_case_ids = frozenset(excluded_case_ids)
     for case in cases:
+        if (excluded_case_ids
+                and case["caseReference"].get("sourceEntryId") in excluded_case_ids):
+            continue
         case["caseReference"]["uploadIds"] = [upload_id]
         if country := common_lib.deep_get(case, "location.country"):
             case["location"]["country"] = iso3166_country_code(country)
         for travel in common_lib.deep_get(case, "travelHistory.travel", default=[]):
             if travel_country := common_lib.deep_get(travel, "location.country"):
                 travel["location"]["country"] = iso3166_country_code(travel_country)
-        if ((excluded_case_ids is None)
-                or ("sourceEntryId" not in case["caseReference"])
-                or (not case["caseReference"]["sourceEntryId"] in excluded_case_ids)):
-            yield remove_nested_none_and_empty(case)
+        yield remove_nested_none_and_empty(case)
 
 
 def remove_nested_none_and_empty(d):
-    if not isinstance(d, (dict, list)):
-        return d
+    """
+    Returns d without the None values and empty strings it contains, at any depth.
+
+    Dicts and lists are only copied when something has to be removed from them,
+    or from a container nested in them: otherwise they are returned as is, and
+    d itself is never modified.
+    """
+    if isinstance(d, dict):
+        pruned = None
+        for i, (k, v) in enumerate(d.items()):
+            if v is None or v == "":
+                if pruned is None:
+                    pruned = dict(itertools.islice(d.items(), i))
+                continue
+            if isinstance(v, (dict, list)):
+                new_v = remove_nested_none_and_empty(v)
+                if new_v is not v and pruned is None:
+                    pruned = dict(itertools.islice(d.items(), i))
+                v = new_v
+            if pruned is not None:
+                pruned[k] = v
+        return d if pruned is None else pruned
     if isinstance(d, list):
-        return [v for v in (remove_nested_none_and_empty(v)
-                            for v in d) if v is not None and v != ""]
-    return {k: v for k, v in ((k, remove_nested_none_and_empty(v))
-                              for k, v in d.items()) if v is not None and v != ""}
+        pruned = None
+        for i, v in enumerate(d):
+            if v is None or v == "":
+                if pruned is None:
+                    pruned = d[:i]
+                continue
+            if isinstance(v, (dict, list)):
+                new_v = remove_nested_none_and_empty(v)
+                if new_v is not v and pruned is None:
+                    pruned = d[:i]
+                v = new_v
+            if pruned is not None:
+                pruned.append(v)
+        return d if pruned is None else pruned
+    return d
+
+
+_json_encoder = json.JSONEncoder(allow_nan=False, separators=(",", ":"))
+
+
+def json_serialize_case(case: Dict) -> bytes:
+    return _json_encoder.encode(case).encode("utf-8")
+
+
+def check_finite(value):
+    """
+    Raises ValueError if value has a NaN or infinite float, at any depth, as
+    json_serialize_case does.
+    """
+    if isinstance(value, float):
+        if not math.isfinite(value):
+            raise ValueError(f"Out of range float values are not JSON compliant: {value}")
+    elif isinstance(value, dict):
+        for v in value.values():
+            check_finite(v)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            check_finite(v)
+
+
+def orjson_serialize_case(case: Dict) -> bytes:
+    serialized = orjson.dumps(case, option=orjson.OPT_NON_STR_KEYS)
+    # orjson writes NaN and infinities as null, where json fails. Cases are
+    # pruned of None values, so they seldom have a null to check.
+    if b"null" in serialized:
+        check_finite(case)
+    return serialized
+
+
+# Functions serializing a case to UTF-8 encoded JSON, by JSON_BACKEND name.
+CASE_SERIALIZERS = {"json": json_serialize_case}
+if orjson:
+    CASE_SERIALIZERS["orjson"] = orjson_serialize_case
+
+
+def get_case_serializer(backend: str = None) -> Callable[[Dict], bytes]:
+    """Returns the case serializer for backend, or for JSON_BACKEND if not given."""
+    backend = backend or JSON_BACKEND
+    try:
+        return CASE_SERIALIZERS[backend]
+    except KeyError:
+        logger.warning(f"JSON backend {backend} is not available, using json")
+        return json_serialize_case
+
+
+def batch_body(batch: List[bytes]) -> bytes:
+    """Returns a batch upsert request body from serialized cases."""
+    return b'{"cases":[' + b",".join(batch) + b"]}"
 
 
 def batch_of(cases: Generator[Dict, None, None], max_items: int) -> List[Dict]:
@@ -246,11 +588,477 @@ def batch_of(cases: Generator[Dict, None, None], max_items: int) -> List[Dict]:
         return batch
 
 
+class BatchSizer:
+    """
+    Chooses the size of batches of serialized cases from the server's response
+    times.
+
+    Batches hold at most max_bytes of cases, which protects the
+    server from running out of memory on sources with large cases, and at most
+    a number of cases that adapts to the server: it grows by half after a full
+    batch is acknowledged within target_seconds, and halves when a batch is
+    slower than that or needed retries.
+    """
+
+    def __init__(self, initial_cases: int = CASES_BATCH_SIZE,
+                 min_cases: int = MIN_CASES_BATCH_SIZE,
+                 max_cases: int = MAX_CASES_BATCH_SIZE,
+                 max_bytes: int = BATCH_MAX_BYTES,
+                 target_seconds: float = BATCH_TARGET_SECONDS):
+        self.min_cases = min_cases
+        self.max_cases = max_cases
+        self.max_bytes = max_bytes
+        self.target_seconds = target_seconds
+        self.case_limit = initial_cases
+        # (number of cases, bytes) of each batch, in the order they were made
+        self.sizes = []
+        self._acknowledged = 0
+        self._pending = None
+
+    def next_batch(self, cases: Iterator[bytes]) -> List[bytes]:
+        """Reads the next batch from cases; an empty batch marks the end."""
+        batch = []
+        batch_bytes = 0
+        while len(batch) < self.case_limit:
+            if self._pending is not None:
+                case, case_bytes = self._pending
+                self._pending = None
+            else:
+                try:
+                    case = next(cases)
+                except StopIteration:
+                    break
+                case_bytes = len(case)
+            if batch and batch_bytes + case_bytes > self.max_bytes:
+                self._pending = case, case_bytes
+                break
+            batch.append(case)
+            batch_bytes += case_bytes
+        if batch:
+            self.sizes.append((len(batch), batch_bytes))
+        return batch
+
+    def record(self, seconds: float, retries: int):
+        """Adjusts the case limit once the oldest unacknowledged batch is sent."""
+        num_cases, _ = self.sizes[self._acknowledged]
+        self._acknowledged += 1
+        old_limit = self.case_limit
+        if retries or seconds > self.target_seconds:
+            self.case_limit = max(self.min_cases, self.case_limit // 2)
+        elif num_cases >= self.case_limit:
+            self.case_limit = min(self.max_cases, self.case_limit * 3 // 2)
+        if self.case_limit != old_limit:
+            logger.info(f"Batch took {seconds:.1f}s with {retries} retries, "
+                        f"batch size limit now {self.case_limit} cases")
+
+    def summary(self) -> str:
+        if not self.sizes:
+            return "no batches sent"
+        counts, sizes = zip(*self.sizes)
+        return (f"{len(self.sizes)} batches of {min(counts)}-{max(counts)} cases "
+                f"(mean {sum(counts) // len(counts)}), "
+                f"{min(sizes)}-{max(sizes)} bytes (mean {sum(sizes) // len(sizes)})")
+
+
+class Checkpoint:
+    """
+    Progress of an upload: the event it was started with, and the number of
+    batches and cases acknowledged by the server along with their counts.
+
+    Checkpoints are saved to the ingestion bucket, at most every interval
+    seconds and when the ingestion fails, and deleted once the upload is
+    finalized. Running the parser again with the same upload ID resumes
+    after the last saved checkpoint. Checkpoints are tagged with
+    CHECKPOINT_TAG, so that a lifecycle rule of the bucket can expire those
+    of uploads that are never resumed.
+    Parsers yield cases from the start of the source file, so the cases that
+    were already sent are parsed again but skipped before upload.
+    """
+
+    def __init__(self, bucket: str, source_id: str, upload_id: str, event: Dict,
+                 interval: float = CHECKPOINT_SECONDS):
+        self.bucket = bucket
+        self.key = common_lib.checkpoint_key(source_id, upload_id)
+        self.event = event
+        self.interval = interval
+        self.batches = 0
+        self.cases = 0
+        self.counts = {"numCreated": 0, "numUpdated": 0, "numError": 0}
+        self._saved_time = time.time()
+
+    @classmethod
+    def load(cls, bucket: str, source_id: str, upload_id: str,
+             interval: float = CHECKPOINT_SECONDS):
+        """Returns the saved checkpoint of an upload, or None if there is none."""
+        key = common_lib.checkpoint_key(source_id, upload_id)
+        try:
+            obj = s3_client.get_object(Bucket=bucket, Key=key)
+        except botocore.exceptions.ClientError:
+            return None
+        saved = json.load(obj["Body"])
+        checkpoint = cls(bucket, source_id, upload_id, saved["event"], interval)
+        checkpoint.batches = saved["batches"]
+        checkpoint.cases = saved["cases"]
+        checkpoint.counts = saved["counts"]
+        return checkpoint
+
+    def update(self, batches: int, cases: int, counts: Dict[str, int]):
+        """Records acknowledged batches, saving them if interval has elapsed."""
+        self.batches = batches
+        self.cases = cases
+        self.counts = {k: counts[k] for k in self.counts}
+        if time.time() - self._saved_time >= self.interval:
+            self.save()
+
+    def save(self):
+        self._saved_time = time.time()
+        body = json.dumps({"event": self.event, "batches": self.batches,
+                           "cases": self.cases, "counts": self.counts})
+        try:
+            s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=body,
+                                 Tagging=CHECKPOINT_TAG)
+        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as e:
+            logger.warning(f"Could not save checkpoint to s3://{self.bucket}/{self.key}: {e}")
+
+    def delete(self):
+        with contextlib.suppress(botocore.exceptions.BotoCoreError,
+                                 botocore.exceptions.ClientError):
+            s3_client.delete_object(Bucket=self.bucket, Key=self.key)
+
+
+class CaseSpool:
+    """
+    Serialized cases spooled in gzipped newline-delimited JSON segments of
+    SPOOL_SEGMENT_CASES cases.
+
+    Spooling decouples parsing from uploading: the parser fills the spool at
+    its own pace on a thread, while the uploader reads back the segments that
+    have been written to directory, deleting each one once it is read.
+    Segments are also copied to the ingestion bucket, where a manifest marks
+    the spool as complete once the parser is done. An upload that fails after
+    that can be resumed with replay_spool, without parsing the source again.
+    The spool is deleted from the bucket once the upload is finalized. Like
+    checkpoints, its objects are tagged with CHECKPOINT_TAG, so that those of
+    uploads that are never resumed expire.
+    """
+
+    def __init__(self, bucket: str, source_id: str, upload_id: str, directory: str = None):
+        self.bucket = bucket
+        self.prefix = common_lib.spool_prefix(source_id, upload_id)
+        self.directory = Path(directory) if directory else None
+        self.segments = 0
+        self.cases = 0
+        self.error = None
+        self._segments = queue.Queue()
+        self._closed = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def load(cls, bucket: str, source_id: str, upload_id: str):
+        """Returns the complete spool of an upload, or None if there is none."""
+        spool = cls(bucket, source_id, upload_id)
+        try:
+            obj = s3_client.get_object(Bucket=bucket, Key=spool.manifest_key)
+        except botocore.exceptions.ClientError:
+            return None
+        manifest = json.load(obj["Body"])
+        spool.segments = manifest["segments"]
+        spool.cases = manifest["cases"]
+        return spool
+
+    @staticmethod
+    def segment_name(n: int) -> str:
+        return f"segment-{n:06d}.ndjson.gz"
+
+    @property
+    def manifest_key(self) -> str:
+        return f"{self.prefix}manifest.json"
+
+    def _put(self, key: str, body):
+        s3_client.put_object(Bucket=self.bucket, Key=key, Body=body, Tagging=CHECKPOINT_TAG)
+
+    def _write(self, cases: Iterator[bytes]):
+        # stop pulling cases from the parser once the spool is closed
+        cases = itertools.takewhile(lambda _: not self._closed.is_set(), cases)
+        copied = True
+        try:
+            for segment in iter(functools.partial(batch_of, cases, SPOOL_SEGMENT_CASES), []):
+                if self._closed.is_set():
+                    return
+                path = self.directory / self.segment_name(self.segments)
+                partial_path = path.with_name(f"{path.name}.partial")
+                with gzip.open(partial_path, "wb", compresslevel=1) as f:
+                    f.writelines(case + b"\n" for case in segment)
+                partial_path.rename(path)
+                if copied:
+                    try:
+                        with path.open("rb") as f:
+                            self._put(f"{self.prefix}{path.name}", f)
+                    except (botocore.exceptions.BotoCoreError,
+                            botocore.exceptions.ClientError) as e:
+                        logger.warning(f"Could not copy spool segment to "
+                                       f"s3://{self.bucket}/{self.prefix}, "
+                                       f"it will not be replayable: {e}")
+                        copied = False
+                self._segments.put(path)
+                self.segments += 1
+                self.cases += len(segment)
+            if copied and not self._closed.is_set():
+                self._put(self.manifest_key,
+                          json.dumps({"segments": self.segments, "cases": self.cases}))
+            logger.info(f"Spooled {self.cases} cases in {self.segments} segments "
+                        f"to {self.directory}")
+        except Exception as e:
+            self.error = e
+        finally:
+            self._segments.put(None)
+
+    @staticmethod
+    def _read_segment(f) -> Iterator[bytes]:
+        with gzip.GzipFile(fileobj=f) as lines:
+            for line in lines:
+                yield line.rstrip(b"\n")
+
+    def spool(self, cases: Iterator[bytes]) -> Iterator[bytes]:
+        """
+        Spools cases on a thread, and yields them back as their segments are
+        written. Errors raised by cases are raised once the spooled cases have
+        been read.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # the manifest of an earlier spool of the upload no longer describes its segments
+        with contextlib.suppress(botocore.exceptions.BotoCoreError,
+                                 botocore.exceptions.ClientError):
+            s3_client.delete_object(Bucket=self.bucket, Key=self.manifest_key)
+        self._thread = threading.Thread(target=self._write, args=(cases,), daemon=True)
+        self._thread.start()
+        while (path := self._segments.get()) is not None:
+            with path.open("rb") as f:
+                yield from self._read_segment(f)
+            path.unlink()
+        if self.error:
+            raise self.error
+
+    def replay(self) -> Iterator[bytes]:
+        """Yields the cases of a complete spool from the bucket."""
+        for n in range(self.segments):
+            obj = s3_client.get_object(
+                Bucket=self.bucket, Key=f"{self.prefix}{self.segment_name(n)}")
+            yield from self._read_segment(obj["Body"])
+
+    def close(self, timeout: float = SPOOL_CLOSE_SECONDS):
+        """
+        Stops spooling, waiting up to timeout seconds for the parser to yield
+        its next case, and deletes the local segments. Those in the bucket are
+        kept for a replay.
+        """
+        self._closed.set()
+        if self._thread:
+            self._thread.join(timeout)
+        if self.directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def delete(self):
+        """Deletes the spool from the bucket."""
+        keys = [self.manifest_key] + [
+            f"{self.prefix}{self.segment_name(n)}" for n in range(self.segments)]
+        for batch in iter(functools.partial(batch_of, iter(keys), 1000), []):
+            with contextlib.suppress(botocore.exceptions.BotoCoreError,
+                                     botocore.exceptions.ClientError):
+                s3_client.delete_objects(
+                    Bucket=self.bucket, Delete={"Objects": [{"Key": key} for key in batch]})
+
+
+def pipelined(func: Callable, items: Iterable, max_in_flight: int,
+              executor_class: Callable = concurrent.futures.ThreadPoolExecutor) -> Iterator[Tuple]:
+    """
+    Applies func to each of items, yielding (item, result) pairs in input order.
+
+    Up to max_in_flight calls run concurrently on a thread pool, or on a pool
+    made by executor_class(max_workers=max_in_flight). Items are only
+    pulled from the (possibly lazy) iterable once there is room for another
+    call, so a slow consumer applies back-pressure all the way to the producer.
+    With max_in_flight <= 1, calls are made inline, one item at a time.
+    """
+    if max_in_flight <= 1:
+        for item in items:
+            yield item, func(item)
+        return
+    in_flight = collections.deque()
+    executor = executor_class(max_workers=max_in_flight)
+    try:
+        for item in items:
+            in_flight.append((item, executor.submit(func, item)))
+            if len(in_flight) >= max_in_flight:
+                item, future = in_flight.popleft()
+                yield item, future.result()
+        while in_flight:
+            item, future = in_flight.popleft()
+            yield item, future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def line_ranges(file_name: str, range_bytes: int) -> Generator[Tuple[int, int], None, None]:
+    """
+    Yields (start, end) byte offsets splitting a file, after its header line,
+    into ranges of about range_bytes that end at a line break.
+    """
+    with open(file_name, "rb") as f:
+        f.readline()
+        start = f.tell()
+        size = os.fstat(f.fileno()).st_size
+        while start < size:
+            f.seek(start + range_bytes)
+            f.readline()
+            end = min(f.tell(), size)
+            yield start, end
+            start = end
+
+
+def parse_range(
+        parsing_function: Callable[[str, str, str], Generator[Dict, None, None]],
+        file_name: str, source_id: str, source_url: str, line_range: Tuple[int, int]) -> List[Dict]:
+    """
+    Returns the cases parsed from the header line and a range of lines of a
+    file, copied to a file of their own.
+    """
+    start, end = line_range
+    fd, range_file_name = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, "wb") as range_file, open(file_name, "rb") as f:
+            range_file.write(f.readline())
+            f.seek(start)
+            while start < end:
+                chunk = f.read(min(end - start, 1024 * 1024))
+                range_file.write(chunk)
+                start += len(chunk)
+        return list(parsing_function(range_file_name, source_id, source_url))
+    finally:
+        os.remove(range_file_name)
+
+
+def parse_in_parallel(
+        parsing_function: Callable[[str, str, str], Generator[Dict, None, None]],
+        file_name: str, source_id: str, source_url: str, workers: int,
+        range_bytes: int = PARSING_RANGE_BYTES) -> Generator[Dict, None, None]:
+    """
+    Parses a file in line-aligned ranges on a pool of worker processes,
+    yielding the cases in the same order as parsing_function would.
+
+    This is only correct for row-independent parsers: each line after the
+    header is a complete record (no quoted line breaks), and the cases parsed
+    from a line do not depend on the lines before it.
+
+    Workers are spawned rather than forked: this process runs threads, such
+    as credential refreshes and other sources' uploads, and a forked worker
+    would inherit the locks they hold without the threads to release them.
+    parsing_function must therefore be importable by the workers.
+    """
+    parse = functools.partial(parse_range, parsing_function, file_name, source_id, source_url)
+    executor_class = functools.partial(concurrent.futures.ProcessPoolExecutor,
+                                       mp_context=multiprocessing.get_context("spawn"))
+    for _, cases in pipelined(parse, line_ranges(file_name, range_bytes), workers,
+                              executor_class):
+        yield from cases
+
+
+def post_batch(batch: List[bytes], put_api_url: str, env: str, headers, cookies,
+               stop: threading.Event = None):
+    """
+    Sends a batch of serialized cases to the batchUpsert endpoint, retrying on
+    errors.
+
+    Returns the last response received, or None if the data service could not
+    be reached, the headers used for the last attempt (these differ from the
+    ones passed in if the request had to be reauthenticated), and the number of
+    attempts that failed with a server or connection error.
+
+    Setting stop abandons the retries at the next backoff.
+    """
+    stop = stop or threading.Event()
+    body = batch_body(batch)
+    content_headers = {"Content-Type": "application/json"}
+    if COMPRESS_UPLOADS:
+        body = gzip.compress(body, compresslevel=1)
+        content_headers["Content-Encoding"] = "gzip"
+    # There are two exponential backoffs:
+    # * wait, total_wait keeps track of the backoff from 5xx errors
+    # * conn_wait, total_conn_wait tracks backoff for connection errors
+    total_wait = 0
+    total_conn_wait = 0
+    wait = 10  # initial wait time in seconds
+    conn_wait = 30
+    retries = 0
+    res = None
+    # Exponential backoff in dev and prod, but not for local testing
+    while (
+        total_wait <= (MAX_WAIT_TIME if env in ["dev", "qa", "prod"] else 0)
+        and total_conn_wait < MAX_CONN_WAIT_TIME
+    ):
+        try:
+            res = common_lib.get_session().post(
+                put_api_url, data=body, headers={**(headers or {}), **content_headers},
+                cookies=cookies)
+        except requests.exceptions.ConnectionError:
+            logger.warning(f"Failed to connect to data service, waiting {conn_wait}s")
+            retries += 1
+            if stop.wait(conn_wait):
+                break
+            total_conn_wait += conn_wait
+            conn_wait *= 2
+            continue
+        if res.status_code in [200, 207]:  # 207 is used for validation error
+            break
+        if res.status_code == 500 and "401" in res.text:
+            logger.warning(f"Request failed, status={res.status_code}, "
+                           f"response={res.text}, reauthenticating...")
+            headers = common_lib.obtain_api_credentials(s3_client, rejected_headers=headers)
+            continue
+        logger.warning(f"Request failed, status={res.status_code}, "
+                       f"response={res.text}, retrying in {wait} seconds...")
+        retries += 1
+        if stop.wait(wait):
+            break
+        total_wait += wait
+        wait *= 2
+    if total_conn_wait >= MAX_CONN_WAIT_TIME:
+        return None, headers, retries
+    return res, headers, retries
+
+
 def write_to_server(
         cases: Generator[Dict, None, None],
         env: str, source_id: str, upload_id: str, headers, cookies,
-        cases_batch_size: int):
-    """Upserts the provided cases via the G.h Case API."""
+        cases_batch_size: int, upload_concurrency: int = 1,
+        batch_sizer: BatchSizer = None,
+        serialize_case: Callable[[Dict], bytes] = None,
+        checkpoint: Checkpoint = None,
+        profile: ingestion_profiling.Profile = None,
+        spool: CaseSpool = None):
+    """
+    Upserts the provided cases via the G.h Case API.
+
+    Each case is serialized once, with serialize_case or the JSON_BACKEND
+    serializer, as it is read from the parser, and batches are built from the
+    serialized cases. Batches hold cases_batch_size cases, unless a
+    batch_sizer is given to choose their size.
+
+    Up to upload_concurrency batches are sent to the server concurrently while
+    the next ones are being parsed. Responses are still processed in batch
+    order, so counts, progress updates and error reporting are the same as
+    for a sequential upload.
+
+    Progress is recorded in checkpoint if given. If it was loaded from an
+    earlier run, the cases it records as sent are skipped and its counts are
+    carried over.
+
+    Serialization and requests to the server are timed in profile if given.
+
+    If a spool is given, serialized cases go through it, so that parsing does
+    not wait for the server. Cases skipped when resuming are spooled too, so
+    that the spool can be replayed along with the checkpoint.
+    """
     source_api_url = common_lib.get_source_api_url(env)
     if env == "locale2e":
         source_api_url = common_lib.get_source_api_url("local")
@@ -258,129 +1066,128 @@ def write_to_server(
     upload_status_url = f"{source_api_url}/sources/{source_id}/uploads/{upload_id}"
     logger.info(f"Prod URL: {put_api_url}")
     counter = collections.defaultdict(int)
-    counter["batch_num"] = 0
+    first_batch = resumed_cases = 0
+    if checkpoint and checkpoint.cases:
+        first_batch, resumed_cases = checkpoint.batches, checkpoint.cases
+        logger.info(f"Resuming upload after {resumed_cases} cases in {first_batch} batches")
+        counter.update(checkpoint.counts, total=resumed_cases)
     start_time = time.time()
-    while True:
-        batch_num = counter["batch_num"]
-        counter["batch_num"] += 1
-        batch = batch_of(cases, cases_batch_size)
-        # End of batch.
-        if not batch:
-            break
-        # There are two exponential backoffs:
-        # * wait, total_wait keeps track of the backoff from 5xx errors
-        # * conn_wait, total_conn_wait tracks backoff for connection errors
-        total_wait = 0
-        total_conn_wait = 0
-        wait = 10  # initial wait time in seconds
-        conn_wait = 30
+    stop = threading.Event()
+    profile = profile or ingestion_profiling.Profile()
+
+    def send(batch):
         logger.info(f"Sending {len(batch)} cases, total so far: {counter['total']}")
-        # Exponential backoff in dev and prod, but not for local testing
-        while (
-            total_wait <= (MAX_WAIT_TIME if env in ["dev", "qa", "prod"] else 0)
-            and total_conn_wait < MAX_CONN_WAIT_TIME
-        ):
-            try:
-                res = requests.post(put_api_url, json={"cases": batch},
-                                    headers=headers, cookies=cookies)
-            except requests.exceptions.ConnectionError:
-                logger.warning(f"Failed to connect to data service, waiting {conn_wait}s")
-                time.sleep(conn_wait)
-                total_conn_wait += conn_wait
-                conn_wait *= 2
-                continue
-            if res.status_code in [200, 207]:  # 207 is used for validation error
-                break
-            if res.status_code == 500 and "401" in res.text:
-                logger.warning(f"Request failed, status={res.status_code}, "
-                               f"response={res.text}, reauthenticating...")
-                headers = common_lib.obtain_api_credentials(s3_client)
+        sent_time = time.time()
+        with profile.stage("http"):
+            res, used_headers, retries = post_batch(
+                batch, put_api_url, env, headers, cookies, stop)
+        return time.time() - sent_time, res, used_headers, retries
+
+    cases = map(profile.timed("serialize", serialize_case or get_case_serializer()), cases)
+    if spool:
+        cases = spool.spool(cases)
+    if resumed_cases:
+        cases = itertools.islice(cases, resumed_cases, None)
+    # Batches are read from the parser until an empty one marks the end.
+    if batch_sizer:
+        batches = iter(functools.partial(batch_sizer.next_batch, cases), [])
+    else:
+        batches = iter(functools.partial(batch_of, cases, cases_batch_size), [])
+    results = pipelined(send, batches, upload_concurrency)
+    try:
+        for batch_num, (batch, (seconds, res, headers, retries)) in enumerate(
+                results, first_batch):
+            if batch_sizer:
+                batch_sizer.record(seconds, retries)
+            if res is None:
+                # data service has failed, raise alert
+                notifymsg = f"[!] *Failed to connect to data-{env}* during {source_id} ingestion"
+                if webhook_url := os.getenv("NOTIFY_WEBHOOK_URL"):
+                    with contextlib.suppress(requests.exceptions.RequestException):
+                        requests.post(webhook_url, json={"text": notifymsg})
+                stop.set()
+                common_lib.complete_with_error(
+                    ConnectionError("Could not connect to data service"),
+                    env,
+                    common_lib.UploadError.INTERNAL_ERROR,
+                    source_id, upload_id, headers, cookies,
+                    count_created=counter["numCreated"],
+                    count_updated=counter["numUpdated"],
+                    count_error=counter["numError"]
+                )
+                return
+
+            if res.status_code in [200, 207]:
+                counter["total"] += len(batch)
+                now = time.time()
+                try:
+                    cps = int((counter["total"] - resumed_cases) / (now - start_time))
+                except ZeroDivisionError:
+                    cps = 0
+                logger.info(f"\tCurrent speed: {cps} cases/sec")
+                res_json = res.json()
+                counter["numCreated"] += res_json["numCreated"]
+                counter["numUpdated"] += res_json["numUpdated"]
+                if res.status_code == 207:
+                    # 207 encompasses both geocoding and case schema validation errors.
+                    # We can consider separating geocoding issues, but for now classifying it
+                    # as a validation problem is pretty reasonable.
+                    # The motivation for continuing past 207 errors is
+                    #  https://github.com/globaldothealth/list/issues/1849
+
+                    # The errors from the backend tell us which cases failed and
+                    # for what reason. Make it easier to diagnose by extracting the
+                    # failing case and attaching it to the error message.
+                    if "errors" in res_json:
+                        def add_input_to_error(error):
+                            res = dict(error)
+                            res['input'] = json.loads(batch[error['index']])
+                            return res
+                        augmented_errors = [add_input_to_error(e) for e in res_json['errors']]
+                        reported_error = dict(res_json)
+                        reported_error["errors"] = augmented_errors
+                        logger.warning(f"Validation error in batch {batch_num}: "
+                                       f"{json.dumps(reported_error)}")
+                        counter["numError"] += len(res_json["errors"])
+                    else:
+                        logger.warning(f"Validation error in batch {batch_num}: {res.text}")
+                update_status = {
+                    "status": "IN_PROGRESS",
+                    "summary": {
+                        "numCreated": counter["numCreated"],
+                        "numUpdated": counter["numUpdated"],
+                        "numError": counter["numError"]
+                    }
+                }
+                with contextlib.suppress(requests.exceptions.RequestException), \
+                        profile.stage("http", count=0):
+                    common_lib.get_session().put(
+                        upload_status_url, json=update_status,
+                        headers=headers, cookies=cookies)
+                if checkpoint:
+                    checkpoint.update(batch_num + 1, counter["total"], counter)
                 continue
-            logger.warning(f"Request failed, status={res.status_code}, "
-                           f"response={res.text}, retrying in {wait} seconds...")
-            time.sleep(wait)
-            total_wait += wait
-            wait *= 2
-
-        if total_conn_wait >= MAX_CONN_WAIT_TIME:
-            # data service has failed, raise alert
-            notifymsg = f"[!] *Failed to connect to data-{env}* during {source_id} ingestion"
-            if webhook_url := os.getenv("NOTIFY_WEBHOOK_URL"):
-                with contextlib.suppress(requests.exceptions.RequestException):
-                    requests.post(webhook_url, json={"text": notifymsg})
+
+            # Response can contain an 'error' field which describe each error that
+            # occurred, it will be contained in the res.text here below.
+            stop.set()
+            e = RuntimeError(
+                f"Error sending cases to server, status={res.status_code}, response={res.text}")
+            upload_error = common_lib.UploadError.DATA_UPLOAD_ERROR
             common_lib.complete_with_error(
-                ConnectionError("Could not connect to data service"),
-                env,
-                common_lib.UploadError.INTERNAL_ERROR,
+                e, env, upload_error,
                 source_id, upload_id, headers, cookies,
                 count_created=counter["numCreated"],
                 count_updated=counter["numUpdated"],
                 count_error=counter["numError"]
             )
             return
-
-        if res and res.status_code in [200, 207]:
-            counter["total"] += len(batch)
-            now = time.time()
-            try:
-                cps = int(counter["total"] / (now - start_time))
-            except ZeroDivisionError:
-                cps = 0
-            logger.info(f"\tCurrent speed: {cps} cases/sec")
-            res_json = res.json()
-            counter["numCreated"] += res_json["numCreated"]
-            counter["numUpdated"] += res_json["numUpdated"]
-            if res.status_code == 207:
-                # 207 encompasses both geocoding and case schema validation errors.
-                # We can consider separating geocoding issues, but for now classifying it
-                # as a validation problem is pretty reasonable.
-                # The motivation for continuing past 207 errors is
-                #  https://github.com/globaldothealth/list/issues/1849
-
-                # The errors from the backend tell us which cases failed and
-                # for what reason. Make it easier to diagnose by extracting the
-                # failing case and attaching it to the error message.
-                res_json = res.json()
-                if "errors" in res_json:
-                    def add_input_to_error(error):
-                        res = dict(error)
-                        res['input'] = batch[error['index']]
-                        return res
-                    augmented_errors = [add_input_to_error(e) for e in res_json['errors']]
-                    reported_error = dict(res_json)
-                    reported_error["errors"] = augmented_errors
-                    logger.warning(f"Validation error in batch {batch_num}: "
-                                   f"{json.dumps(reported_error)}")
-                    counter["numError"] += len(res_json["errors"])
-                else:
-                    logger.warning(f"Validation error in batch {batch_num}: {res.text}")
-            update_status = {
-                "status": "IN_PROGRESS",
-                "summary": {
-                    "numCreated": counter["numCreated"],
-                    "numUpdated": counter["numUpdated"],
-                    "numError": counter["numError"]
-                }
-            }
-            with contextlib.suppress(requests.exceptions.RequestException):
-                requests.put(upload_status_url, json=update_status,
-                             headers=headers, cookies=cookies)
-            continue
-
-        # Response can contain an 'error' field which describe each error that
-        # occurred, it will be contained in the res.text here below.
-        e = RuntimeError(
-            f"Error sending cases to server, status={res.status_code}, response={res.text}")
-        upload_error = common_lib.UploadError.DATA_UPLOAD_ERROR
-        common_lib.complete_with_error(
-            e, env, upload_error,
-            source_id, upload_id, headers, cookies,
-            count_created=counter["numCreated"],
-            count_updated=counter["numUpdated"],
-            count_error=counter["numError"]
-        )
-        return
+    finally:
+        stop.set()
+        results.close()
     logger.info(f"sent {counter['total']} cases in {time.time() - start_time} seconds")
+    if batch_sizer:
+        logger.info(f"Batch sizes: {batch_sizer.summary()}")
     return counter["numCreated"], counter["numUpdated"], counter["numError"]
 
 
@@ -389,14 +1196,92 @@ def get_today() -> datetime.datetime:
     return datetime.datetime.today()
 
 
+# Regular expressions of the numeric strptime directives that parse_date
+# parses without strptime, and the datetime field each one sets
+_DATE_DIRECTIVES = {
+    "Y": (r"(\d{4})", "year"),
+    "y": (r"(\d{2})", "year"),
+    "m": (r"(\d{1,2})", "month"),
+    "d": (r"(\d{1,2})", "day"),
+    "H": (r"(\d{1,2})", "hour"),
+    "M": (r"(\d{1,2})", "minute"),
+    "S": (r"(\d{1,2})", "second"),
+    "f": (r"([0-9]{1,6})", "microsecond"),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _date_pattern(date_format: str) -> Tuple[re.Pattern, List[str]] | None:
+    """
+    Returns a regular expression matching the strings that date_format
+    matches, and the directive of each of its groups, if it only has numeric
+    directives, each once.
+    """
+    pattern, directives = [], []
+    for i, part in enumerate(re.split(r"%(.)", date_format)):
+        if i % 2 == 0:
+            # as in strptime, whitespace matches any whitespace
+            pattern.append(r"\s+".join(re.escape(literal) for literal in re.split(r"\s+", part)))
+        elif part in _DATE_DIRECTIVES and part not in directives:
+            pattern.append(_DATE_DIRECTIVES[part][0])
+            directives.append(part)
+        else:
+            return None
+    return re.compile("".join(pattern), re.IGNORECASE), directives
+
+
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def _parse_date(raw_date: str, date_format: str) -> datetime.datetime | str:
+    if (compiled := _date_pattern(date_format)) and (match := compiled[0].fullmatch(raw_date)):
+        fields = {}
+        for directive, value in zip(compiled[1], match.groups()):
+            if directive == "y":
+                # as in strptime, 69-99 are in the 20th century
+                fields["year"] = int(value) + (2000 if int(value) <= 68 else 1900)
+            elif directive == "f":
+                fields["microsecond"] = int(value.ljust(6, "0"))
+            else:
+                fields[_DATE_DIRECTIVES[directive][1]] = int(value)
+        fields.setdefault("year", 1900)
+        try:
+            return datetime.datetime(**{"month": 1, "day": 1, **fields})
+        except ValueError:
+            # strptime may split adjacent numbers differently, e.g. "2021131"
+            pass
+    try:
+        return datetime.datetime.strptime(raw_date, date_format)
+    except ValueError as e:
+        # memoize failures too
+        return str(e)
+
+
+def parse_date(raw_date: str, date_format: str) -> datetime.datetime:
+    """
+    Returns datetime.strptime(raw_date, date_format), memoized.
+
+    Sources have few distinct dates, repeated over many cases and fields, so
+    parsers should convert dates with this rather than strptime. Formats of
+    numeric directives (%Y, %y, %m, %d, %H, %M, %S, %f) are parsed with a
+    regular expression compiled once per format, falling back to strptime
+    for anything else. Failures raise the ValueError strptime would.
+    Hits and misses of the memo are given by parse_date_cache_info.
+    """
+    if isinstance(date := _parse_date(raw_date, date_format), str):
+        raise ValueError(date)
+    return date
+
+
+def parse_date_cache_info():
+    """Returns the hits and misses of the parse_date memo, for profiling."""
+    return _parse_date.cache_info()
+
+
 def get_case_date(date_string) -> datetime.datetime:
     """Return a datetime parsed from a case."""
     case_date = ""
     for fmt in (DATE_FORMATS):
         try:
-            return datetime.datetime.strptime(
-                date_string,
-                fmt)
+            return parse_date(date_string, fmt)
         except ValueError:
             pass
     if not case_date:
@@ -405,6 +1290,55 @@ def get_case_date(date_string) -> datetime.datetime:
     return case_date
 
 
+def case_date_ordinal(date_string: str) -> int:
+    """
+    Return the proleptic Gregorian ordinal of a date parsed from a case.
+
+    Dates in the usual %m/%d/%YZ shape are sliced directly, anything else
+    goes through get_case_date, which accepts the same strings.
+    """
+    if (len(date_string) == 11 and date_string[2] == "/" and date_string[5] == "/"
+            and date_string[10] == "Z"):
+        month, day, year = date_string[:2], date_string[3:5], date_string[6:10]
+        if month.isdigit() and day.isdigit() and year.isdigit():
+            try:
+                return datetime.date(int(year), int(month), int(day)).toordinal()
+            except ValueError:
+                pass
+    return get_case_date(date_string).toordinal()
+
+
+def confirmed_date(case: Dict) -> str:
+    """Return the start date of the confirmed event of a case."""
+    for event in case["events"]:
+        if event["name"] == "confirmed":
+            return event["dateRange"]["start"]
+    raise IndexError("Case has no confirmed event")
+
+
+DATE_FILTER_OPS = {"EQ": operator.eq, "LT": operator.lt, "GT": operator.gt}
+
+
+def select_cases_by_date(
+        cases: Iterable[Dict],
+        is_selected: Callable[[int], bool]) -> Generator[Dict, None, None]:
+    """
+    Yield the cases whose confirmed date ordinal satisfies is_selected.
+
+    Parsed dates are cached for the duration of the upload: sources report
+    a few hundred distinct dates across millions of cases.
+    """
+    ordinals = {}
+    for case in cases:
+        date_string = confirmed_date(case)
+        ordinal = ordinals.get(date_string)
+        if ordinal is None:
+            ordinal = ordinals[date_string] = case_date_ordinal(date_string)
+        if is_selected(ordinal):
+            yield case
+    logger.info(f"Filtered cases on {len(ordinals)} distinct confirmed dates")
+
+
 def filter_cases_by_date(
         case_data: Generator[Dict, None, None],
         date_filter: Dict, date_range: Dict, env: str,
@@ -421,42 +1355,27 @@ def filter_cases_by_date(
     """
     if date_range:
         logger.info(f"Filtering cases using date range {date_range}")
-
-        def case_is_within_range(case, start, end):
-            confirmed_event = [e for e in case["events"]
-                               if e["name"] == "confirmed"][0]
-            case_date = get_case_date(confirmed_event["dateRange"]["start"])
-            return start <= case_date <= end
-
-        start = datetime.datetime.strptime(date_range["start"], "%Y-%m-%d")
-        end = datetime.datetime.strptime(date_range["end"], "%Y-%m-%d")
-        return (case for case in case_data if case_is_within_range(case, start, end))
+        start = datetime.datetime.strptime(date_range["start"], "%Y-%m-%d").toordinal()
+        end = datetime.datetime.strptime(date_range["end"], "%Y-%m-%d").toordinal()
+        return select_cases_by_date(case_data, lambda ordinal: start <= ordinal <= end)
 
     elif date_filter:
         logger.info(f"Filtering cases using date filter {date_filter}")
+        op = DATE_FILTER_OPS.get(date_filter["op"])
+        if not op:
+            e = ValueError(f"Unsupported date filter operand: {date_filter['op']}")
+            common_lib.complete_with_error(
+                e, env, common_lib.UploadError.SOURCE_CONFIGURATION_ERROR,
+                source_id, upload_id, api_creds, cookies)
         now = get_today()
         delta = datetime.timedelta(days=date_filter["numDaysBeforeToday"])
         cutoff_date = now - delta
-        op = date_filter["op"]
-
-        def case_is_within_range(case, cutoff_date, op):
-            confirmed_event = [e for e in case["events"]
-                               if e["name"] == "confirmed"][0]
-            case_date = get_case_date(confirmed_event["dateRange"]["start"])
-            delta_days = (case_date - cutoff_date).days
-            if op == "EQ":
-                return delta_days == 0
-            elif op == "LT":
-                return delta_days < 0
-            elif op == "GT":
-                return delta_days > 0
-            else:
-                e = ValueError(f"Unsupported date filter operand: {op}")
-                common_lib.complete_with_error(
-                    e, env, common_lib.UploadError.SOURCE_CONFIGURATION_ERROR,
-                    source_id, upload_id, api_creds, cookies)
-
-        return (case for case in case_data if case_is_within_range(case, cutoff_date, op))
+        # Case dates are at midnight, so the whole days between a case date and
+        # a cutoff later in the day are one fewer than between their ordinals.
+        cutoff = cutoff_date.toordinal()
+        if cutoff_date.time() != datetime.time():
+            cutoff += 1
+        return select_cases_by_date(case_data, lambda ordinal: op(ordinal, cutoff))
 
     else:
         return case_data
@@ -468,10 +1387,16 @@ class ParserError(Exception):
 
 def run(
         event: Dict,
-        parsing_function: Callable[[str, str, str], Generator[Dict, None, None]]):
+        parsing_function: Callable[[str, str, str], Generator[Dict, None, None]],
+        row_independent: bool = False):
     """
     Encapsulates all of the work performed by a parsing Lambda.
 
+    If the event refers to an upload that was interrupted after saving a
+    Checkpoint, the upload resumes after the last cases it recorded as sent.
+    Without a parsing_function, the cases of the upload are read from its
+    complete CaseSpool instead of parsing the source, see replay_spool.
+
     Parameters
     ----------
     event: dict, required
@@ -487,6 +1412,12 @@ def run(
         case format as per https://data.covid-19.global.health/api-docs/.
         For an example, see:
           https://github.com/globaldothealth/list/blob/main/ingestion/functions/parsing/india/india.py#L57
+        It is None when replaying the spool of the upload, see replay_spool.
+
+    row_independent: bool, optional
+        Whether the source file has a header line followed by one record per
+        line, each parsed independently of the others. The file of such
+        parsers is parsed by PARSING_WORKERS processes, see parse_in_parallel.
 
     Returns
     ------
@@ -511,13 +1442,24 @@ def run(
         cookies = common_lib.login(local_auth["email"])
     else:
         api_creds = common_lib.obtain_api_credentials(s3_client)
+    checkpoint = None
+    if CHECKPOINT_SECONDS and upload_id:
+        checkpoint = Checkpoint.load(s3_bucket, source_id, upload_id)
+        if checkpoint and checkpoint.event.get(S3_KEY_FIELD) != s3_key:
+            logger.warning(f"Ignoring checkpoint of upload {upload_id}, which was "
+                           f"for s3://{s3_bucket}/{checkpoint.event.get(S3_KEY_FIELD)}")
+            checkpoint = None
     if not upload_id:
         upload_id = common_lib.create_upload_record(
             env, source_id, api_creds, cookies)
+    if CHECKPOINT_SECONDS and not checkpoint:
+        checkpoint = Checkpoint(s3_bucket, source_id, upload_id,
+                                {**event, UPLOAD_ID_FIELD: upload_id})
     # grab the source object
     base_url = common_lib.get_source_api_url(env)
     source_info_url = f"{base_url}/sources/{source_id}"
-    source_info_request = requests.get(source_info_url, headers=api_creds, cookies=cookies)
+    source_info_request = common_lib.get_session().get(
+        source_info_url, headers=api_creds, cookies=cookies)
     # if that failed then just bail, we can't ingest the cases
     if source_info_request.status_code > 299:  # yes I'm ignoring redirects
         common_lib.complete_with_error(
@@ -525,58 +1467,128 @@ def run(
                         f"yielded HTTP status {source_info_request.status_code}"),
             env, common_lib.UploadError.INTERNAL_ERROR, source_id, upload_id,
             api_creds, cookies)
+    profile = ingestion_profiling.Profile()
+    local_data_file_name = None
+    raw_data_stream = None
+    replay = parsing_function is None
+    spool = None
+    if replay:
+        spool = CaseSpool.load(s3_bucket, source_id, upload_id)
+        if not spool:
+            common_lib.complete_with_error(
+                ParserError(f"Upload {upload_id} of source {source_id} has no complete spool"),
+                env, common_lib.UploadError.INTERNAL_ERROR, source_id, upload_id,
+                api_creds, cookies)
+    elif SPOOL_DIR:
+        spool = CaseSpool(s3_bucket, source_id, upload_id,
+                          Path(SPOOL_DIR) / source_id / upload_id)
     try:
-        # retrieve source from s3 bucket
-        fd, local_data_file_name = tempfile.mkstemp()
-        local_data_file = os.fdopen(fd, "wb")
-        retrieve_raw_data_file(s3_bucket, s3_key, local_data_file)
-        logger.info(f"Raw file retrieved at {local_data_file_name}")
-        # construct parsing generator
-        logger.info("Running parsing function...")
-        case_data = parsing_function(
-            local_data_file_name, source_id,
-            source_url)
-        logger.info("Retrieving excluded case IDs...")
-        excluded_case_ids = retrieve_excluded_case_ids(source_id, date_filter, date_range, env,
-                                                       headers=api_creds, cookies=cookies)
-        logger.info("Preparing cases...")
-        final_cases = prepare_cases(case_data, upload_id, excluded_case_ids)
-
-        logger.info("Writing to server...")
-        count_created, count_updated, count_error = write_to_server(
-            filter_cases_by_date(
+        serialize_case = None
+        if replay:
+            logger.info(f"Replaying {spool.cases} cases spooled to s3://{s3_bucket}/{spool.prefix}")
+            final_cases = spool.replay()
+            serialize_case = bytes  # spooled cases are serialized already
+        else:
+            parse_in_processes = row_independent and PARSING_WORKERS > 1
+            if STREAM_RAW_DATA and not parse_in_processes:
+                # parse the source while it is streamed from the s3 bucket
+                logger.info(f"Streaming raw data from s3://{s3_bucket}/{s3_key}")
+                raw_data_stream = RawDataStream(s3_bucket, s3_key, profile)
+                logger.info("Running parsing function...")
+                case_data = raw_data_stream.parse(parsing_function, source_id, source_url)
+            else:
+                # retrieve source from s3 bucket
+                fd, local_data_file_name = tempfile.mkstemp()
+                with os.fdopen(fd, "wb") as local_data_file, profile.stage("download"):
+                    retrieve_raw_data_file(s3_bucket, s3_key, local_data_file)
+                logger.info(f"Raw file retrieved at {local_data_file_name}")
+                # construct parsing generator
+                if parse_in_processes:
+                    logger.info(f"Running parsing function on {PARSING_WORKERS} processes...")
+                    case_data = parse_in_parallel(
+                        parsing_function, local_data_file_name, source_id, source_url,
+                        PARSING_WORKERS)
+                else:
+                    logger.info("Running parsing function...")
+                    case_data = parsing_function(
+                        local_data_file_name, source_id,
+                        source_url)
+            case_data = profile.iterate("parse", case_data)
+            logger.info("Retrieving excluded case IDs...")
+            with profile.stage("excluded_case_ids"):
+                excluded_case_ids = retrieve_excluded_case_ids(
+                    source_id, date_filter, date_range, env, headers=api_creds, cookies=cookies)
+            logger.info("Preparing cases...")
+            final_cases = profile.iterate(
+                "prepare", prepare_cases(case_data, upload_id, excluded_case_ids))
+            final_cases = profile.iterate("filter", filter_cases_by_date(
                 final_cases,
                 date_filter,
                 date_range,
                 env, source_id, upload_id,
-                api_creds, cookies),
+                api_creds, cookies))
+
+        logger.info("Writing to server...")
+        count_created, count_updated, count_error = write_to_server(
+            final_cases,
             env, source_id, upload_id,
             api_creds, cookies,
-            CASES_BATCH_SIZE)
+            CASES_BATCH_SIZE,
+            upload_concurrency=UPLOAD_CONCURRENCY,
+            batch_sizer=BatchSizer() if ADAPTIVE_BATCHING else None,
+            serialize_case=serialize_case,
+            checkpoint=checkpoint,
+            profile=profile,
+            spool=None if replay else spool)
 
         for _ in range(5):  # Maximum number of attempts to finalize upload
             logger.info("Attempting to finalise upload...")
-            status, text = common_lib.finalize_upload(
-                env, source_id, upload_id, api_creds, cookies, count_created,
-                count_updated, count_error, deltas=deltas
-            )
+            with profile.stage("finalize"):
+                status, text = common_lib.finalize_upload(
+                    env, source_id, upload_id, api_creds, cookies, count_created,
+                    count_updated, count_error, deltas=deltas,
+                    profile=profile.report() if PROFILE_UPLOADS else None
+                )
             if status == 200:
                 break
             elif status == 500 and "401" in text:
                 logger.warning("Finalizing upload failed with 401, reauthenticating...")
-                api_creds = common_lib.obtain_api_credentials(s3_client)
+                api_creds = common_lib.obtain_api_credentials(
+                    s3_client, rejected_headers=api_creds)
                 continue
             else:
                 raise RuntimeError(f"Error updating upload record, "
                                    f"status={status}, response={text}")
+        if checkpoint:
+            checkpoint.delete()
+        if spool:
+            spool.delete()
         logger.info(f"count_created={count_created}, count_updated={count_updated}")
         return {"count_created": count_created, "count_updated": count_updated}
     except Exception as e:
+        if checkpoint:
+            # keep the batches acknowledged since the last save for a resume
+            checkpoint.save()
         common_lib.complete_with_error(
             e, env, common_lib.UploadError.INTERNAL_ERROR, source_id, upload_id,
             api_creds, cookies)
     finally:
-        local_data_file.close()
-        if os.path.exists(local_data_file_name):
+        if spool:
+            spool.close()
+        if raw_data_stream:
+            raw_data_stream.close()
+        if local_data_file_name and os.path.exists(local_data_file_name):
             os.remove(local_data_file_name)
+        logger.info(f"Ingestion profile: {json.dumps(profile.report())}")
         logging.flushAll()
+
+
+def replay_spool(event: Dict):
+    """
+    Uploads the cases spooled by an interrupted ingestion of the event's
+    upload, without parsing the source again, and finalizes the upload.
+
+    The event is that of the interrupted ingestion, which must have a complete
+    CaseSpool. Cases recorded as sent in the upload's checkpoint are skipped.
+    """
+    return run(event, None)
@@ -2,13 +2,17 @@
 # If you come from a unittest background and wonder at how requests_mock
 # arrives by magic here, check out
 # https://requests-mock.readthedocs.io/en/latest/pytest.html?highlight=pytest#pytest
+import botocore.exceptions
 import io
 import copy
+import csv
+import gzip
 import json
 import os
 import pytest
 import sys
 import tempfile
+import time
 import datetime
 import logging
 
@@ -96,11 +100,55 @@ MOCK_SOURCE_DETAILS = {
 }
 
 
+def posted_cases(request):
+    """Decodes the cases sent in a (possibly gzipped) batch upsert request."""
+    body = request.body
+    if request.headers.get("Content-Encoding") == "gzip":
+        body = gzip.decompress(body)
+    return json.loads(body)["cases"]
+
+
+class FakeBucket:
+    """Stands in for s3_client, keeping the objects put in memory."""
+
+    def __init__(self):
+        self.objects = {}
+        self.tags = {}
+
+    def put_object(self, Bucket, Key, Body, Tagging=None):
+        self.objects[Key] = Body.encode() if isinstance(Body, str) else (
+            Body if isinstance(Body, bytes) else Body.read())
+        self.tags[Key] = Tagging
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise botocore.exceptions.ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        return {"Body": io.BytesIO(self.objects[Key])}
+
+    def download_fileobj(self, Bucket, Key, Fileobj):
+        Fileobj.write(self.get_object(Bucket, Key)["Body"].read())
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+    def delete_objects(self, Bucket, Delete):
+        for obj in Delete["Objects"]:
+            self.delete_object(Bucket, obj["Key"])
+
+
 def fake_parsing_fn(raw_data_file, source_id, source_url):
     """For use in testing parsing_lib.run_lambda()."""
     return iter([_PARSED_CASE])
 
 
+def fake_csv_parsing_fn(raw_data_file, source_id, source_url):
+    """For use in testing parsing_lib.parse_in_parallel()."""
+    with open(raw_data_file) as f:
+        for row in csv.DictReader(f):
+            yield {"caseReference": {"sourceId": source_id, "sourceEntryId": row["id"]},
+                   "notes": row["notes"]}
+
+
 @pytest.fixture()
 def mock_source_api_url_fixture():
     """
@@ -314,6 +362,97 @@ def test_retrieve_raw_data_file_stores_s3_in_local_file(input_event, sample_data
         os.remove(fname)
 
 
+def fake_s3_body(data, fail_after=None,
+                 error=botocore.exceptions.ReadTimeoutError(endpoint_url="s3")):
+    """A streaming S3 object body, optionally failing with error after fail_after bytes."""
+    body = MagicMock()
+
+    def iter_chunks(chunk_size):
+        for i in range(0, len(data), 4):
+            if fail_after is not None and i >= fail_after:
+                raise error
+            yield data[i:i + 4]
+    body.iter_chunks = iter_chunks
+    return {"Body": body, "ETag": '"etag"'}
+
+
+def test_raw_data_stream_feeds_parser_through_pipe():
+    import parsing_lib  # Import locally to avoid superseding mock
+    data = "id,notes\n" + "".join(f"{i},note {i}\n" for i in range(10))
+    with patch("parsing_lib.s3_client") as mock_s3:
+        mock_s3.get_object.return_value = fake_s3_body(data.encode())
+        stream = parsing_lib.RawDataStream("bucket", "key")
+        try:
+            cases = list(stream.parse(fake_csv_parsing_fn, _SOURCE_ID, "url"))
+        finally:
+            stream.close()
+    assert [c["notes"] for c in cases] == [f"note {i}" for i in range(10)]
+    assert not os.path.exists(stream.file_name)
+
+
+def test_raw_data_stream_resumes_failed_download():
+    import parsing_lib  # Import locally to avoid superseding mock
+    data = ("id,notes\n" + "".join(f"{i},note {i}\n" for i in range(10))).encode()
+    with patch("parsing_lib.s3_client") as mock_s3:
+        mock_s3.get_object.side_effect = [
+            fake_s3_body(data, fail_after=20),
+            fake_s3_body(data[20:], fail_after=20,
+                         error=parsing_lib.urllib3.exceptions.ProtocolError("reset")),
+            fake_s3_body(data[40:])]
+        stream = parsing_lib.RawDataStream("bucket", "key")
+        try:
+            cases = list(stream.parse(fake_csv_parsing_fn, _SOURCE_ID, "url"))
+        finally:
+            stream.close()
+    assert len(cases) == 10
+    assert mock_s3.get_object.call_args.kwargs["Range"] == "bytes=40-"
+    assert mock_s3.get_object.call_args.kwargs["IfMatch"] == '"etag"'
+
+
+def test_raw_data_stream_fails_if_object_is_replaced():
+    import parsing_lib  # Import locally to avoid superseding mock
+    data = ("id,notes\n" + "".join(f"{i},note {i}\n" for i in range(10))).encode()
+    replaced = botocore.exceptions.ClientError(
+        {"Error": {"Code": "PreconditionFailed"}}, "GetObject")
+    with patch("parsing_lib.s3_client") as mock_s3:
+        mock_s3.get_object.side_effect = [fake_s3_body(data, fail_after=20), replaced]
+        stream = parsing_lib.RawDataStream("bucket", "key")
+        try:
+            with pytest.raises(botocore.exceptions.ClientError, match="PreconditionFailed"):
+                list(stream.parse(fake_csv_parsing_fn, _SOURCE_ID, "url"))
+        finally:
+            stream.close()
+    assert mock_s3.get_object.call_count == 2
+
+
+def test_raw_data_stream_raises_download_error():
+    import parsing_lib  # Import locally to avoid superseding mock
+    data = ("id,notes\n" + "".join(f"{i},note {i}\n" for i in range(10))).encode()
+    with patch("parsing_lib.s3_client") as mock_s3:
+        mock_s3.get_object.side_effect = lambda **kwargs: fake_s3_body(data, fail_after=20)
+        stream = parsing_lib.RawDataStream("bucket", "key")
+        try:
+            with pytest.raises(botocore.exceptions.ReadTimeoutError):
+                list(stream.parse(fake_csv_parsing_fn, _SOURCE_ID, "url"))
+        finally:
+            stream.close()
+
+
+def test_raw_data_stream_closes_when_parser_stops_early():
+    import parsing_lib  # Import locally to avoid superseding mock
+    data = ("id,notes\n" + "".join(f"{i},note {i}\n" for i in range(100000))).encode()
+    with patch("parsing_lib.s3_client") as mock_s3:
+        mock_s3.get_object.return_value = fake_s3_body(data)
+        stream = parsing_lib.RawDataStream("bucket", "key")
+        cases = stream.parse(fake_csv_parsing_fn, _SOURCE_ID, "url")
+        assert next(cases)["notes"] == "note 0"
+        cases.close()
+        stream.close()
+        unopened = parsing_lib.RawDataStream("bucket", "key")
+        unopened.close()
+    assert not stream._thread.is_alive() and not unopened._thread.is_alive()
+
+
 def test_extract_event_fields_returns_all_present_fields(input_event):
     import parsing_lib  # Import locally to avoid superseding mock
     assert parsing_lib.extract_event_fields(input_event) == (
@@ -509,6 +648,444 @@ def test_write_to_server_records_input_for_failed_batch_upsert_with_validation_e
     assert parsing_output.find('Hanuman Nagar, Darbhanga, Bihar, India') != -1
 
 
+def test_line_ranges_split_after_header_at_line_breaks(tmp_path):
+    import parsing_lib  # Import locally to avoid superseding mock
+    data = tmp_path / "data.csv"
+    data.write_bytes(b"id,notes\n1,a\n2,bb\n3,ccc\n4,d")
+    ranges = list(parsing_lib.line_ranges(str(data), 5))
+    assert [data.read_bytes()[start:end] for start, end in ranges] == [
+        b"1,a\n2,bb\n", b"3,ccc\n", b"4,d"]
+
+
+@pytest.mark.parametrize("range_bytes", [1, 20, 1000])
+def test_parse_in_parallel_yields_cases_in_file_order(tmp_path, range_bytes):
+    import parsing_lib  # Import locally to avoid superseding mock
+    data = tmp_path / "data.csv"
+    data.write_text("id,notes\n" + "".join(f"{i},note {i}\n" for i in range(50)))
+    cases = parsing_lib.parse_in_parallel(
+        fake_csv_parsing_fn, str(data), _SOURCE_ID, "url", 3, range_bytes)
+    assert list(cases) == list(fake_csv_parsing_fn(str(data), _SOURCE_ID, "url"))
+
+
+@pytest.mark.parametrize("chunk_rows", [1, 2, 1000])
+def test_read_csv_columns_yields_columns_in_chunks(tmp_path, chunk_rows):
+    import parsing_lib  # Import locally to avoid superseding mock
+    data = tmp_path / "data.csv"
+    data.write_text('id;notes;date\n1;"a;b";01/02/2021\n\n2;c\n3;d;02/02/2021\n')
+    chunks = list(parsing_lib.read_csv_columns(
+        str(data), ["date", "id"], chunk_rows, delimiter=";"))
+    assert len(chunks) == -(-3 // chunk_rows)
+    assert {c: sum((chunk[c] for chunk in chunks), []) for c in ["date", "id"]} == {
+        "date": ["01/02/2021", None, "02/02/2021"], "id": ["1", "2", "3"]}
+
+
+def test_read_csv_columns_raises_on_missing_columns(tmp_path):
+    import parsing_lib  # Import locally to avoid superseding mock
+    data = tmp_path / "data.csv"
+    data.write_text("id,notes\n1,a\n")
+    with pytest.raises(ValueError, match="date"):
+        list(parsing_lib.read_csv_columns(str(data), ["id", "date"]))
+
+
+def test_map_column_calls_function_once_per_distinct_value():
+    import parsing_lib  # Import locally to avoid superseding mock
+    func = MagicMock(side_effect=lambda *values: "-".join(values))
+    assert parsing_lib.map_column(func, ["a", "b", "a", "a"]) == ["a", "b", "a", "a"]
+    assert func.call_count == 2
+    cache = {}
+    assert parsing_lib.map_column(
+        func, ["a", "b", "a"], ["1", "1", "1"], cache=cache) == ["a-1", "b-1", "a-1"]
+    assert parsing_lib.map_column(func, ["b"], ["1"], cache=cache) == ["b-1"]
+    assert func.call_count == 4
+
+
+def test_pipelined_yields_results_in_order_with_bounded_concurrency():
+    import parsing_lib  # Import locally to avoid superseding mock
+    import threading
+    import time
+    lock = threading.Lock()
+    running = [0]
+    max_running = [0]
+
+    def slow_square(x):
+        with lock:
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+        time.sleep(0.01 * (5 - x))
+        with lock:
+            running[0] -= 1
+        return x * x
+
+    results = list(parsing_lib.pipelined(slow_square, iter(range(5)), 3))
+    assert results == [(0, 0), (1, 1), (2, 4), (3, 9), (4, 16)]
+    assert max_running[0] <= 3
+
+
+def test_write_to_server_concurrent_upload_aggregates_counts(
+        requests_mock, mock_source_api_url_fixture):
+    import parsing_lib  # Import locally to avoid superseding mock
+    full_source_url = f"{_SOURCE_API_URL}/cases/batchUpsert"
+    update_upload_url = f"{_SOURCE_API_URL}/sources/{_SOURCE_ID}/uploads/{_UPLOAD_ID}"
+    requests_mock.post(
+        full_source_url,
+        json={"numCreated": 1, "numUpdated": 2})
+    requests_mock.put(update_upload_url, json={})
+
+    count_created, count_updated, count_error = parsing_lib.write_to_server(
+        iter([_PARSED_CASE] * 5),
+        "env", _SOURCE_ID, _UPLOAD_ID, {}, {}, 2,
+        upload_concurrency=3)
+    posts = [r for r in requests_mock.request_history if r.method == "POST"]
+    assert sorted(len(posted_cases(r)) for r in posts) == [1, 2, 2]
+    assert count_created == 3
+    assert count_updated == 6
+    assert count_error == 0
+    assert requests_mock.request_history[-1].json()["summary"] == {
+        "numCreated": 3, "numUpdated": 6, "numError": 0}
+
+
+@pytest.mark.parametrize("compress", [True, False])
+def test_write_to_server_sends_batch_through_shared_session(
+        compress, requests_mock, mock_source_api_url_fixture):
+    import parsing_lib  # Import locally to avoid superseding mock
+    full_source_url = f"{_SOURCE_API_URL}/cases/batchUpsert"
+    update_upload_url = f"{_SOURCE_API_URL}/sources/{_SOURCE_ID}/uploads/{_UPLOAD_ID}"
+    requests_mock.post(full_source_url, json={"numCreated": 1, "numUpdated": 0})
+    requests_mock.put(update_upload_url, json={})
+    session = common_lib.new_session()
+    session.headers["X-Test"] = "injected"
+    with patch("common_lib.get_session", return_value=session), \
+            patch("parsing_lib.COMPRESS_UPLOADS", compress):
+        parsing_lib.write_to_server(
+            iter([_PARSED_CASE]), "env", _SOURCE_ID, _UPLOAD_ID, {"Authorization": "x"}, {},
+            parsing_lib.CASES_BATCH_SIZE)
+    post = requests_mock.request_history[0]
+    assert post.headers["X-Test"] == "injected"
+    assert post.headers["Authorization"] == "x"
+    assert (post.headers.get("Content-Encoding") == "gzip") == compress
+    assert posted_cases(post) == [_PARSED_CASE]
+
+
+@pytest.mark.parametrize("backend", ["json", "orjson"])
+def test_write_to_server_serializes_cases_with_backend(
+        backend, requests_mock, mock_source_api_url_fixture):
+    import parsing_lib  # Import locally to avoid superseding mock
+    if backend not in parsing_lib.CASE_SERIALIZERS:
+        pytest.skip(f"{backend} is not installed")
+    full_source_url = f"{_SOURCE_API_URL}/cases/batchUpsert"
+    update_upload_url = f"{_SOURCE_API_URL}/sources/{_SOURCE_ID}/uploads/{_UPLOAD_ID}"
+    requests_mock.post(full_source_url, json={"numCreated": 2, "numUpdated": 0})
+    requests_mock.put(update_upload_url, json={})
+    cases = [_PARSED_CASE, {**_PARSED_CASE, "notes": "São Paulo"}]
+
+    parsing_lib.write_to_server(
+        iter(cases), "env", _SOURCE_ID, _UPLOAD_ID, {}, {},
+        parsing_lib.CASES_BATCH_SIZE,
+        serialize_case=parsing_lib.get_case_serializer(backend))
+    assert posted_cases(requests_mock.request_history[0]) == cases
+
+
+@pytest.mark.parametrize("backend", ["json", "orjson"])
+@pytest.mark.parametrize("value", [float("nan"), float("inf"), -float("inf")])
+def test_case_serializers_reject_non_finite_floats(backend, value):
+    import parsing_lib  # Import locally to avoid superseding mock
+    if backend not in parsing_lib.CASE_SERIALIZERS:
+        pytest.skip(f"{backend} is not installed")
+    serialize = parsing_lib.get_case_serializer(backend)
+    assert json.loads(serialize({"location": {"geometry": {"latitude": None}}}))
+    with pytest.raises(ValueError):
+        serialize({"location": {"geometry": {"latitude": value, "longitude": None}}})
+
+
+def test_get_case_serializer_falls_back_to_json():
+    import parsing_lib  # Import locally to avoid superseding mock
+    assert parsing_lib.get_case_serializer("nope") is parsing_lib.json_serialize_case
+
+
+def test_batch_sizer_caps_batches_by_bytes():
+    import parsing_lib  # Import locally to avoid superseding mock
+    case = parsing_lib.json_serialize_case(_PARSED_CASE)
+    case_bytes = len(case)
+    sizer = parsing_lib.BatchSizer(initial_cases=10, max_bytes=3 * case_bytes)
+    cases = iter([case] * 7)
+    assert len(sizer.next_batch(cases)) == 3
+    assert len(sizer.next_batch(cases)) == 3
+    assert len(sizer.next_batch(cases)) == 1
+    assert sizer.next_batch(cases) == []
+    assert sizer.sizes == [(3, 3 * case_bytes), (3, 3 * case_bytes), (1, case_bytes)]
+
+
+def test_batch_sizer_grows_when_fast_and_shrinks_on_slow_or_retried_batches():
+    import parsing_lib  # Import locally to avoid superseding mock
+    sizer = parsing_lib.BatchSizer(initial_cases=4, min_cases=2, max_cases=8,
+                                   target_seconds=1)
+    cases = iter([parsing_lib.json_serialize_case(_PARSED_CASE)] * 100)
+    sizer.next_batch(cases)
+    sizer.record(0.5, 0)
+    assert sizer.case_limit == 6
+    sizer.next_batch(cases)
+    sizer.record(0.5, 0)
+    assert sizer.case_limit == 8  # capped at max_cases
+    sizer.next_batch(cases)
+    sizer.record(2, 0)
+    assert sizer.case_limit == 4
+    sizer.next_batch(cases)
+    sizer.record(0.1, 1)
+    assert sizer.case_limit == 2
+    sizer.next_batch(cases)
+    sizer.record(0.1, 1)
+    assert sizer.case_limit == 2  # capped at min_cases
+
+
+def test_write_to_server_with_batch_sizer(requests_mock, mock_source_api_url_fixture):
+    import parsing_lib  # Import locally to avoid superseding mock
+    full_source_url = f"{_SOURCE_API_URL}/cases/batchUpsert"
+    update_upload_url = f"{_SOURCE_API_URL}/sources/{_SOURCE_ID}/uploads/{_UPLOAD_ID}"
+    requests_mock.post(full_source_url, json={"numCreated": 1, "numUpdated": 0})
+    requests_mock.put(update_upload_url, json={})
+    sizer = parsing_lib.BatchSizer(initial_cases=2, max_cases=3)
+
+    parsing_lib.write_to_server(
+        iter([_PARSED_CASE] * 6), "env", _SOURCE_ID, _UPLOAD_ID, {}, {},
+        parsing_lib.CASES_BATCH_SIZE, batch_sizer=sizer)
+    posts = [r for r in requests_mock.request_history if r.method == "POST"]
+    assert [len(posted_cases(r)) for r in posts] == [2, 3, 1]
+
+
+def test_write_to_server_profiles_serialization_and_requests(
+        requests_mock, mock_source_api_url_fixture):
+    import parsing_lib  # Import locally to avoid superseding mock
+    full_source_url = f"{_SOURCE_API_URL}/cases/batchUpsert"
+    update_upload_url = f"{_SOURCE_API_URL}/sources/{_SOURCE_ID}/uploads/{_UPLOAD_ID}"
+    requests_mock.post(full_source_url, json={"numCreated": 1, "numUpdated": 0})
+    requests_mock.put(update_upload_url, json={})
+    profile = parsing_lib.ingestion_profiling.Profile()
+
+    parsing_lib.write_to_server(
+        iter([_PARSED_CASE] * 5), "env", _SOURCE_ID, _UPLOAD_ID, {}, {}, 2, profile=profile)
+    stages = profile.report()["stages"]
+    assert stages["serialize"]["count"] == 5
+    assert stages["http"]["count"] == 3
+
+
+def test_write_to_server_spools_cases(
+        tmp_path, requests_mock, mock_source_api_url_fixture):
+    import parsing_lib  # Import locally to avoid superseding mock
+    full_source_url = f"{_SOURCE_API_URL}/cases/batchUpsert"
+    update_upload_url = f"{_SOURCE_API_URL}/sources/{_SOURCE_ID}/uploads/{_UPLOAD_ID}"
+    requests_mock.post(full_source_url, json={"numCreated": 2, "numUpdated": 0})
+    requests_mock.put(update_upload_url, json={})
+    cases = [{**_PARSED_CASE, "notes": str(i)} for i in range(5)]
+    bucket = FakeBucket()
+    spool = parsing_lib.CaseSpool("bucket", _SOURCE_ID, _UPLOAD_ID, tmp_path / "spool")
+
+    with patch("parsing_lib.s3_client", bucket), patch("parsing_lib.SPOOL_SEGMENT_CASES", 2):
+        parsing_lib.write_to_server(
+            iter(cases), "env", _SOURCE_ID, _UPLOAD_ID, {}, {}, 2, spool=spool)
+        spooled = parsing_lib.CaseSpool.load("bucket", _SOURCE_ID, _UPLOAD_ID)
+        replayed = [json.loads(case) for case in spooled.replay()]
+    posts = [r for r in requests_mock.request_history if r.method == "POST"]
+    assert [posted_cases(r) for r in posts] == [cases[:2], cases[2:4], cases[4:]]
+    # local segments are deleted once uploaded, those in the bucket are kept
+    assert not list(spool.directory.glob("segment-*"))
+    assert (spooled.segments, spooled.cases) == (3, 5)
+    assert replayed == cases
+    assert set(bucket.tags.values()) == {parsing_lib.CHECKPOINT_TAG}
+
+
+def test_write_to_server_spools_cases_skipped_when_resuming(
+        tmp_path, requests_mock, mock_source_api_url_fixture):
+    import parsing_lib  # Import locally to avoid superseding mock
+    full_source_url = f"{_SOURCE_API_URL}/cases/batchUpsert"
+    update_upload_url = f"{_SOURCE_API_URL}/sources/{_SOURCE_ID}/uploads/{_UPLOAD_ID}"
+    requests_mock.post(full_source_url, json={"numCreated": 1, "numUpdated": 0})
+    requests_mock.put(update_upload_url, json={})
+    checkpoint = parsing_lib.Checkpoint("bucket", _SOURCE_ID, _UPLOAD_ID, {}, interval=60)
+    checkpoint.batches, checkpoint.cases = 1, 2
+    cases = [{**_PARSED_CASE, "notes": str(i)} for i in range(5)]
+    spool = parsing_lib.CaseSpool("bucket", _SOURCE_ID, _UPLOAD_ID, tmp_path / "spool")
+
+    with patch("parsing_lib.s3_client", FakeBucket()), \
+            patch("parsing_lib.SPOOL_SEGMENT_CASES", 2):
+        counts = parsing_lib.write_to_server(
+            iter(cases), "env", _SOURCE_ID, _UPLOAD_ID, {}, {}, 2,
+            checkpoint=checkpoint, spool=spool)
+        spooled = parsing_lib.CaseSpool.load("bucket", _SOURCE_ID, _UPLOAD_ID)
+    assert counts == (2, 0, 0)
+    posts = [r for r in requests_mock.request_history if r.method == "POST"]
+    assert [posted_cases(r) for r in posts] == [cases[2:4], cases[4:]]
+    assert (checkpoint.batches, checkpoint.cases) == (3, 5)
+    assert spooled.cases == 5
+
+
+def test_replay_spool_resumes_failed_upload_without_parsing(
+        tmp_path, input_event, requests_mock, mock_source_api_url_fixture):
+    import parsing_lib  # Import locally to avoid superseding mock
+    cases = [{**_PARSED_CASE, "notes": str(i)} for i in range(5)]
+    upload_url = f"{_SOURCE_API_URL}/sources/{_SOURCE_ID}/uploads/{_UPLOAD_ID}"
+    requests_mock.get(f"{_SOURCE_API_URL}/sources/{_SOURCE_ID}", json={})
+    requests_mock.get(f"{_SOURCE_API_URL}/excludedCaseIds", json={"cases": []})
+    requests_mock.post(f"{_SOURCE_API_URL}/cases/batchUpsert",
+                       json={"numCreated": 2, "numUpdated": 0})
+    requests_mock.put(upload_url, [{"json": {}}] * 3 + [{"status_code": 503, "text": "down"}]
+                      + [{"json": {}}] * 4)
+    event = {**input_event, "dateRange": None}
+    bucket = FakeBucket()
+    bucket.put_object(Bucket="gdh-sources", Key=event["s3Key"], Body=b"")
+    parsed = []
+
+    def parsing_fn(raw_data_file, source_id, source_url):
+        parsed.extend(cases)
+        return iter(cases)
+    with patch("parsing_lib.s3_client", bucket), \
+            patch("parsing_lib.SPOOL_DIR", str(tmp_path)), \
+            patch("parsing_lib.SPOOL_SEGMENT_CASES", 2), \
+            patch("parsing_lib.CASES_BATCH_SIZE", 2), \
+            patch("common_lib.login"):
+        # all cases are sent, but the upload fails to be finalized
+        with pytest.raises(RuntimeError, match="down"):
+            parsing_lib.run(event, parsing_fn)
+        assert not list(tmp_path.rglob("segment-*"))
+        checkpoint_key = f"{_SOURCE_ID}/checkpoints/{_UPLOAD_ID}.json"
+        checkpoint = json.loads(bucket.objects[checkpoint_key])
+        assert checkpoint["cases"] == 5
+        # as if the upload had failed after its first batch
+        checkpoint.update(batches=1, cases=2,
+                          counts={"numCreated": 2, "numUpdated": 0, "numError": 0})
+        bucket.put_object(Bucket="gdh-sources", Key=checkpoint_key, Body=json.dumps(checkpoint))
+        num_posts = requests_mock.call_count
+        result = parsing_lib.replay_spool(event)
+    assert len(parsed) == 5
+    posts = [r for r in requests_mock.request_history[num_posts:] if r.method == "POST"]
+    assert [posted_cases(r) for r in posts] == [cases[2:4], cases[4:]]
+    assert requests_mock.request_history[-1].json()["status"] == "SUCCESS"
+    assert result == {"count_created": 6, "count_updated": 0}
+    # the spool and the checkpoint are deleted once the upload is finalized
+    assert list(bucket.objects) == [event["s3Key"]]
+
+
+def test_replay_spool_fails_without_complete_spool(
+        input_event, requests_mock, mock_source_api_url_fixture):
+    import parsing_lib  # Import locally to avoid superseding mock
+    requests_mock.get(f"{_SOURCE_API_URL}/sources/{_SOURCE_ID}", json={})
+    requests_mock.put(f"{_SOURCE_API_URL}/sources/{_SOURCE_ID}/uploads/{_UPLOAD_ID}", json={})
+
+    with patch("parsing_lib.s3_client", FakeBucket()), patch("common_lib.login"):
+        with pytest.raises(parsing_lib.ParserError, match="no complete spool"):
+            parsing_lib.replay_spool(input_event)
+    assert requests_mock.request_history[-1].json()["status"] == "ERROR"
+
+
+def test_case_spool_raises_parser_error_after_spooled_cases(tmp_path):
+    import parsing_lib  # Import locally to avoid superseding mock
+
+    def failing_cases():
+        yield b'{"n":1}'
+        raise ValueError("bad row")
+    bucket = FakeBucket()
+    spool = parsing_lib.CaseSpool("bucket", _SOURCE_ID, _UPLOAD_ID, tmp_path)
+    with patch("parsing_lib.s3_client", bucket), patch("parsing_lib.SPOOL_SEGMENT_CASES", 1):
+        cases = spool.spool(failing_cases())
+        assert next(cases) == b'{"n":1}'
+        with pytest.raises(ValueError, match="bad row"):
+            next(cases)
+    # an incomplete spool is not replayable
+    assert spool.manifest_key not in bucket.objects
+
+
+def test_case_spool_close_stops_parser_and_deletes_local_spool(tmp_path):
+    import parsing_lib  # Import locally to avoid superseding mock
+    parsed = []
+
+    def endless_cases():
+        while True:
+            parsed.append(None)
+            yield b'{"n":1}'
+    bucket = FakeBucket()
+    spool = parsing_lib.CaseSpool("bucket", _SOURCE_ID, _UPLOAD_ID, tmp_path / "spool")
+    with patch("parsing_lib.s3_client", bucket), patch("parsing_lib.SPOOL_SEGMENT_CASES", 10):
+        cases = spool.spool(endless_cases())
+        assert next(cases) == b'{"n":1}'
+        spool.close()
+        cases.close()
+    assert not spool._thread.is_alive()
+    num_parsed = len(parsed)
+    time.sleep(0.05)
+    assert len(parsed) == num_parsed
+    assert not spool.directory.exists()
+    assert spool.manifest_key not in bucket.objects
+
+
+def test_write_to_server_resumes_from_checkpoint(requests_mock, mock_source_api_url_fixture):
+    import parsing_lib  # Import locally to avoid superseding mock
+    full_source_url = f"{_SOURCE_API_URL}/cases/batchUpsert"
+    update_upload_url = f"{_SOURCE_API_URL}/sources/{_SOURCE_ID}/uploads/{_UPLOAD_ID}"
+    requests_mock.post(full_source_url, json={"numCreated": 1, "numUpdated": 1})
+    requests_mock.put(update_upload_url, json={})
+    checkpoint = parsing_lib.Checkpoint("bucket", _SOURCE_ID, _UPLOAD_ID, {}, interval=0)
+    checkpoint.batches, checkpoint.cases = 1, 2
+    checkpoint.counts = {"numCreated": 2, "numUpdated": 0, "numError": 0}
+    cases = [{**_PARSED_CASE, "notes": str(i)} for i in range(5)]
+
+    with patch("parsing_lib.s3_client") as mock_s3:
+        counts = parsing_lib.write_to_server(
+            iter(cases), "env", _SOURCE_ID, _UPLOAD_ID, {}, {}, 2, checkpoint=checkpoint)
+    assert counts == (4, 2, 0)
+    posts = [r for r in requests_mock.request_history if r.method == "POST"]
+    assert [posted_cases(r) for r in posts] == [cases[2:4], cases[4:]]
+    saved = mock_s3.put_object.call_args.kwargs
+    assert saved["Key"] == f"{_SOURCE_ID}/checkpoints/{_UPLOAD_ID}.json"
+    assert json.loads(saved["Body"]) == {
+        "event": {}, "batches": 3, "cases": 5,
+        "counts": {"numCreated": 4, "numUpdated": 2, "numError": 0}}
+
+
+def test_run_saves_checkpoint_when_ingestion_fails(
+        input_event, requests_mock, mock_source_api_url_fixture):
+    import parsing_lib  # Import locally to avoid superseding mock
+
+    def failing_parsing_fn(raw_data_file, source_id, source_url):
+        yield from [_PARSED_CASE] * 3
+        raise ValueError("bad row")
+    requests_mock.get(f"{_SOURCE_API_URL}/sources/{_SOURCE_ID}", json={})
+    requests_mock.get(f"{_SOURCE_API_URL}/excludedCaseIds", json={"cases": []})
+    requests_mock.post(f"{_SOURCE_API_URL}/cases/batchUpsert",
+                       json={"numCreated": 2, "numUpdated": 0})
+    requests_mock.put(f"{_SOURCE_API_URL}/sources/{_SOURCE_ID}/uploads/{_UPLOAD_ID}", json={})
+
+    with patch("parsing_lib.s3_client") as mock_s3, \
+            patch("parsing_lib.CASES_BATCH_SIZE", 2), \
+            patch("common_lib.login"):
+        mock_s3.get_object.side_effect = botocore.exceptions.ClientError(
+            {"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        with pytest.raises(ValueError, match="bad row"):
+            parsing_lib.run({**input_event, "dateRange": None}, failing_parsing_fn)
+    saved = mock_s3.put_object.call_args.kwargs
+    assert saved["Key"] == f"{_SOURCE_ID}/checkpoints/{_UPLOAD_ID}.json"
+    assert saved["Tagging"] == parsing_lib.CHECKPOINT_TAG
+    assert json.loads(saved["Body"])["cases"] == 2
+    assert requests_mock.request_history[-1].json()["status"] == "ERROR"
+
+
+def test_checkpoint_load_returns_saved_checkpoint():
+    import parsing_lib  # Import locally to avoid superseding mock
+    saved = {"event": {"s3Key": "key"}, "batches": 3, "cases": 750,
+             "counts": {"numCreated": 700, "numUpdated": 40, "numError": 10}}
+    with patch("parsing_lib.s3_client") as mock_s3:
+        mock_s3.get_object.return_value = {"Body": io.BytesIO(json.dumps(saved).encode())}
+        checkpoint = parsing_lib.Checkpoint.load("bucket", _SOURCE_ID, _UPLOAD_ID)
+    assert (checkpoint.event, checkpoint.batches, checkpoint.cases, checkpoint.counts) == (
+        saved["event"], 3, 750, saved["counts"])
+
+
+def test_checkpoint_load_returns_none_without_checkpoint():
+    import parsing_lib  # Import locally to avoid superseding mock
+    with patch("parsing_lib.s3_client") as mock_s3:
+        mock_s3.get_object.side_effect = parsing_lib.botocore.exceptions.ClientError(
+            {"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        assert parsing_lib.Checkpoint.load("bucket", _SOURCE_ID, _UPLOAD_ID) is None
+
+
 @patch('parsing_lib.get_today')
 def test_filter_cases_by_date_keeps_exact_with_EQ(mock_today):
     import parsing_lib  # Import locally to avoid superseding mock
@@ -655,6 +1232,45 @@ def test_filter_cases_by_date_handles_two_date_formats():
     assert next(cases) == other_date_format_case
 
 
+@patch('parsing_lib.get_today')
+def test_filter_cases_by_date_rounds_cutoff_during_day(mock_today):
+    import parsing_lib  # Import locally to avoid superseding mock
+    mock_today.return_value = datetime.datetime(2020, 6, 8, 12, 30)
+    date_filter = {"numDaysBeforeToday": 3}
+    selected = {op: list(parsing_lib.filter_cases_by_date(
+        [CASE_JUNE_FIFTH], {**date_filter, "op": op}, None,
+        "env", "source_id", "upload_id", {}, {})) for op in ["EQ", "LT", "GT"]}
+    assert selected == {"EQ": [], "LT": [CASE_JUNE_FIFTH], "GT": []}
+
+
+@pytest.mark.parametrize("date_string", [
+    "06/05/2020Z", "06/05/2020", "6/5/2020Z", "12/31/1999Z", "02/29/2020Z"])
+def test_case_date_ordinal_matches_get_case_date(date_string):
+    import parsing_lib  # Import locally to avoid superseding mock
+    assert (parsing_lib.case_date_ordinal(date_string)
+            == parsing_lib.get_case_date(date_string).toordinal())
+
+
+@pytest.mark.parametrize("date_string", ["02/30/2020Z", "13/01/2020Z", "2020-06-05"])
+def test_case_date_ordinal_raises_on_invalid_date(date_string):
+    import parsing_lib  # Import locally to avoid superseding mock
+    with pytest.raises(ValueError):
+        parsing_lib.case_date_ordinal(date_string)
+
+
+def test_filter_cases_by_date_parses_each_date_once():
+    import parsing_lib  # Import locally to avoid superseding mock
+    with patch("parsing_lib.case_date_ordinal",
+               side_effect=parsing_lib.case_date_ordinal) as parse:
+        cases = parsing_lib.filter_cases_by_date(
+            [CASE_JUNE_FIFTH] * 5,
+            None,
+            {"start": "2020-06-05", "end": "2020-06-05"},
+            "env", "source_id", "upload_id", {}, {})  # api_creds
+        assert len(list(cases)) == 5
+    parse.assert_called_once_with("06/05/2020Z")
+
+
 def test_remove_nested_none_and_empty_removes_only_nones_and_empty_str():
     import parsing_lib  # Import locally to avoid superseding mock
     data = {"keep1": 0, "keep2": False, "keep3": [], "drop1": None,
@@ -666,6 +1282,17 @@ def test_remove_nested_none_and_empty_removes_only_nones_and_empty_str():
                 "emptyobject": {}}
     assert parsing_lib.remove_nested_none_and_empty(data) == expected
 
+def test_remove_nested_none_and_empty_copies_only_what_changes():
+    import parsing_lib  # Import locally to avoid superseding mock
+    clean = {"a": 1, "b": [1, {"c": "x"}]}
+    assert parsing_lib.remove_nested_none_and_empty(clean) is clean
+    data = {"keep": {"x": 1}, "prune": {"y": None, "z": [None, "", 0]}, "drop": ""}
+    original = copy.deepcopy(data)
+    pruned = parsing_lib.remove_nested_none_and_empty(data)
+    assert pruned == {"keep": {"x": 1}, "prune": {"z": [0]}}
+    assert pruned["keep"] is data["keep"]
+    assert data == original
+
 def test_excluded_case_are_removed_from_cases():
     import parsing_lib  # Import locally to avoid superseding mock
 
@@ -678,6 +1305,63 @@ def test_excluded_case_are_removed_from_cases():
     assert len(cases_list) == 1
     assert cases_list[0]["caseReference"]["sourceEntryId"] == valid_case["caseReference"]["sourceEntryId"]
 
+def test_retrieve_excluded_case_ids_returns_set(requests_mock, mock_source_api_url_fixture):
+    import parsing_lib  # Import locally to avoid superseding mock
+    excluded_case_ids_url = (f"{_SOURCE_API_URL}/excludedCaseIds?sourceId={_SOURCE_ID}"
+                             "&dateFrom=2020-06-01&dateTo=2020-06-30")
+    requests_mock.get(excluded_case_ids_url, json={"cases": ["1", "2", "2"]})
+    excluded_case_ids = parsing_lib.retrieve_excluded_case_ids(
+        _SOURCE_ID, None, {"start": "2020-06-01", "end": "2020-06-30"}, "env")
+    assert excluded_case_ids == {"1", "2"}
+
+# Formats used by parsers, and some with other directives (strptime only)
+_DATE_FORMATS = [
+    "%d/%m/%Y", "%Y%m%d", "%m/%d/%y", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S.%fZ",
+    "%Y/%m/%d", "%d-%m-%Y", "%m/%d/%YZ", "%Y-%m-%d  %H", "%d %b %Y", "%Y-%j"]
+
+
+def strptime_or_error(raw_date, date_format):
+    try:
+        return datetime.datetime.strptime(raw_date, date_format)
+    except ValueError as e:
+        return str(e)
+
+
+def test_parse_date_is_equivalent_to_strptime():
+    import parsing_lib  # Import locally to avoid superseding mock
+    import random
+    rnd = random.Random(0)
+    for _ in range(20000):
+        date_format = rnd.choice(_DATE_FORMATS)
+        raw_date = list((datetime.datetime(1950, 1, 1) + datetime.timedelta(
+            seconds=rnd.randrange(3 * 10 ** 9), microseconds=rnd.randrange(10 ** 6))
+        ).strftime(date_format))
+        # corrupt some of the dates
+        for _ in range(rnd.choice([0, 0, 1, 2])):
+            raw_date[rnd.randrange(len(raw_date))] = rnd.choice("0123456789/-: TZz.")
+        if rnd.random() < 0.1:
+            del raw_date[rnd.randrange(len(raw_date))]
+        raw_date = "".join(raw_date)
+        try:
+            parsed = parsing_lib.parse_date(raw_date, date_format)
+        except ValueError as e:
+            parsed = str(e)
+        assert parsed == strptime_or_error(raw_date, date_format), (raw_date, date_format)
+
+
+def test_parse_date_is_memoized_including_failures():
+    import parsing_lib  # Import locally to avoid superseding mock
+
+    before = parsing_lib.parse_date_cache_info()
+    for _ in range(3):
+        assert parsing_lib.parse_date("31/01/2021", "%d/%m/%Y") == datetime.datetime(2021, 1, 31)
+        with pytest.raises(ValueError, match="does not match format"):
+            parsing_lib.parse_date("2021-01-31", "%d/%m/%Y")
+    after = parsing_lib.parse_date_cache_info()
+    assert after.hits - before.hits >= 4
+    assert after.misses - before.misses <= 2
+
+
 def test_country_code_lookup_by_exact_name():
     import parsing_lib # Import locally to avoid superseding mock
 
@@ -690,6 +1374,14 @@ def test_country_code_lookup_by_partial_name():
     code = parsing_lib.iso3166_country_code('Netherland')
     assert(code == 'NL')
 
+def test_country_code_partial_matches_are_those_of_a_scan_of_all_names():
+    import parsing_lib # Import locally to avoid superseding mock
+
+    for name in list(parsing_lib.countries_index)[::10]:
+        for part in {name[i:i + n] for n in [1, 3, 7] for i in range(len(name) - n + 1)}:
+            scanned = {code for other, code in parsing_lib.countries_index.items() if part in other}
+            assert set(parsing_lib._partially_matching_countries(part)) == scanned
+
 def test_country_code_lookup_by_code_returns_code():
     import parsing_lib # Import locally to avoid superseding mock
 
@@ -701,3 +1393,15 @@ def test_country_code_lookup_raises_on_ambiguous_name():
 
     with pytest.raises(KeyError):
         code = parsing_lib.iso3166_country_code('United')
+
+def test_country_code_lookup_is_memoized_including_failures():
+    import parsing_lib # Import locally to avoid superseding mock
+
+    before = parsing_lib.iso3166_country_code_cache_info()
+    for _ in range(3):
+        assert parsing_lib.iso3166_country_code('Netherland') == 'NL'
+        with pytest.raises(KeyError):
+            parsing_lib.iso3166_country_code('Atlantis')
+    after = parsing_lib.iso3166_country_code_cache_info()
+    assert after.hits - before.hits >= 4
+    assert after.misses - before.misses <= 2
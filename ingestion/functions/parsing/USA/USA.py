@@ -45,7 +45,7 @@ def convert_date(raw_date, manual_import=False):
     If manual_import is set to True, returns in format recognized by MongoDB.
     """
     try:
-        date = datetime.strptime(raw_date, "%Y/%m/%d")
+        date = parsing_lib.parse_date(raw_date, "%Y/%m/%d")
         return (
             {"$date": date.strftime("%Y-%m-%dT00:00:00Z")}
             if manual_import else date.strftime("%m/%d/%YZ")
@@ -209,7 +209,7 @@ def prepare_manual_import(raw_data_file: str, source_url: str, last_date: str =
 
 
 def event_handler(event):
-    return parsing_lib.run(event, parse_cases)
+    return parsing_lib.run(event, parse_cases, row_independent=True)
 
 if __name__ == "__main__":
     with open('input_event.json') as f:
@@ -1,6 +1,5 @@
 import os
 import sys
-from datetime import datetime
 import csv
 import json
 import common.ingestion_logging as logging
@@ -48,7 +47,7 @@ def convert_date(date_str: str):
 
     The date is listed in YYYY-mm-dd format
     """
-    date = datetime.strptime(date_str, "%Y-%m-%d")
+    date = parsing_lib.parse_date(date_str, "%Y-%m-%d")
 
     return date.strftime("%m/%d/%Y")
 
@@ -1,7 +1,6 @@
 import json
 import os
 import sys
-from datetime import datetime
 import csv
 import common.ingestion_logging as logging
 
@@ -132,11 +131,11 @@ def convert_date(raw_date: str):
     if raw_date.startswith("None"):
         return None
     try:
-        date = datetime.strptime(raw_date, "%Y-%m-%d %H:%M:%S")
+        date = parsing_lib.parse_date(raw_date, "%Y-%m-%d %H:%M:%S")
         return date.strftime("%m/%d/%YZ")
     except ValueError:
         try:
-            date = datetime.strptime(raw_date, "%Y-%m-%dT%H:%M:%S.%fZ")
+            date = parsing_lib.parse_date(raw_date, "%Y-%m-%dT%H:%M:%S.%fZ")
             return date.strftime("%m/%d/%YZ")
         except:
             return None
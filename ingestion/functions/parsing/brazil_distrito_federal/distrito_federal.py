@@ -1,6 +1,5 @@
 import os
 import sys
-from datetime import datetime
 import csv
 import json
 import common.ingestion_logging as logging
@@ -53,9 +52,9 @@ def convert_date(raw_date):
     try:
         # There is variation in how dates are reported
         if "-" in raw_date:
-            date = datetime.strptime(raw_date, "%Y-%m-%d")
+            date = parsing_lib.parse_date(raw_date, "%Y-%m-%d")
         else:
-            date = datetime.strptime(raw_date, "%d/%m/%Y")
+            date = parsing_lib.parse_date(raw_date, "%d/%m/%Y")
         return date.strftime("%m/%d/%YZ")
     except:
         return None
@@ -1,7 +1,6 @@
 import json
 import os
 import sys
-from datetime import datetime
 import csv
 
 # Layer code, like parsing_lib, is added to the path by AWS.
@@ -92,7 +91,7 @@ def convert_date(raw_date):
     Convert raw date field into a value interpretable by the dataserver.
     """
     if raw_date:
-        date = datetime.strptime(raw_date, "%Y-%m-%d")
+        date = parsing_lib.parse_date(raw_date, "%Y-%m-%d")
         return date.strftime("%m/%d/%YZ")
 
 
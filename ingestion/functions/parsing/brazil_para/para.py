@@ -1,7 +1,6 @@
 import json
 import os
 import sys
-from datetime import datetime
 import csv
 
 # Layer code, like parsing_lib, is added to the path by AWS.
@@ -65,7 +64,7 @@ def convert_date(raw_date):
     Convert raw date field into a value interpretable by the dataserver.
     """
     try:
-        date = datetime.strptime(raw_date.split("T")[0], "%Y-%m-%d")
+        date = parsing_lib.parse_date(raw_date.split("T")[0], "%Y-%m-%d")
         return date.strftime("%m/%d/%YZ")
     except:
         return None
@@ -122,7 +121,7 @@ def convert_events(date_confirmed, date_symptoms, test_type, outcome):
         }
     ]
     # There are some date entries which are before the earliest allowed date
-    if date_symptoms not in _NONE_TYPES and datetime.strptime(date_symptoms.split("T")[0], "%Y-%m-%d") > datetime.strptime("2019-11-01", "%Y-%m-%d"):
+    if date_symptoms not in _NONE_TYPES and parsing_lib.parse_date(date_symptoms.split("T")[0], "%Y-%m-%d") > parsing_lib.parse_date("2019-11-01", "%Y-%m-%d"):
         events.append(
             {
                 "name": "onsetSymptoms",
@@ -1,7 +1,6 @@
 import json
 import os
 import sys
-from datetime import datetime
 import csv
 
 # Layer code, like parsing_lib, is added to the path by AWS.
@@ -22,7 +21,7 @@ def convert_date(date_str: str,dataserver=True):
 
     The date is listed in dd/mm/YYYY  format
     """    
-    date = datetime.strptime(date_str.split(' ')[0], "%Y/%m/%d")
+    date = parsing_lib.parse_date(date_str.split(' ')[0], "%Y/%m/%d")
     if not dataserver:
         return date.strftime("%m/%d/%Y")
     return date.strftime("%m/%d/%YZ")
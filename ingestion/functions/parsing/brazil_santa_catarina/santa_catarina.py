@@ -1,7 +1,6 @@
 import json
 import os
 import sys
-from datetime import datetime
 import csv
 
 # Layer code, like parsing_lib, is added to the path by AWS.
@@ -75,11 +74,11 @@ def convert_date(raw_date):
     """
     # Two date formats in use
     try:
-        date = datetime.strptime(raw_date.split(" ")[0], "%Y-%m-%d")
+        date = parsing_lib.parse_date(raw_date.split(" ")[0], "%Y-%m-%d")
         return date.strftime("%m/%d/%YZ")
     except ValueError:
         try:
-            date = datetime.strptime(raw_date.split(" ")[0], "%d-%m-%Y")
+            date = parsing_lib.parse_date(raw_date.split(" ")[0], "%d-%m-%Y")
             return date.strftime("%m/%d/%YZ")
         except:
             return None
@@ -245,7 +244,7 @@ def parse_cases(raw_data_file: str, source_id: str, source_url: str):
         for row in reader:
             # A few anomalous confirmation dates reported e.g. from the year 1990
             confirmation_date = convert_date(row[_DATE_CONFIRMED])
-            if row[_CLASSIFICATION] == "CONFIRMADO" and row[_STATE] == "SANTA CATARINA" and confirmation_date is not None and datetime.strptime(confirmation_date.split("Z")[0], "%m/%d/%Y") > datetime.strptime("11/01/2020", "%m/%d/%Y"):
+            if row[_CLASSIFICATION] == "CONFIRMADO" and row[_STATE] == "SANTA CATARINA" and confirmation_date is not None and parsing_lib.parse_date(confirmation_date.split("Z")[0], "%m/%d/%Y") > parsing_lib.parse_date("11/01/2020", "%m/%d/%Y"):
                 try:
                     case = {
                         "caseReference": {"sourceId": source_id, "sourceUrl": source_url},
@@ -1,7 +1,6 @@
 import os
 import sys
 from datetime import datetime
-import csv
 import json
 
 # Layer code, like parsing_lib, is added to the path by AWS.
@@ -70,6 +69,23 @@ _TRAVEL_COUNTRY = "PAIS_VGM"
 _TRAVEL_OUT = "DT_VGM"
 _TRAVEL_RETURN = "DT_RT_VGM"
 
+_EVENT_COLUMNS = [
+    _DATE_CONFIRMED, _DATE_SYMPTOMS, _SEROLOGICAL_TEST_IGG, _SEROLOGICAL_TEST_IGM,
+    _SEROLOGICAL_TEST_IGA, _PCR_TEST, _HOSPITALIZED, _DATE_HOSP, _ICU, _ICU_ENTRY,
+    _ICU_DISCHARGE, _OUTCOME, _DATE_OUTCOME]
+_SYMPTOM_COLUMNS = [
+    _TASTE, _SMELL, _SORE_THROAT, _DYSPNEA, _FEVER, _COUGH, _BREATHING_DIFFICULTY,
+    _LOW_OXYGEN, _DIARRHOEA, _VOMITING, _STOMACH_ACHE, _FATIGUE]
+_COMORBIDITY_COLUMNS = [
+    _DIABETES, _PREGNANCY, _KIDNEY, _HEART, _OBESITY, _DOWN_SYND, _LIVER, _ASTHMA,
+    _NEUROLOGIC, _LUNG, _OTHER_COMORB]
+_TRAVEL_COLUMNS = [_TRAVEL_YN, _TRAVEL_COUNTRY, _TRAVEL_OUT, _TRAVEL_RETURN]
+_VACCINE_COLUMNS = [_DATE_DOSE_1, _DATE_DOSE_2, _BATCH_DOSE_1, _BATCH_DOSE_2]
+_COLUMNS = list(dict.fromkeys(
+    [_COVID_CONFIRMED, _STATE, _MUNICIPALITY, _GENDER, _AGE, _AGE_TYPE, _ETHNICITY]
+    + _EVENT_COLUMNS + _SYMPTOM_COLUMNS + _COMORBIDITY_COLUMNS + _TRAVEL_COLUMNS
+    + _VACCINE_COLUMNS))
+
 _COMORBIDITIES_MAP = {
     "DIABETES": "diabetes mellitus",
     "CS_GESTANT": "pregnancy",
@@ -129,29 +145,30 @@ def convert_date(raw_date: str, reference_date=None, dataserver=True, adi = True
 
     Hospitalization dates are sometimes given as dates in the future, which aren't allowed
     """
-    today = datetime.now().date()
+    # midnight today
+    today = datetime.combine(datetime.now().date(), datetime.min.time())
+    date = parsing_lib.parse_date(raw_date, "%d/%m/%Y") if raw_date else None
     if adi is False:
-        if raw_date and datetime.strptime(raw_date, "%d/%m/%Y") < datetime.strptime(str(today), "%Y-%m-%d"):
-            date = datetime.strptime(raw_date, "%d/%m/%Y")
+        if date is not None and date < today:
             return {"$date": f"{date.isoformat()}Z"}
         if not dataserver:
             return date.strftime("%m/%d/%Y")
     else:
-        if raw_date and datetime.strptime(raw_date, "%d/%m/%Y") < datetime.strptime(str(today), "%Y-%m-%d"):
-            date = datetime.strptime(raw_date, "%d/%m/%Y")
+        if date is not None and date < today:
             return date.strftime("%m/%d/%YZ")
 
 
-def convert_vaccines(date_dose_1, date_dose_2, batch_dose_1, batch_dose_2):
+def convert_vaccines(date_dose_1, date_dose_2, batch_dose_1, batch_dose_2,
+                     date_converter=convert_date):
     vaccines = {}
     if date_dose_1:
         vaccines[0] = {
-            "date": convert_date(date_dose_1),
+            "date": date_converter(date_dose_1),
             "batch": batch_dose_1
         }
     if date_dose_2 and date_dose_2 != date_dose_1:
         vaccines[1] = {
-            "date": convert_date(date_dose_2),
+            "date": date_converter(date_dose_2),
             "batch": batch_dose_2
         }
     if not vaccines:
@@ -195,13 +212,13 @@ def convert_test(serological_igg, serological_igm, serological_iga, pcr):
         return "Serological test"
 
 
-def convert_events(date_confirmed, date_symptoms, serological_igg, serological_igm, serological_iga, pcr, hospitalized, date_hospitalized, icu, date_icu_entry, date_icu_discharge, outcome, date_outcome):
+def convert_events(date_confirmed, date_symptoms, serological_igg, serological_igm, serological_iga, pcr, hospitalized, date_hospitalized, icu, date_icu_entry, date_icu_discharge, outcome, date_outcome, date_converter=convert_date):
     events = [
         {
             "name": "confirmed",
             "dateRange": {
-                "start": convert_date(date_confirmed),
-                "end": convert_date(date_confirmed)
+                "start": date_converter(date_confirmed),
+                "end": date_converter(date_confirmed)
             },
             "value": convert_test(serological_igg, serological_igm, serological_iga, pcr)
         }
@@ -211,8 +228,8 @@ def convert_events(date_confirmed, date_symptoms, serological_igg, serological_i
             {
                 "name": "onsetSymptoms",
                 "dateRange": {
-                    "start": convert_date(date_symptoms),
-                    "end": convert_date(date_symptoms)
+                    "start": date_converter(date_symptoms),
+                    "end": date_converter(date_symptoms)
                 },
             }
         )
@@ -222,8 +239,8 @@ def convert_events(date_confirmed, date_symptoms, serological_igg, serological_i
                 "name": "hospitalAdmission",
                 "value": "Yes",
                 "dateRange": {
-                    "start": convert_date(date_hospitalized),
-                    "end": convert_date(date_hospitalized)
+                    "start": date_converter(date_hospitalized),
+                    "end": date_converter(date_hospitalized)
                 }
             }
         )
@@ -240,8 +257,8 @@ def convert_events(date_confirmed, date_symptoms, serological_igg, serological_i
                 "name": "icuAdmission",
                 "value": "Yes",
                 "dateRange": {
-                    "start": convert_date(date_icu_entry),
-                    "end": convert_date(date_icu_discharge)
+                    "start": date_converter(date_icu_entry),
+                    "end": date_converter(date_icu_discharge)
                 }
             }
         )
@@ -258,8 +275,8 @@ def convert_events(date_confirmed, date_symptoms, serological_igg, serological_i
                 "name": "outcome",
                 "value": "Recovered",
                 "dateRange": {
-                    "start": convert_date(date_outcome),
-                    "end": convert_date(date_outcome)
+                    "start": date_converter(date_outcome),
+                    "end": date_converter(date_outcome)
                 }
             }
         )
@@ -270,8 +287,8 @@ def convert_events(date_confirmed, date_symptoms, serological_igg, serological_i
                 "name": "outcome",
                 "value": "Death",
                 "dateRange": {
-                    "start": convert_date(date_outcome),
-                    "end": convert_date(date_outcome)
+                    "start": date_converter(date_outcome),
+                    "end": date_converter(date_outcome)
                 }
             }
         )
@@ -379,7 +396,7 @@ def convert_ethnicity(ethnicity: str):
         return "Indigenous"
 
 
-def convert_travel(travel_yn, travel_country, travel_out, travel_in):
+def convert_travel(travel_yn, travel_country, travel_out, travel_in, date_converter=convert_date):
     '''
     International travel within 14 days before symptoms appeared is recorded.
     '''
@@ -390,7 +407,7 @@ def convert_travel(travel_yn, travel_country, travel_out, travel_in):
         travel_countries.append({"location": parsing_lib.geocode_country(country_ISO2)})
         travel["traveledPrior30Days"] = True
         travel["travel"] = travel_countries
-        travel["dateRange"] = {"start": convert_date(travel_out), "end": convert_date(travel_in)}
+        travel["dateRange"] = {"start": date_converter(travel_out), "end": date_converter(travel_in)}
         if travel:
             return travel
 
@@ -406,84 +423,65 @@ def convert_notes(outcome):
 def parse_cases(raw_data_file: str, source_id: str, source_url: str):
     """
     Parses G.h-format case data from raw API data.
+
+    The file is read a chunk of columns at a time, see
+    parsing_lib.read_csv_columns, and each distinct date, location,
+    combination of demographics, symptoms or comorbidities is only converted
+    once.
     """
-    with open(raw_data_file, "r") as f:
-        reader = csv.DictReader(f, delimiter=";")
-        for row in reader:
-            confirmation_date = convert_date(row[_DATE_CONFIRMED])
-            if confirmation_date is not None and row[_COVID_CONFIRMED] == "5":
-                try:
-                    case = {
-                        "caseReference": {"sourceId": source_id, "sourceUrl": source_url},
-                        "location": convert_location(row[_STATE], row[_MUNICIPALITY]),
-                        "events": convert_events(
-                            row[_DATE_CONFIRMED],
-                            row[_DATE_SYMPTOMS],
-                            row[_SEROLOGICAL_TEST_IGG],
-                            row[_SEROLOGICAL_TEST_IGM],
-                            row[_SEROLOGICAL_TEST_IGA],
-                            row[_PCR_TEST],
-                            row[_HOSPITALIZED],
-                            row[_DATE_HOSP],
-                            row[_ICU],
-                            row[_ICU_ENTRY],
-                            row[_ICU_DISCHARGE],
-                            row[_OUTCOME],
-                            row[_DATE_OUTCOME]
-                        ),
-                        "symptoms": convert_symptoms(
-                            row[_TASTE],
-                            row[_SMELL],
-                            row[_SORE_THROAT],
-                            row[_DYSPNEA],
-                            row[_FEVER],
-                            row[_COUGH],
-                            row[_BREATHING_DIFFICULTY],
-                            row[_LOW_OXYGEN],
-                            row[_DIARRHOEA],
-                            row[_VOMITING],
-                            row[_STOMACH_ACHE],
-                            row[_FATIGUE],
-                        ),
-                        "demographics": convert_demographics(
-                            row[_GENDER], row[_AGE], row[_AGE_TYPE], row[_ETHNICITY]
-                        ),
-                        "preexistingConditions": convert_preexisting_conditions(
-                            row[_DIABETES],
-                            row[_PREGNANCY],
-                            row[_KIDNEY],
-                            row[_HEART],
-                            row[_OBESITY],
-                            row[_DOWN_SYND],
-                            row[_LIVER],
-                            row[_ASTHMA],
-                            row[_NEUROLOGIC],
-                            row[_LUNG],
-                            row[_OTHER_COMORB]
-                        ),
-                        "travelHistory": convert_travel(
-                            row[_TRAVEL_YN],
-                            row[_TRAVEL_COUNTRY],
-                            row[_TRAVEL_OUT],
-                            row[_TRAVEL_RETURN]
-                        )
-                    }
-                    notes = convert_notes(
-                        row[_OUTCOME]
-                    )
-                    if vaccines := convert_vaccines(
-                            row[_DATE_DOSE_1],
-                            row[_DATE_DOSE_2],
-                            row[_BATCH_DOSE_1],
-                            row[_BATCH_DOSE_2]
-                    ):
-                        case["vaccines"] = vaccines
-                    if notes:
-                        case["restrictedNotes"] = notes
-                    yield case
-                except ValueError as ve:
-                    raise ValueError(f"error converting case: {ve}")
+    dates = {}
+    locations, demographics, symptoms = {}, {}, {}
+
+    def convert_cached_date(raw_date):
+        if raw_date not in dates:
+            dates[raw_date] = convert_date(raw_date)
+        return dates[raw_date]
+
+    for columns in parsing_lib.read_csv_columns(raw_data_file, _COLUMNS, delimiter=";"):
+        confirmation_dates = parsing_lib.map_column(
+            convert_date, columns[_DATE_CONFIRMED], cache=dates)
+        kept = [i for i, (date, classification) in enumerate(
+                    zip(confirmation_dates, columns[_COVID_CONFIRMED]))
+                if date is not None and classification == "5"]
+        if not kept:
+            continue
+        col = {name: [values[i] for i in kept] for name, values in columns.items()}
+        try:
+            case_locations = parsing_lib.map_column(
+                convert_location, col[_STATE], col[_MUNICIPALITY], cache=locations)
+            case_demographics = parsing_lib.map_column(
+                convert_demographics, col[_GENDER], col[_AGE], col[_AGE_TYPE], col[_ETHNICITY],
+                cache=demographics)
+            case_symptoms = parsing_lib.map_column(
+                convert_symptoms, *(col[c] for c in _SYMPTOM_COLUMNS), cache=symptoms)
+            case_conditions = parsing_lib.map_column(
+                convert_preexisting_conditions, *(col[c] for c in _COMORBIDITY_COLUMNS))
+            case_notes = parsing_lib.map_column(convert_notes, col[_OUTCOME])
+            for i, location in enumerate(case_locations):
+                case = {
+                    "caseReference": {"sourceId": source_id, "sourceUrl": source_url},
+                    # prepare_cases modifies the location of each case
+                    "location": {**location, "geometry": dict(location["geometry"])},
+                    "events": convert_events(
+                        *(col[c][i] for c in _EVENT_COLUMNS),
+                        date_converter=convert_cached_date),
+                    "symptoms": case_symptoms[i],
+                    "demographics": case_demographics[i],
+                    "preexistingConditions": case_conditions[i],
+                    "travelHistory": convert_travel(
+                        *(col[c][i] for c in _TRAVEL_COLUMNS),
+                        date_converter=convert_cached_date)
+                }
+                if vaccines := convert_vaccines(
+                        *(col[c][i] for c in _VACCINE_COLUMNS),
+                        date_converter=convert_cached_date):
+                    case["vaccines"] = vaccines
+                if case_notes[i]:
+                    case["restrictedNotes"] = case_notes[i]
+                yield case
+        except ValueError as ve:
+            raise ValueError(f"error converting case: {ve}")
 
 
 def event_handler(event):
-    return parsing_lib.run(event, parse_cases)
+    return parsing_lib.run(event, parse_cases, row_independent=True)
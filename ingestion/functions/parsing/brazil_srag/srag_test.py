@@ -1,6 +1,8 @@
 import os
 import unittest
 
+from unittest.mock import patch
+
 from brazil_srag import srag
 
 _SOURCE_ID = "abc123"
@@ -201,3 +203,16 @@ class BrazilSRAGTest(unittest.TestCase):
 
         result = srag.parse_cases(sample_data_file, _SOURCE_ID, _SOURCE_URL)
         self.assertCountEqual(list(result), _EXPECTED)
+
+    def test_parse_in_chunks(self):
+        current_dir = os.path.dirname(__file__)
+        sample_data_file = os.path.join(current_dir, "sample_data.csv")
+        read_csv_columns = srag.parsing_lib.read_csv_columns
+
+        def read_row_by_row(*args, **kwargs):
+            return read_csv_columns(*args, chunk_rows=1, **kwargs)
+        with patch.object(srag.parsing_lib, "read_csv_columns", read_row_by_row):
+            result = list(srag.parse_cases(sample_data_file, _SOURCE_ID, _SOURCE_URL))
+        self.assertCountEqual(result, _EXPECTED)
+        # locations are modified by parsing_lib.prepare_cases, so not shared
+        self.assertIsNot(result[0]["location"], result[1]["location"])
@@ -48,7 +48,7 @@ def convert_location(health_region, province, country):
 
 # dd-mm-yyyy -> %m/%d/%Y
 def convert_date(raw):
-    return datetime.strftime(datetime.strptime(raw, "%d-%m-%Y"), "%m/%d/%Y")
+    return datetime.strftime(parsing_lib.parse_date(raw, "%d-%m-%Y"), "%m/%d/%Y")
 
 def additional_sources(case_source, additional_source):
     def parse(source):
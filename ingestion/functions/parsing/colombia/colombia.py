@@ -1,6 +1,5 @@
 import os
 import sys
-from datetime import datetime
 import csv
 import json
 import common.ingestion_logging as logging
@@ -35,7 +34,7 @@ def convert_date(raw_date: str, dataserver=True):
 
     Set dataserver to False in order to return version appropriate for notes.
     """
-    date = datetime.strptime(raw_date.split(' ')[0], "%Y-%m-%d")
+    date = parsing_lib.parse_date(raw_date.split(' ')[0], "%Y-%m-%d")
     if not dataserver:
         return date.strftime("%m/%d/%Y")
     return date.strftime("%m/%d/%YZ")
@@ -311,7 +310,7 @@ def parse_cases(raw_data_file, source_id, source_url):
 
 
 def event_handler(event):
-    return parsing_lib.run(event, parse_cases)
+    return parsing_lib.run(event, parse_cases, row_independent=True)
 
 if __name__ == "__main__":
     with open('input_event.json') as f:
@@ -2,7 +2,6 @@ import os
 import sys
 import csv
 import copy
-from datetime import datetime
 import json
 from pathlib import Path
 import common.ingestion_logging as logging
@@ -84,7 +83,7 @@ def convert_date(raw_date, dataserver=True):
     Dates are listed in YYYY/mm/dd format
     """
     try:
-        date = datetime.strptime(raw_date, "%Y/%m/%d")
+        date = parsing_lib.parse_date(raw_date, "%Y/%m/%d")
         if not dataserver:
             return date.strftime("%m/%d/%Y")
         return date.strftime("%m/%d/%YZ")
@@ -1,6 +1,5 @@
 import os
 import sys
-from datetime import datetime
 import csv
 import json
 import common.ingestion_logging as logging
@@ -30,7 +29,7 @@ def convert_date(raw_date: str, dataserver=True):
     Set dataserver to False in order to return version appropriate for notes.
     """
     try:
-        date = datetime.strptime(raw_date, "%Y-%m-%d")
+        date = parsing_lib.parse_date(raw_date, "%Y-%m-%d")
     except BaseException:
         return None
     if not dataserver:
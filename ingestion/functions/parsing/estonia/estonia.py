@@ -1,7 +1,6 @@
 import json
 import os
 import sys
-from datetime import datetime
 import csv
 
 # Layer code, like parsing_lib, is added to the path by AWS.
@@ -35,7 +34,7 @@ def convert_date(raw_date):
     The date is listed in YYYY-mm-dd HH:MM:SS format (i.e.: 2020-03-06 18:44:00), but the date filtering API
     expects mm/dd/YYYYZ format.
     """
-    date = datetime.strptime(raw_date, "%Y-%m-%d %H:%M:%S")
+    date = parsing_lib.parse_date(raw_date, "%Y-%m-%d %H:%M:%S")
     return date.strftime("%m/%d/%YZ")
 
 
@@ -1,6 +1,5 @@
 import os
 import sys
-from datetime import datetime
 import csv
 import json
 import common.ingestion_logging as logging
@@ -45,7 +44,7 @@ def convert_date(raw_date):
     """
     Convert raw date field into a value interpretable by the dataserver.
     """
-    date = datetime.strptime(raw_date.split(" ")[0], "%Y/%m/%d")
+    date = parsing_lib.parse_date(raw_date.split(" ")[0], "%Y/%m/%d")
     return date.strftime("%m/%d/%YZ")
 
 
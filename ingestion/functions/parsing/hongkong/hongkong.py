@@ -1,7 +1,6 @@
 import json
 import os
 import sys
-from datetime import datetime
 import csv
 import common.ingestion_logging as logging
 
@@ -54,7 +53,7 @@ def convert_date(raw_date: str):
     formatYear = "%Y"
     if len(year) == 2:
         formatYear = "%y"
-    date = datetime.strptime(raw_date, f"%d/%m/{formatYear}")
+    date = parsing_lib.parse_date(raw_date, f"%d/%m/{formatYear}")
     return date.strftime("%m/%d/%YZ")
 
 
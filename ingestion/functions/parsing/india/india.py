@@ -3,7 +3,6 @@ import csv
 import json
 import os
 import sys
-from datetime import datetime
 
 # Layer code, like parsing_lib, is added to the path by AWS.
 # To test locally (e.g. via pytest), we have to modify sys.path.
@@ -26,7 +25,7 @@ def convert_date(raw_date):
     The date is listed in dd/mm/YYYY format, but the data server API will
     assume that ambiguous cases (e.g. "05/06/2020") are in mm/dd/YYYY format.
     """
-    date = datetime.strptime(raw_date, "%d/%m/%Y")
+    date = parsing_lib.parse_date(raw_date, "%d/%m/%Y")
     return date.strftime("%m/%d/%YZ")
 
 
@@ -1,7 +1,6 @@
 import json
 import os
 import sys
-from datetime import datetime
 from typing import Dict
 
 
@@ -65,7 +64,7 @@ def convert_date(raw_date: Dict):
 ​
     The date filtering API expects mm/dd/YYYYZ format.
     """
-    date = datetime.strptime(raw_date["dateAnnounced"], "%Y-%m-%d")
+    date = parsing_lib.parse_date(raw_date["dateAnnounced"], "%Y-%m-%d")
     return date.strftime("%m/%d/%YZ")
 
 
@@ -86,7 +85,7 @@ def convert_additional_sources(additional_source_url: Dict):
 def convert_outcome(raw_outcome: Dict, raw_death_date: Dict):
     if "patientStatus" in raw_outcome:
         if raw_outcome["patientStatus"] == "Deceased":
-            death_date = datetime.strptime(
+            death_date = parsing_lib.parse_date(
                 raw_death_date["deceasedDate"], "%Y-%m-%d")
             return {"name": "outcome",
                     "dateRange": {
@@ -1,6 +1,5 @@
 import os
 import sys
-from datetime import datetime
 import csv
 import json
 import common.ingestion_logging as logging
@@ -67,7 +66,7 @@ def convert_date(raw_date):
     """
     Convert raw date field into a value interpretable by the dataserver.
     """
-    date = datetime.strptime(raw_date, "%Y-%m-%d")
+    date = parsing_lib.parse_date(raw_date, "%Y-%m-%d")
     return date.strftime("%m/%d/%YZ")
 
 
@@ -250,7 +249,7 @@ def parse_cases(raw_data_file: str, source_id: str, source_url: str):
 
 
 def event_handler(event):
-    return parsing_lib.run(event, parse_cases)
+    return parsing_lib.run(event, parse_cases, row_independent=True)
 
 
 if __name__ == "__main__":
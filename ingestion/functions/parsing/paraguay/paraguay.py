@@ -1,7 +1,6 @@
 import json
 import os
 import sys
-from datetime import datetime
 import csv
 
 # Layer code, like parsing_lib, is added to the path by AWS.
@@ -32,7 +31,7 @@ def convert_date(raw_date):
     """
     # Some date fields are empty
     try:
-        date = datetime.strptime(raw_date, "%d/%m/%Y")
+        date = parsing_lib.parse_date(raw_date, "%d/%m/%Y")
         return date.strftime("%m/%d/%YZ")
     except:
         return None
@@ -1,6 +1,5 @@
 import os
 import sys
-from datetime import datetime
 import csv
 import json
 import common.ingestion_logging as logging
@@ -41,7 +40,7 @@ def convert_date(raw_date: str):
     The date is listed in YYYYmmdd format, but the data server API will
     assume that ambiguous cases (e.g. "05/06/2020") are in mm/dd/YYYY format.
     """
-    date = datetime.strptime(raw_date, "%Y%m%d")
+    date = parsing_lib.parse_date(raw_date, "%Y%m%d")
     return date.strftime("%m/%d/%YZ")
 
 
@@ -1,7 +1,6 @@
 import json
 import os
 import sys
-import datetime
 import csv
 
 # Layer code, like parsing_lib, is added to the path by AWS.
@@ -21,7 +20,7 @@ def convert_date(raw_date: str, dataserver=True):
     Convert raw date field into a value interpretable by the dataserver.
     The date is listed in mddyy format,
     """
-    date = datetime.datetime.strptime(raw_date, "%m/%d/%y")
+    date = parsing_lib.parse_date(raw_date, "%m/%d/%y")
     if not dataserver:
         return date.strftime("%m/%d/%Y")
     return date.strftime("%m/%d/%YZ")
@@ -57,7 +56,7 @@ def convert_location(entry):
 def convert_demographics(entry):
     ''' Calculating age by subtracting birth year field from confirmed date'''
     demo = {}
-    date = datetime.datetime.strptime(entry["confirmed_date"], "%m/%d/%y")
+    date = parsing_lib.parse_date(entry["confirmed_date"], "%m/%d/%y")
     if entry['birth_year']:
         demo["ageRange"] = {
             "start": float(date.year - float(entry['birth_year']) - 1),
@@ -1,7 +1,7 @@
 import json
 import os
 import sys
-from datetime import date, datetime
+from datetime import date
 import csv
 
 # Layer code, like parsing_lib, is added to the path by AWS.
@@ -57,7 +57,7 @@ def convert_date(raw_date):
     """
     Convert raw date field into a value interpretable by the dataserver.
     """
-    date = datetime.strptime(raw_date, "%d/%m/%Y")
+    date = parsing_lib.parse_date(raw_date, "%d/%m/%Y")
     return date.strftime("%m/%d/%YZ")
 
 
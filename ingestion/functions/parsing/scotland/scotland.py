@@ -1,7 +1,6 @@
 import json
 import os
 import sys
-from datetime import datetime
 import csv
 
 # Layer code, like parsing_lib, is added to the path by AWS.
@@ -23,7 +22,7 @@ def convert_date(raw_date: str, dataserver=True):
     Convert raw date field into a value interpretable by the dataserver.
     The date is listed in mddyy format,
     """
-    date = datetime.strptime(raw_date, "%Y%m%d")
+    date = parsing_lib.parse_date(raw_date, "%Y%m%d")
     if not dataserver:
         return date.strftime("%m/%d/%Y")
     return date.strftime("%m/%d/%YZ")
@@ -1,7 +1,6 @@
 import json
 import os
 import sys
-from datetime import datetime
 import csv
 import pycountry
 
@@ -45,7 +44,7 @@ def convert_date(raw_date):
     Convert raw date field into a value interpretable by the dataserver.
     """
     try:
-        date = datetime.strptime(raw_date, "%Y-%m-%d")
+        date = parsing_lib.parse_date(raw_date, "%Y-%m-%d")
         return date.strftime("%m/%d/%YZ")
     except:
         return None
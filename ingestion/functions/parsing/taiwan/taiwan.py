@@ -2,7 +2,6 @@ import os
 import sys
 import csv
 import json
-from datetime import datetime
 from pathlib import Path
 import common.ingestion_logging as logging
 
@@ -42,7 +41,7 @@ def convert_date(raw_date):
 
     Date filtering API expects mm/dd/YYYYZ format.
     """
-    date = datetime.strptime(raw_date, "%Y/%m/%d")
+    date = parsing_lib.parse_date(raw_date, "%Y/%m/%d")
     return date.strftime("%m/%d/%YZ")
 
 
@@ -1,7 +1,6 @@
 import json
 import os
 import sys
-from datetime import datetime
 
 # Layer code, like parsing_lib, is added to the path by AWS.
 # To test locally (e.g. via pytest), we have to modify sys.path.
@@ -28,7 +27,7 @@ def convert_date(raw_date):
     The date is listed in YYYY-mm-dd HH:MM:SS format, but the date filtering API
     expects mm/dd/YYYYZ format.
     """
-    date = datetime.strptime(raw_date, "%Y-%m-%d %H:%M:%S")
+    date = parsing_lib.parse_date(raw_date, "%Y-%m-%d %H:%M:%S")
     # Some cases are reported using the Buddhist calendar which is 543 years ahead of the Gregorian
     year = date.year
     if year > 2540:
@@ -1,6 +1,5 @@
 import os
 import sys
-from datetime import datetime
 import csv
 import json
 import copy
@@ -21,7 +20,7 @@ def convert_date(raw_date: str):
     """
     Convert raw date field into a value interpretable by the dataserver.
     """
-    date = datetime.strptime(raw_date, "%d/%m/%Y")
+    date = parsing_lib.parse_date(raw_date, "%d/%m/%Y")
     return date.strftime("%m/%d/%YZ")
 
 def convert_location(entry):
@@ -1,22 +1,38 @@
+import array
+import bz2
 import codecs
+import collections
+import concurrent.futures
+import contextlib
+import email.utils
+import gzip
+import hashlib
+import heapq
+import itertools
+import lzma
+import math
 import re
 import io
 import mimetypes
 import os
 import sys
 import tempfile
+import threading
+import urllib.parse
 import operator
-import subprocess
 import importlib
+import json
 import time
 import logging
+import zipfile
+import zlib
 import dateutil.parser
-from typing import Tuple, List, Dict
-from sys import platform
+from typing import Dict, List, Tuple
 from chardet import detect
 from pathlib import Path
 
 import boto3
+import botocore.exceptions
 import requests
 
 from datetime import datetime, timezone, timedelta
@@ -31,11 +47,48 @@ SOURCE_ID_FIELD = "sourceId"
 PARSING_DATE_RANGE_FIELD = "parsingDateRange"
 TIME_FILEPART_FORMAT = "/%Y/%m/%d/%H%M/"
 DEFAULT_ENCODING = 'utf-8'
-READ_CHUNK_BYTES = 2048
+# Content held back to detect its encoding before transcoding the rest, and
+# size of the sample across it on which chardet runs if need be
+DETECT_ENCODING_BYTES = 2 << 20
+DETECT_SAMPLE_BYTES = 128 * 1024
+DETECT_SAMPLE_CHUNKS = 16
+BYTE_ORDER_MARKS = [
+    (codecs.BOM_UTF32_LE, "utf-32"), (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"), (codecs.BOM_UTF16_BE, "utf-16"),
+]
+# What is remembered about the last retrieval of each source, in OUTPUT_BUCKET
+RETRIEVAL_STATE_FILENAME = "retrieval_state.json"
+# Content of sources that accept range requests is downloaded in parts of
+# DOWNLOAD_PART_BYTES over DOWNLOAD_CONNECTIONS connections, if there are
+# several parts.
+DOWNLOAD_CONNECTIONS = int(os.environ.get("EPID_INGESTION_DOWNLOAD_CONNECTIONS", 4))
+DOWNLOAD_PART_BYTES = int(os.environ.get("EPID_INGESTION_DOWNLOAD_PART_BYTES", 16 * 1024 ** 2))
+# Skip ingestions of content identical to that of the last successful one
+SKIP_UNCHANGED = os.environ.get("EPID_INGESTION_SKIP_UNCHANGED", "true").lower() == "true"
+# Sources ingested at a time by a job retrieving several (EPID_INGESTION_SOURCE_IDS),
+# and how many of them may download from the same host at a time
+SOURCE_WORKERS = int(os.environ.get("EPID_INGESTION_SOURCE_WORKERS", 4))
+SOURCES_PER_HOST = int(os.environ.get("EPID_INGESTION_SOURCES_PER_HOST", 2))
 HEADER_CHUNK_BYTES = 1024 * 1024
 CSV_CHUNK_BYTES = 2 * 1024 * 1024
 IN_PROGRESS_STATUS = ['SUBMITTED', 'PENDING', 'RUNNABLE', 'STARTING', 'RUNNING']
 
+# Memory available to compute deltas. Files that would not fit are split
+# into partitions on disk, see write_deltas.
+DELTAS_MEMORY_BYTES = int(os.environ.get("EPID_INGESTION_DELTAS_MEMORY_BYTES", 1024 ** 3))
+# Estimated memory used per row besides its content
+DELTAS_ROW_OVERHEAD_BYTES = 150
+
+# Row index uploaded next to each CSV source file, see RowIndex.
+ROW_INDEX_FILENAME = "content.rowindex"
+ROW_INDEX_MAGIC = b"GDHROWINDEX1\n"
+# Rows removed from the previous file are fetched with ranged GETs, merging
+# rows less than DELTAS_RANGE_GAP_BYTES apart. If more GETs than
+# DELTAS_MAX_RANGE_REQUESTS would be needed, the file is downloaded in full.
+DELTAS_RANGE_GAP_BYTES = int(os.environ.get("EPID_INGESTION_DELTAS_RANGE_GAP_BYTES", 1024 ** 2))
+DELTAS_MAX_RANGE_REQUESTS = int(os.environ.get("EPID_INGESTION_DELTAS_MAX_RANGE_REQUESTS", 256))
+
 s3_client = boto3.client("s3")
 
 if os.environ.get("DOCKERIZED"):
@@ -82,8 +135,8 @@ def get_source_details(env, source_id, upload_id, api_headers, cookies):
     try:
         source_api_endpoint = f"{common_lib.get_source_api_url(env)}/sources/{source_id}"
         logging.info(f"Requesting source configuration from {source_api_endpoint}")
-        r = requests.get(source_api_endpoint,
-                         headers=api_headers, cookies=cookies)
+        r = common_lib.get_session().get(source_api_endpoint,
+                                         headers=api_headers, cookies=cookies)
         if r and r.status_code == 200:
             api_json = r.json()
             logging.info(f"Received source API response: {api_json}")
@@ -108,87 +161,464 @@ def get_source_details(env, source_id, upload_id, api_headers, cookies):
             api_headers, cookies)
 
 
+def decodes(sample: bytes, encoding: str) -> bool:
+    """Is sample, the start of some content, valid in encoding?"""
+    try:
+        codecs.getincrementaldecoder(encoding)().decode(sample)
+        return True
+    except (UnicodeDecodeError, LookupError):
+        return False
+
+
+def stride_sample(data: bytes, sample_bytes: int = DETECT_SAMPLE_BYTES,
+                  chunks: int = DETECT_SAMPLE_CHUNKS) -> bytes:
+    """Returns chunks taken at regular intervals across data, starting at lines."""
+    if len(data) <= sample_bytes:
+        return data
+    chunk_bytes = sample_bytes // chunks
+    sample = []
+    for i in range(chunks):
+        start = i * (len(data) - chunk_bytes) // (chunks - 1)
+        if i > 0:
+            start = data.find(b"\n", start, start + chunk_bytes) + 1 or start
+        sample.append(data[start:start + chunk_bytes])
+    return b"".join(sample)
+
+
+def detect_encoding(sample: bytes, cached_encoding: str | None = None) -> str:
+    """
+    Returns the presumable encoding of content starting with sample.
+
+    chardet is slow, so it only runs on a stride_sample, and only if the
+    content has no byte order mark, is not valid UTF-8 (without null bytes,
+    which are more likely UTF-16), and is not valid in cached_encoding, the
+    encoding last detected for the same source.
+    """
+    logger.info("Detecting encoding of retrieved content")
+    for bom, encoding in BYTE_ORDER_MARKS:
+        if sample.startswith(bom):
+            logger.info(f"Source encoding is {encoding} (byte order mark)")
+            return encoding
+    if b"\x00" not in sample and decodes(sample, "utf-8"):
+        logger.info("Source encoding is presumably utf-8 (valid UTF-8)")
+        return "utf-8"
+    if cached_encoding and decodes(sample, cached_encoding):
+        logger.info(f"Source encoding is presumably {cached_encoding} (as last retrieval)")
+        return cached_encoding
+    detected_enc = detect(stride_sample(sample))
+    if detected_enc["encoding"]:
+        logger.info(f"Source encoding is presumably {detected_enc}")
+        return detected_enc["encoding"]
+    logger.warning(f"Source encoding detection failed, setting to {DEFAULT_ENCODING}")
+    return DEFAULT_ENCODING
+
+
+def load_retrieval_state(s3_bucket: str, source_id: str) -> dict:
+    """Returns what was saved about the last retrieval of a source, if anything."""
+    try:
+        obj = s3_client.get_object(
+            Bucket=s3_bucket, Key=f"{source_id}/{RETRIEVAL_STATE_FILENAME}")
+        return json.load(obj["Body"])
+    except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError,
+            ValueError) as e:
+        logger.info(f"No retrieval state for source {source_id}: {e}")
+        return {}
+
+
+def save_retrieval_state(s3_bucket: str, source_id: str, state: dict):
+    """Saves state for the next retrieval of a source, logging rather than raising errors."""
+    try:
+        s3_client.put_object(Bucket=s3_bucket, Key=f"{source_id}/{RETRIEVAL_STATE_FILENAME}",
+                             Body=json.dumps(state).encode())
+    except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as e:
+        logger.warning(f"Could not save retrieval state for source {source_id}: {e}")
+
+
+def parser_version(parser_module: str) -> str:
+    """
+    Returns a digest of the files in the directory of a parser module and in
+    the common directory, which changes whenever a new version of the parser
+    or of the code it shares with others is deployed.
+    """
+    functions_dir = Path(__file__).parent.parent  # ingestion/functions
+    digest = hashlib.sha256()
+    for directory in [functions_dir.joinpath(*parser_module.split(".")).parent,
+                      functions_dir / "common"]:
+        if not directory.is_dir():
+            continue
+        for path in sorted(directory.iterdir()):
+            if path.is_file():
+                digest.update(path.name.encode())
+                digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+class SourceUnchanged(Exception):
+    """The content of a source is the same as at its last successful retrieval."""
+
+
+class RawSink:
+    """
+    Writes retrieved content to a binary file as is.
+
+    Also keeps the SHA-256 of the content, and the validators (ETag,
+    Last-Modified, Content-Length) of the response it came from.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.received = 0
+        self.sha256 = hashlib.sha256()
+        self.validators = {}
+
+    def write(self, chunk: bytes):
+        self.received += len(chunk)
+        self.sha256.update(chunk)
+        self._write(chunk)
+
+    def _write(self, chunk: bytes):
+        self.file.write(chunk)
+
+    def finish(self):
+        """Writes anything held back, once all the content has been received."""
+        self.file.flush()
+
+
+class Utf8Sink(RawSink):
+    """
+    Writes retrieved content to a binary file, transcoded to UTF-8.
+
+    Unless given, the encoding is detected from the first detect_bytes of
+    content, which are held back until then, see detect_encoding. Content is
+    then decoded incrementally as it arrives. Content in ASCII or UTF-8 is
+    only validated as UTF-8, and written as is.
+    """
+
+    def __init__(self, file, detect_bytes: int = DETECT_ENCODING_BYTES,
+                 encoding: str | None = None, cached_encoding: str | None = None):
+        super().__init__(file)
+        self.detect_bytes = detect_bytes
+        self.encoding = encoding
+        self.cached_encoding = cached_encoding
+        self._head = bytearray()
+        self._decoder = None
+        self._passthrough = False
+
+    def _write(self, chunk: bytes):
+        if self._decoder is None:
+            self._head += chunk
+            if len(self._head) < self.detect_bytes and self.encoding is None:
+                return
+            chunk = self._start()
+        self._write_decoded(chunk)
+
+    def _start(self) -> bytes:
+        head, self._head = bytes(self._head), bytearray()
+        if self.encoding is None:
+            self.encoding = detect_encoding(head, self.cached_encoding)
+        if codecs.lookup(self.encoding).name == "ascii":
+            # later content may not be ASCII, but UTF-8 is a superset of it
+            self.encoding = "utf-8"
+        self._decoder = codecs.getincrementaldecoder(self.encoding)()
+        self._passthrough = codecs.lookup(self.encoding).name == "utf-8"
+        return head
+
+    def _write_decoded(self, chunk: bytes, final: bool = False):
+        text = self._decoder.decode(chunk, final)
+        self.file.write(chunk if self._passthrough else text.encode("utf-8"))
+
+    def finish(self):
+        if self._decoder is None:
+            self._write_decoded(self._start(), final=True)
+        else:
+            self._write_decoded(b"", final=True)
+        super().finish()
+
+
+# Decompressors of content compressed as the mimetypes module guesses from URLs
+DECOMPRESSORS = {
+    "gzip": lambda: zlib.decompressobj(wbits=zlib.MAX_WBITS | 16),
+    "bzip2": bz2.BZ2Decompressor,
+    "xz": lzma.LZMADecompressor,
+}
+COMPRESSION_MAGIC = {"gzip": b"\x1f\x8b", "bzip2": b"BZh", "xz": b"\xfd7zXZ\x00"}
+
+
+class DecompressingSink(RawSink):
+    """
+    Decompresses retrieved content into another sink as it arrives.
+
+    The SHA-256 and validators are those of the compressed content. Several
+    concatenated streams (as written by pigz or pbzip2) are all decompressed.
+    Content which is not compressed after all, for instance as the server
+    already decoded it, is passed on as is.
+    """
+
+    def __init__(self, sink: RawSink, compression: str):
+        super().__init__(sink.file)
+        self.sink = sink
+        self.compression = compression
+        self._decompressor = None
+        self._passthrough = False
+
+    @property
+    def encoding(self) -> str | None:
+        return getattr(self.sink, "encoding", None)
+
+    def _write(self, chunk: bytes):
+        if self._decompressor is None and not self._passthrough:
+            magic = COMPRESSION_MAGIC[self.compression]
+            if not chunk.startswith(magic[:len(chunk)]):
+                logger.warning(f"Content is not {self.compression} compressed, keeping it as is")
+                self._passthrough = True
+        if self._passthrough:
+            self.sink.write(chunk)
+            return
+        while chunk:
+            if self._decompressor is None or self._decompressor.eof:
+                self._decompressor = DECOMPRESSORS[self.compression]()
+            self.sink.write(self._decompressor.decompress(chunk))
+            chunk = self._decompressor.unused_data if self._decompressor.eof else b""
+
+    def finish(self):
+        if self._decompressor is not None and not self._decompressor.eof:
+            raise ValueError(f"Truncated {self.compression} content")
+        self.sink.finish()
+
+
+def largest_zip_member(zf: zipfile.ZipFile) -> zipfile.ZipInfo:
+    """Returns the largest file in a zip archive, as listed in its central directory."""
+    members = [member for member in zf.infolist() if not member.is_dir()]
+    if not members:
+        raise zipfile.BadZipFile("No files in zip archive")
+    return max(members, key=operator.attrgetter("file_size"))
+
+
 def raw_content(url: str, content: bytes, tempdir: str = TEMP_PATH) -> io.BytesIO:
     # Detect the mimetype of a given URL.
     logger.info(f"Guessing mimetype of {url}")
     mimetype, _ = mimetypes.guess_type(url)
     if mimetype == "application/zip":
         logger.info("File seems to be a zip file, decompressing it now")
-        # Writing the zip file to temp dir.
-        with tempfile.NamedTemporaryFile(dir=tempdir, delete=False) as f:
-            f.write(content)
-            f.flush()
-        with tempfile.TemporaryDirectory(dir=tempdir) as xf:
-            # extract into temporary folder using unzip
-            try:
-                subprocess.run(["/usr/bin/unzip", "-d", xf, f.name], check=True)
-                largest_file = max(
-                    ((f, f.stat().st_size) for f in Path(xf).iterdir()
-                     if f.is_file()),
-                    key=operator.itemgetter(1)
-                )[0]
-                return largest_file.open("rb")
-            except subprocess.CalledProcessError as e:
-                raise ValueError(f"Error in extracting zip file with exception:\n{e}")
-        Path(f.name).unlink(missing_ok=True)
+        try:
+            with zipfile.ZipFile(io.BytesIO(content)) as zf:
+                return io.BytesIO(zf.read(largest_zip_member(zf)))
+        except (zipfile.BadZipFile, zlib.error) as e:
+            raise ValueError(f"Error in extracting zip file with exception:\n{e}")
     elif not mimetype:
         logger.warning("Could not determine mimetype")
     return io.BytesIO(content)
 
 
-def raw_content_fileconvert(url: str, local_filename: str, tempdir: str = TEMP_PATH) -> str:
-    """Convert file to UTF-8 (and decompress) as needed
+def raw_content_fileconvert(url: str, local_filename: str, tempdir: str = TEMP_PATH,
+                            sink_class=RawSink, chunk_bytes: int = CSV_CHUNK_BYTES) -> str:
+    """Decompress file as needed
 
     Whereas raw_content takes a binary stream as input, this function takes a
-    a filename on the local system and returns another filename"""
+    a filename on the local system and returns another filename. The largest
+    member of a zip file is streamed through sink_class into a new file,
+    without extracting the others."""
     # Detect the mimetype of a given URL.
     logger.info(f"Guessing mimetype of {url}")
     mimetype, _ = mimetypes.guess_type(url)
     if mimetype == "application/zip":
         logger.info("File seems to be a zip file, decompressing it now")
-        xf = tempfile.mkdtemp(dir=tempdir)
-        # extract into temporary folder using unzip
         try:
-            subprocess.run(["/usr/bin/unzip", "-d", xf, local_filename], check=True)
-            largest_file = max(
-                ((f, f.stat().st_size) for f in Path(xf).iterdir()
-                 if f.is_file()),
-                key=operator.itemgetter(1)
-            )[0]
-            return '/'.join([xf, largest_file.name])
-        except subprocess.CalledProcessError as e:
+            with zipfile.ZipFile(local_filename) as zf:
+                member = largest_zip_member(zf)
+                logger.info(f"Extracting {member.filename} ({member.file_size} bytes)")
+                fd, outfile_name = tempfile.mkstemp(dir=tempdir)
+                with zf.open(member) as infile, os.fdopen(fd, "wb") as outfile:
+                    sink = sink_class(outfile)
+                    while chunk := infile.read(chunk_bytes):
+                        sink.write(chunk)
+                    sink.finish()
+        except (zipfile.BadZipFile, zlib.error) as e:
             raise ValueError(f"Error in extracting zip file with exception:\n{e}")
+        os.remove(local_filename)
+        return outfile_name
     elif not mimetype:
         logger.warning("Could not determine mimetype")
     return local_filename
 
 
-def download_file_stream(url: str, headers: dict, tempdir: str,
-                         reps: int = 5, sleeptime: float = 30.,
-                         chunk_bytes: int = CSV_CHUNK_BYTES) -> str:
-    """Download file as stream checking filesize and retrying (if able)"""
+def response_validators(etag: str | None, last_modified: str | None,
+                        content_length: int | None) -> dict:
+    """Returns the validators of a response that were given."""
+    validators = {"etag": etag, "lastModified": last_modified, "contentLength": content_length}
+    return {k: v for k, v in validators.items() if v is not None}
+
+
+def conditional_headers(validators: dict) -> dict:
+    """Returns the headers of a request for content changed since validators."""
+    headers = {}
+    if "etag" in validators:
+        headers["If-None-Match"] = validators["etag"]
+    if "lastModified" in validators:
+        headers["If-Modified-Since"] = validators["lastModified"]
+    return headers
+
+
+def download_s3_object(s3_bucket: str, s3_key: str, tempdir: str,
+                       chunk_bytes: int = CSV_CHUNK_BYTES, sink_class=RawSink,
+                       validators: dict | None = None) -> str:
+    """Download S3 object as stream into a new local file through sink_class
+
+    Raises SourceUnchanged if the object still has the ETag in validators."""
+    conditions = {"IfNoneMatch": validators["etag"]} if validators and "etag" in validators else {}
+    try:
+        obj = s3_client.get_object(Bucket=s3_bucket, Key=s3_key, **conditions)
+    except botocore.exceptions.ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("304", "NotModified"):
+            raise SourceUnchanged(f"s3://{s3_bucket}/{s3_key} not modified")
+        raise
+    fd, local_filename = tempfile.mkstemp(dir=tempdir)
+    with os.fdopen(fd, "wb") as f:
+        sink = sink_class(f)
+        sink.validators = response_validators(
+            obj.get("ETag"),
+            email.utils.format_datetime(obj["LastModified"], usegmt=True)
+            if obj.get("LastModified") else None,
+            obj.get("ContentLength"))
+        for chunk in obj["Body"].iter_chunks(chunk_bytes):
+            sink.write(chunk)
+        sink.finish()
+    return local_filename
+
+
+def accepts_ranges(response: requests.Response) -> bool:
+    """Can the content of response be downloaded in byte ranges?"""
+    return (response.headers.get("accept-ranges", "").lower() == "bytes"
+            and response.headers.get("content-encoding", "identity").lower() == "identity")
+
+
+def download_part(session: requests.Session, url: str, headers: dict, start: int, end: int,
+                  reps: int = 5, sleeptime: float = 30.,
+                  chunk_bytes: int = CSV_CHUNK_BYTES) -> bytes:
+    """
+    Downloads bytes start to end (excluded) of the content at url, resuming
+    from the last byte received if the connection is lost.
+    """
+    data = bytearray()
     for _ in range(reps):
-        # stream from source to avoid MemoryError for very large (>10Gb) files
-        fd, local_filename = tempfile.mkstemp(dir=tempdir)
-        with requests.get(url, headers=headers, stream=True) as r:
-            r.raise_for_status()
-            # check if filesize reported and validate download if possible
-            expected_size = int(r.headers["content-length"]
-                                if "content-length" in r.headers.keys() else 0)
-            logger.info(f"Starting file download, expected size: {expected_size}")
-            with os.fdopen(fd, 'wb') as f:
+        try:
+            range_headers = {**headers, "Range": f"bytes={start + len(data)}-{end - 1}"}
+            with session.get(url, headers=range_headers, stream=True) as r:
+                r.raise_for_status()
+                if r.status_code != 206:
+                    raise requests.exceptions.RequestException(
+                        f"Content of {url} changed during download", response=r)
                 for chunk in r.iter_content(chunk_size=chunk_bytes):
-                    if chunk:
-                        f.write(chunk)
-                f.flush()
-        # confirm download completed successfully
-        received_size = os.path.getsize(local_filename)
-        if expected_size == 0 or received_size >= expected_size:
-            return local_filename
-        logger.info(f"File download incomplete (expected {expected_size} got {received_size})")
-        logger.info(f"Sleeping for {sleeptime} secs...")
-        os.remove(local_filename)
+                    data += chunk
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError) as e:
+            logger.info(f"Connection lost downloading {url}: {e}")
+        if len(data) >= end - start:
+            return bytes(data[:end - start])
+        logger.info(f"Download of bytes {start}-{end - 1} incomplete (got {len(data)}), "
+                    f"resuming in {sleeptime} secs...")
         time.sleep(sleeptime)
+    raise requests.exceptions.RequestException(f"Download of bytes {start}-{end - 1} failed.")
+
+
+def download_parts(url: str, headers: dict, sink: RawSink, size: int,
+                   connections: int = DOWNLOAD_CONNECTIONS,
+                   part_bytes: int = DOWNLOAD_PART_BYTES, **kwargs):
+    """
+    Downloads the content at url of the given size into sink, in parts
+    fetched concurrently over several connections. Parts are written to sink
+    in order, with at most two parts per connection held in memory.
+    """
+    parts = iter(range(0, size, part_bytes))
+    with common_lib.new_session(pool_size=connections) as session, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=connections) as executor:
+
+        def submit(start):
+            return executor.submit(download_part, session, url, headers, start,
+                                   min(start + part_bytes, size), **kwargs)
+        in_flight = collections.deque(map(submit, itertools.islice(parts, 2 * connections)))
+        while in_flight:
+            sink.write(in_flight.popleft().result())
+            if (start := next(parts, None)) is not None:
+                in_flight.append(submit(start))
+
+
+def download_file_stream(url: str, headers: dict, tempdir: str,
+                         reps: int = 5, sleeptime: float = 30.,
+                         chunk_bytes: int = CSV_CHUNK_BYTES, sink_class=RawSink,
+                         validators: dict | None = None,
+                         connections: int = DOWNLOAD_CONNECTIONS,
+                         part_bytes: int = DOWNLOAD_PART_BYTES) -> str:
+    """Download file as stream checking filesize and retrying (if able)
+
+    Content is written to the returned file through sink_class, such as
+    Utf8Sink to transcode it as it downloads. If validators of the content
+    last downloaded are given, raises SourceUnchanged if the server replies
+    that it has not been modified since.
+
+    If the server accepts range requests, content larger than part_bytes is
+    downloaded in parts over several connections (see download_parts), and
+    incomplete downloads resume where they stopped rather than restart."""
+    fd, local_filename = tempfile.mkstemp(dir=tempdir)
+    with os.fdopen(fd, 'wb') as f:
+        sink, resumable, expected_size = None, False, 0
+        for _ in range(reps):
+            request_headers = {**headers, **conditional_headers(validators or {})}
+            if sink is not None and resumable:
+                # resume, unless the content changed since
+                request_headers = {**headers, "Range": f"bytes={sink.received}-"}
+                if if_range := sink.validators.get("etag", sink.validators.get("lastModified")):
+                    request_headers["If-Range"] = if_range
+            # stream from source to avoid MemoryError for very large (>10Gb) files
+            with requests.get(url, headers=request_headers, stream=True) as r:
+                if r.status_code == 304:
+                    os.remove(local_filename)
+                    raise SourceUnchanged(f"{url} not modified")
+                r.raise_for_status()
+                if r.status_code != 206:
+                    # check if filesize reported and validate download if possible
+                    expected_size = int(r.headers["content-length"]
+                                        if "content-length" in r.headers.keys() else 0)
+                    logger.info(f"Starting file download, expected size: {expected_size}")
+                    resumable = accepts_ranges(r)
+                    f.seek(0)
+                    f.truncate()
+                    sink = sink_class(f)
+                    sink.validators = response_validators(
+                        r.headers.get("etag"), r.headers.get("last-modified"),
+                        expected_size or None)
+                    if resumable and expected_size > part_bytes and connections > 1:
+                        r.close()
+                        logger.info(f"Downloading in parts over {connections} connections")
+                        if if_range := sink.validators.get(
+                                "etag", sink.validators.get("lastModified")):
+                            headers = {**headers, "If-Range": if_range}
+                        download_parts(url, headers, sink, expected_size, connections,
+                                       part_bytes, reps=reps, sleeptime=sleeptime,
+                                       chunk_bytes=chunk_bytes)
+                        sink.finish()
+                        return local_filename
+                else:
+                    logger.info(f"Resuming file download from byte {sink.received}")
+                try:
+                    for chunk in r.iter_content(chunk_size=chunk_bytes):
+                        if chunk:
+                            sink.write(chunk)
+                    complete = True
+                except (requests.exceptions.ConnectionError,
+                        requests.exceptions.ChunkedEncodingError) as e:
+                    logger.info(f"Connection lost: {e}")
+                    complete = False
+            # confirm download completed successfully
+            received_size = sink.received
+            if ((complete and expected_size == 0)
+                    or (expected_size and received_size >= expected_size)):
+                sink.finish()
+                return local_filename
+            logger.info(f"File download incomplete (expected {expected_size} got {received_size})")
+            logger.info(f"Sleeping for {sleeptime} secs...")
+            time.sleep(sleeptime)
+    os.remove(local_filename)
     raise requests.exceptions.RequestException("File download failed.")
 
 
@@ -201,17 +631,127 @@ def new_file_with_header(header):
     return file_name
 
 
-def sort_file_preserve_header(out_filename, in_filename):
-    '''Sort input file to output file, preserving the header'''
-    with open(in_filename, "r") as infile:
-        header = infile.readline()
-    with open(out_filename, "w") as outfile:
-        outfile.writelines(header)
-    with open(out_filename, "a") as outfile:
-        body = subprocess.Popen(('tail', '--lines', '+2', in_filename),
-                                stdout=subprocess.PIPE)
-        subprocess.run(('sort'), stdin=body.stdout, stdout=outfile)
-        body.wait()
+def read_rows(file_name: str, skip_header: bool = False) -> List[bytes]:
+    """Returns the lines of a file, without line breaks."""
+    with open(file_name, "rb") as f:
+        if skip_header:
+            f.readline()
+        rows = f.read().split(b"\n")
+    if rows[-1] == b"":
+        rows.pop()
+    return rows
+
+
+def diff_rows(early_file_name: str, later_file_name: str,
+              skip_header: bool) -> Tuple[List[bytes], List[bytes]]:
+    """
+    Returns the rows added to and removed from early_file_name in
+    later_file_name, in sorted order.
+
+    Rows are compared as a multiset, like comm does on sorted files: a row
+    appearing twice in the later file and once in the earlier one is added
+    once. Both files are held in memory.
+    """
+    early_rows = read_rows(early_file_name, skip_header)
+    later_rows = read_rows(later_file_name, skip_header)
+    early_set, later_set = set(early_rows), set(later_rows)
+    if len(early_set) == len(early_rows) and len(later_set) == len(later_rows):
+        added = list(later_set - early_set)
+        removed = list(early_set - later_set)
+    else:
+        early_counts = collections.Counter(early_rows)
+        later_counts = collections.Counter(later_rows)
+        added = list((later_counts - early_counts).elements())
+        removed = list((early_counts - later_counts).elements())
+    del early_rows, later_rows, early_set, later_set
+    added.sort()
+    removed.sort()
+    return added, removed
+
+
+def write_lines(f, rows: List[bytes]):
+    """Writes rows to a binary file, each followed by a line break."""
+    if rows:
+        f.write(b"\n".join(rows))
+        f.write(b"\n")
+
+
+def diff_files(early_file_name: str, later_file_name: str, skip_header: bool,
+               tempdir: str = None) -> Tuple[str, str]:
+    """
+    Writes the rows added to and removed from early_file_name in
+    later_file_name to two new files, in sorted order, and returns their
+    names, see diff_rows.
+    """
+    file_names = []
+    for rows in diff_rows(early_file_name, later_file_name, skip_header):
+        fd, file_name = tempfile.mkstemp(dir=tempdir)
+        with os.fdopen(fd, "wb") as f:
+            write_lines(f, rows)
+        file_names.append(file_name)
+    return file_names[0], file_names[1]
+
+
+def partition_rows(file_name: str, num_partitions: int, tempdir: str) -> List[str]:
+    """
+    Splits the rows of a file after its header into num_partitions files by
+    hash, so that equal rows of different files end up in the same partition.
+    """
+    file_names = [os.path.join(tempdir, f"{Path(file_name).name}.{i}")
+                  for i in range(num_partitions)]
+    partitions = [open(name, "wb") for name in file_names]
+    try:
+        with open(file_name, "rb") as f:
+            f.readline()
+            for line in f:
+                row = line[:-1] if line.endswith(b"\n") else line
+                partitions[hash(row) % num_partitions].write(row + b"\n")
+    finally:
+        for partition in partitions:
+            partition.close()
+    return file_names
+
+
+def write_deltas(early_file_name: str, later_file_name: str, add_file, del_file,
+                 memory_bytes: int = DELTAS_MEMORY_BYTES) -> Tuple[int, int]:
+    """
+    Writes the rows added and removed between two CSV files, after their
+    headers, to the add_file and del_file binary files, in sorted order.
+    Returns the number of rows added and removed.
+
+    If the rows of both files would not fit in memory_bytes, both files are
+    first partitioned on disk by row hash, and the partitions are compared
+    one at a time.
+    """
+    with open(early_file_name, "rb") as f:
+        head = f.read(HEADER_CHUNK_BYTES)
+    files_size = os.path.getsize(early_file_name) + os.path.getsize(later_file_name)
+    row_bytes = max(1, len(head) // max(1, head.count(b"\n")))
+    rows_memory = files_size + files_size // row_bytes * DELTAS_ROW_OVERHEAD_BYTES
+    num_partitions = math.ceil(rows_memory / max(1, memory_bytes))
+    if num_partitions <= 1:
+        added, removed = diff_rows(early_file_name, later_file_name, True)
+        write_lines(add_file, added)
+        write_lines(del_file, removed)
+        return len(added), len(removed)
+    logger.info(f"Deltas: comparing files in {num_partitions} partitions")
+    with tempfile.TemporaryDirectory() as tempdir:
+        pairs = zip(partition_rows(early_file_name, num_partitions, tempdir),
+                    partition_rows(later_file_name, num_partitions, tempdir))
+        diffs = [diff_files(early, later, False, tempdir) for early, later in pairs]
+        counts = []
+        for out_file, partition_names in zip((add_file, del_file), zip(*diffs)):
+            partitions = [open(name, "rb") for name in partition_names]
+            try:
+                count = 0
+                for row in heapq.merge(*partitions):
+                    out_file.write(row)
+                    count += 1
+                counts.append(count)
+            finally:
+                for partition in partitions:
+                    partition.close()
+    return counts[0], counts[1]
 
 
 def find_source_name_in_ingestion_queue(
@@ -259,6 +799,7 @@ def generate_deltas(env: str, latest_filename: str, uploads: List[dict],
                     s3_bucket: str, source_id: str, source_format: str,
                     sort_sources: bool = True,
                     bulk_ingest_on_reject: bool = True,
+                    latest_index: "RowIndex | None" = None,
                     ) -> Tuple[str | None, str | None]:
     """Check last valid ingestion and return the filenames of ADD/DEL deltas
 
@@ -267,11 +808,13 @@ def generate_deltas(env: str, latest_filename: str, uploads: List[dict],
     :param s3_bucket: S3 bucket used to store retrieved line lists and deltas
     :param source_id: UUID for the upload ingestor
     :param source_format: Format of source file ('CSV', 'JSON', 'XLSX',...)
-    :param sort_sources: Should sources be sorted before computing deltas. This
-      is initially slower, but can drastically reduce the number of lines
-      added and removed following difference determination (recommended).
+    :param sort_sources: Kept for compatibility. Rows are compared regardless
+      of their order, and deltas are always written sorted, see write_deltas.
     :param bulk_ingest_on_reject: Should we revert to bulk ingestion if the
         most recent delta ingestion failed?
+    :param latest_index: RowIndex of latest_filename. If given, and the last
+        successful ingestion has a row index, deltas are computed from the row
+        indexes without downloading the previous source file.
 
     'delta' refers to the difference between the full upload at the previous
     successful ingestion, whether that ingestion was a 'bulk' upload (overwriting
@@ -296,6 +839,8 @@ def generate_deltas(env: str, latest_filename: str, uploads: List[dict],
         return reject_deltas
     # identify last successful ingestion source
     uploads.sort(key=lambda x: x["created"], reverse=False)  # most recent last
+    # uploads skipped as the source was unchanged have no content of their own
+    uploads = [x for x in uploads if not x.get('unchanged')]
     if not (last_successful_ingest_list := list(filter(
             lambda x: x['status'] == 'SUCCESS', uploads))):
         logger.info("Deltas: No previous successful ingestions found.")
@@ -323,86 +868,232 @@ def generate_deltas(env: str, latest_filename: str, uploads: List[dict],
         logger.info("Deltas: rejected deltas identified in upload history, "
                     "abandoning deltas generation")
         return reject_deltas
-    # retrieve last good ingestion source
-    _, last_ingested_file_name = tempfile.mkstemp()
-    s3_key = f"{source_id}{d.strftime(TIME_FILEPART_FORMAT)}content.csv"
+    s3_prefix = f"{source_id}{d.strftime(TIME_FILEPART_FORMAT)}"
+    s3_key = f"{s3_prefix}content.csv"
     logger.info(f"Deltas: Identified last good ingestion source at: {s3_bucket}/{s3_key}")
-    s3_client.download_file(s3_bucket, s3_key, last_ingested_file_name)
-    logger.info(f"Deltas: Retrieved last good ingestion source: {last_ingested_file_name}")
-    # confirm that reference (previously ingested file) and latest headers match
-    with open(last_ingested_file_name, "r") as last_ingested_file:
-        last_ingested_header = last_ingested_file.readline()
     with open(latest_filename, "r") as lastest_file:
         latest_header = lastest_file.readline()
-    if latest_header != last_ingested_header:
-        logger.info("Deltas: Headers do not match - abandoning deltas")
-        return reject_deltas
-    # generate deltas files (additions and removals) with correct headers
-    try:
-        if sort_sources:
-            logger.info("Deltas: Sorting source files (initially slower but "
-                        "produces fewer deltas)")
-            # sort the source files - this is slower but produces fewer deltas
-            _, early_file_name = tempfile.mkstemp()
-            sort_file_preserve_header(early_file_name, last_ingested_file_name)
-            logger.info("Deltas: Sorted file for last successful ingestion: "
-                        f"{early_file_name}")
-            _, later_file_name = tempfile.mkstemp()
-            sort_file_preserve_header(later_file_name, latest_filename)
-            logger.info("Deltas: Sorted file for latest source file: "
-                        f"{later_file_name}")
-        else:
-            early_file_name = last_ingested_file_name
-            later_file_name = latest_filename
-        # 'comm' command has an annoying incompatibility between linux and mac
-        nocheck_flag = ["--nocheck-order"]  # linux requires this if not sorted
-        if platform == "darwin":  # but mac does not support the flag
-            nocheck_flag = []
-        # generate additions file (or return filename: None)
-        deltas_add_file_name = new_file_with_header(latest_header)
-        deltas_add_file = open(deltas_add_file_name, "a")
-        initial_file_size = deltas_add_file.tell()
-        if subprocess.run(["/usr/bin/env",
-                           "comm",
-                           "-13",  # Suppress unique lines from file1 and common
-                           early_file_name,
-                           later_file_name
-                           ] + nocheck_flag,
-                          stdout=deltas_add_file).returncode > 0:
-            logger.error("Deltas: second comm command returned an error code")
+    # compare with the row index of the last good ingestion source if there is
+    # one, fetching only the rows it removes
+    previous_index = None
+    if latest_index is not None:
+        previous_index = RowIndex.load(s3_bucket, f"{s3_prefix}{ROW_INDEX_FILENAME}")
+    if previous_index is not None:
+        if previous_index.header != latest_index.header:
+            logger.info("Deltas: Headers do not match - abandoning deltas")
             return reject_deltas
-        if deltas_add_file.tell() == initial_file_size:
-            deltas_add_file_name = None
-        deltas_add_file.close()
-        # generate removals file (or return filename: None)
+        previous_size = previous_index.size
+        added_rows, removed_rows = changed_rows(previous_index, latest_index)
+        removed_spans = previous_index.spans(removed_rows)
+        if (removed_spans and len(latest_index.header) + sum(n for _, n in removed_spans)
+                > 0.5 * previous_size):
+            return reject_deltas
+        if (len(coalesce_spans(removed_spans, DELTAS_RANGE_GAP_BYTES))
+                > DELTAS_MAX_RANGE_REQUESTS):
+            logger.info("Deltas: Too many rows removed to fetch them separately")
+            previous_index = None
+    if previous_index is not None:
+        logger.info("Deltas: Comparing with row index of last good ingestion source")
+        deltas_add_file_name = new_file_with_header(latest_header)
         deltas_del_file_name = new_file_with_header(latest_header)
-        deltas_del_file = open(deltas_del_file_name, "a")
-        initial_file_size = deltas_del_file.tell()
-        if subprocess.run(["/usr/bin/env",
-                           "comm",
-                           "-23",  # Suppress unique lines from file2 and common
-                           early_file_name,
-                           later_file_name
-                           ] + nocheck_flag,
-                          stdout=deltas_del_file).returncode > 0:
-            logger.error("Deltas: first comm command returned an error code")
+        added = write_rows(deltas_add_file_name, read_spans(
+            latest_filename, latest_index.spans(added_rows)))
+        removed = write_rows(deltas_del_file_name, fetch_rows(s3_bucket, s3_key, removed_spans))
+    else:
+        # retrieve last good ingestion source
+        _, last_ingested_file_name = tempfile.mkstemp()
+        s3_client.download_file(s3_bucket, s3_key, last_ingested_file_name)
+        logger.info(f"Deltas: Retrieved last good ingestion source: {last_ingested_file_name}")
+        # confirm that reference (previously ingested file) and latest headers match
+        with open(last_ingested_file_name, "r") as last_ingested_file:
+            last_ingested_header = last_ingested_file.readline()
+        if latest_header != last_ingested_header:
+            logger.info("Deltas: Headers do not match - abandoning deltas")
             return reject_deltas
-        if deltas_del_file.tell() == initial_file_size:
-            deltas_del_file_name = None
-        deltas_del_file.close()
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Deltas: Process error during call to comm command: {e}")
-        return reject_deltas
+        previous_size = os.path.getsize(last_ingested_file_name)
+        # generate deltas files (additions and removals) with correct headers
+        deltas_add_file_name = new_file_with_header(latest_header)
+        deltas_del_file_name = new_file_with_header(latest_header)
+        with open(deltas_add_file_name, "ab") as deltas_add_file, \
+                open(deltas_del_file_name, "ab") as deltas_del_file:
+            added, removed = write_deltas(
+                last_ingested_file_name, latest_filename, deltas_add_file, deltas_del_file)
+    logger.info(f"Deltas: {added} rows added, {removed} rows removed")
+    if not added:
+        os.remove(deltas_add_file_name)
+        deltas_add_file_name = None
+    if not removed:
+        os.remove(deltas_del_file_name)
+        deltas_del_file_name = None
     # finally, check that the deltas aren't replacing most of the source file,
     # wherein we would be better to simply re-ingest the full source and reset
     # delta tracking (remembering that Del deltas accumulate records in the DB)
     if deltas_del_file_name:
-        if (os.path.getsize(deltas_del_file_name)
-                > (0.5 * os.path.getsize(last_ingested_file_name))):
+        if os.path.getsize(deltas_del_file_name) > (0.5 * previous_size):
             return reject_deltas
     return deltas_add_file_name, deltas_del_file_name
 
 
+class RowIndex:
+    """
+    Digests and lengths of the rows of a CSV source file, after its header,
+    in file order.
+
+    The row index of each retrieved CSV file is uploaded next to it, so that
+    the deltas of the next retrieval can be computed from the index alone,
+    fetching only the rows removed since with ranged GETs, rather than
+    downloading the whole previous file. Digests are the first 8 bytes of the
+    BLAKE2b hash of each row, and row offsets follow from the lengths, so the
+    index takes 12 bytes per row.
+    """
+
+    def __init__(self, header: bytes, digests: array.array, lengths: array.array):
+        self.header = header
+        self.digests = digests
+        self.lengths = lengths
+
+    @classmethod
+    def from_file(cls, file_name: str) -> "RowIndex":
+        digests = bytearray()
+        lengths = array.array("I")
+        with open(file_name, "rb") as f:
+            header = f.readline()
+            for line in f:
+                digests += hashlib.blake2b(line.rstrip(b"\n"), digest_size=8).digest()
+                lengths.append(len(line))
+        return cls(header, array.array("Q", bytes(digests)), lengths)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "RowIndex":
+        data = gzip.decompress(data)
+        if not data.startswith(ROW_INDEX_MAGIC):
+            raise ValueError("Not a row index")
+        data = memoryview(data)[len(ROW_INDEX_MAGIC):]
+        header_length, num_rows = (int.from_bytes(data[i:i + 8], "little") for i in (0, 8))
+        header = bytes(data[16:16 + header_length])
+        digests, lengths = array.array("Q"), array.array("I")
+        start = 16 + header_length
+        digests.frombytes(data[start:start + num_rows * digests.itemsize])
+        lengths.frombytes(data[start + num_rows * digests.itemsize:])
+        if sys.byteorder != "little":
+            digests.byteswap()
+            lengths.byteswap()
+        if len(digests) != num_rows or len(lengths) != num_rows:
+            raise ValueError("Truncated row index")
+        return cls(header, digests, lengths)
+
+    def to_bytes(self) -> bytes:
+        digests, lengths = self.digests, self.lengths
+        if sys.byteorder != "little":
+            digests, lengths = array.array("Q", digests), array.array("I", lengths)
+            digests.byteswap()
+            lengths.byteswap()
+        return gzip.compress(b"".join([
+            ROW_INDEX_MAGIC, len(self.header).to_bytes(8, "little"),
+            len(digests).to_bytes(8, "little"), self.header,
+            digests.tobytes(), lengths.tobytes()]), compresslevel=6)
+
+    @classmethod
+    def load(cls, s3_bucket: str, s3_key: str) -> "RowIndex | None":
+        """Returns the row index at s3_key, or None if there is none."""
+        try:
+            obj = s3_client.get_object(Bucket=s3_bucket, Key=s3_key)
+            return cls.from_bytes(obj["Body"].read())
+        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError,
+                ValueError, EOFError, OSError) as e:
+            logger.info(f"Deltas: No usable row index at {s3_bucket}/{s3_key}: {e}")
+            return None
+
+    def save(self, s3_bucket: str, s3_key: str):
+        """Uploads the row index, logging rather than raising errors."""
+        try:
+            s3_client.put_object(Bucket=s3_bucket, Key=s3_key, Body=self.to_bytes())
+            logger.info(f"Uploaded row index to s3://{s3_bucket}/{s3_key}")
+        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as e:
+            logger.warning(f"Could not upload row index to s3://{s3_bucket}/{s3_key}: {e}")
+
+    @property
+    def size(self) -> int:
+        """Size of the indexed file."""
+        return len(self.header) + sum(self.lengths)
+
+    def spans(self, positions: List[int]) -> List[Tuple[int, int]]:
+        """Returns the (offset, length) in the indexed file of rows at positions."""
+        offsets = array.array("Q", itertools.accumulate(
+            self.lengths[:-1], initial=len(self.header)))
+        return [(offsets[i], self.lengths[i]) for i in positions]
+
+
+def changed_rows(early: RowIndex, later: RowIndex) -> Tuple[List[int], List[int]]:
+    """
+    Returns the positions of the rows added in later, and of those removed
+    from early, comparing rows as a multiset, in ascending order.
+    """
+    early_set, later_set = set(early.digests), set(later.digests)
+    if len(early_set) == len(early.digests) and len(later_set) == len(later.digests):
+        is_changed = (early_set ^ later_set).__contains__
+        return tuple(
+            list(itertools.compress(range(len(digests)), map(is_changed, digests)))
+            for digests in (later.digests, early.digests))
+    positions = []
+    for digests, other_digests in ((later.digests, early.digests),
+                                   (early.digests, later.digests)):
+        remaining = collections.Counter(digests)
+        remaining.subtract(other_digests)
+        unmatched = []
+        for i, digest in enumerate(digests):
+            if remaining[digest] > 0:
+                remaining[digest] -= 1
+                unmatched.append(i)
+        positions.append(unmatched)
+    return positions[0], positions[1]
+
+
+def coalesce_spans(spans: List[Tuple[int, int]], gap: int) -> List[Tuple[int, int]]:
+    """Merges (offset, length) spans in ascending order less than gap bytes apart."""
+    ranges = []
+    for offset, length in spans:
+        if ranges and offset - ranges[-1][1] < gap:
+            ranges[-1][1] = offset + length
+        else:
+            ranges.append([offset, offset + length])
+    return [(start, end - start) for start, end in ranges]
+
+
+def fetch_rows(s3_bucket: str, s3_key: str, spans: List[Tuple[int, int]],
+               gap: int = DELTAS_RANGE_GAP_BYTES) -> List[bytes]:
+    """Fetches the rows at (offset, length) spans in ascending order, with ranged GETs."""
+    rows = []
+    spans_iter = iter(spans)
+    for start, length in coalesce_spans(spans, gap):
+        body = s3_client.get_object(
+            Bucket=s3_bucket, Key=s3_key,
+            Range=f"bytes={start}-{start + length - 1}")["Body"].read()
+        for offset, row_length in spans_iter:
+            rows.append(body[offset - start:offset - start + row_length].rstrip(b"\n"))
+            if offset + row_length >= start + length:
+                break
+    return rows
+
+
+def read_spans(file_name: str, spans: List[Tuple[int, int]]) -> List[bytes]:
+    """Reads the rows at (offset, length) spans of a local file."""
+    rows = []
+    with open(file_name, "rb") as f:
+        for offset, length in spans:
+            f.seek(offset)
+            rows.append(f.read(length).rstrip(b"\n"))
+    return rows
+
+
+def write_rows(file_name: str, rows: List[bytes]) -> int:
+    """Appends rows to file_name in sorted order, returning their number."""
+    rows.sort()
+    with open(file_name, "ab") as f:
+        f.writelines(row + b"\n" for row in rows)
+    return len(rows)
+
+
 def parse_datetime(date_str: str) -> datetime:
     """Isolate functionality to facilitate easier mocking"""
     return dateutil.parser.parse(date_str)
@@ -411,8 +1102,15 @@ def parse_datetime(date_str: str) -> datetime:
 def retrieve_content(env, source_id, upload_id, url, source_format,
                      api_headers, cookies, chunk_bytes=CSV_CHUNK_BYTES,
                      tempdir=TEMP_PATH, uploads_history={},
-                     bucket=OUTPUT_BUCKET):
-    """ Retrieves and locally persists the content at the provided URL. """
+                     bucket=OUTPUT_BUCKET, state=None, skip_unchanged=False):
+    """ Retrieves and locally persists the content at the provided URL.
+
+    state is what was saved about the last successful retrieval of the
+    source (see load_retrieval_state), and is updated with the encoding and
+    validators of the content retrieved. If skip_unchanged, raises
+    SourceUnchanged if the content is the same as then.
+    """
+    state = {} if state is None else state
     try:
         if (source_format != "JSON"
                 and source_format != "CSV"
@@ -422,18 +1120,51 @@ def retrieve_content(env, source_id, upload_id, url, source_format,
                 e, env, common_lib.UploadError.SOURCE_CONFIGURATION_ERROR,
                 source_id, upload_id, api_headers, cookies)
         logger.info(f"Downloading {source_format} content from {url}")
+        # Make the encoding of retrieved content consistent (UTF-8) for all
+        # parsers as per https://github.com/globaldothealth/list/issues/867,
+        # while downloading and decompressing, or while extracting from a zip
+        # file. XLSX content is left for parsers.
+        mimetype, compression = mimetypes.guess_type(url)
+        zipped = mimetype == "application/zip"
+        transcode = source_format != "XLSX"
+        previous = state.get("validators", {}) if skip_unchanged else {}
+        # conditional requests only make sense for the same URL
+        validators = previous if previous.get("url") == url else None
+        sinks = []
+
+        def content_sink(f):
+            sinks.append(Utf8Sink(f, cached_encoding=state.get("encoding"))
+                         if transcode else RawSink(f))
+            return sinks[-1]
+
+        def sink_class(f):
+            if zipped:
+                sinks.append(RawSink(f))
+            elif compression in DECOMPRESSORS:
+                sinks.append(DecompressingSink(content_sink(f), compression))
+            else:
+                return content_sink(f)
+            return sinks[-1]
         if url.startswith("s3://"):
             # strip the prefix
             s3Location = url[5:]
             # split at the first /
             [s3Bucket, s3Key] = s3Location.split('/', 1)
             # get it!
-            _, local_filename = tempfile.mkstemp(dir=tempdir)
-            s3_client.download_file(s3Bucket, s3Key, local_filename)
+            local_filename = download_s3_object(
+                s3Bucket, s3Key, tempdir, chunk_bytes, sink_class=sink_class,
+                validators=validators)
         else:
             headers = {"user-agent": "GHDSI/1.0 (https://global.health)"}
-            local_filename = download_file_stream(url, headers, tempdir)
+            local_filename = download_file_stream(
+                url, headers, tempdir, chunk_bytes=chunk_bytes, sink_class=sink_class,
+                validators=validators)
         logger.info("Download finished")
+        sha256 = sinks[-1].sha256.hexdigest()
+        if previous.get("sha256") == sha256:
+            os.remove(local_filename)
+            raise SourceUnchanged(f"Content at {url} has the same SHA-256 as last retrieved")
+        state["validators"] = {**sinks[-1].validators, "url": url, "sha256": sha256}
         # Match upload s3 key (bucket folder) to upload timestamp (if available)
         try:
             today = parse_datetime(
@@ -448,36 +1179,18 @@ def retrieve_content(env, source_id, upload_id, url, source_format,
             f"{today.strftime(TIME_FILEPART_FORMAT)}"
             f"{key_filename_part}"
         )
-        # Make the encoding of retrieved content consistent (UTF-8) for all
-        # parsers as per https://github.com/globaldothealth/list/issues/867.
-        bytes_filename = raw_content_fileconvert(url, local_filename, tempdir)
-        logging.info(f"Filename after conversion: {bytes_filename}")
-        if source_format == "XLSX":
+        outfile_name = raw_content_fileconvert(
+            url, local_filename, tempdir, sink_class=content_sink, chunk_bytes=chunk_bytes)
+        logging.info(f"Filename after conversion: {outfile_name}")
+        if transcode:
+            state["encoding"] = sinks[-1].encoding
+        else:
             # do not convert XLSX into another encoding, leave for parsers
             logger.warning("Skipping encoding detection for XLSX")
-            outfile = bytes_filename
-        else:
-            logger.info("Detecting encoding of retrieved content")
-            # Read 2MB to be quite sure about the encoding.
-            bytesio = open(bytes_filename, "rb")
-            detected_enc = detect(bytesio.read(2 << 20))
-            bytesio.seek(0)
-            if detected_enc["encoding"]:
-                logger.info(f"Source encoding is presumably {detected_enc}")
-            else:
-                detected_enc["encoding"] = DEFAULT_ENCODING
-                logger.warning(f"Source encoding detection failed, setting to {DEFAULT_ENCODING}")
-            fd, outfile_name = tempfile.mkstemp(dir=tempdir)
-            with os.fdopen(fd, "w", encoding="utf-8") as outfile:
-                text_stream = codecs.getreader(detected_enc["encoding"])(bytesio)
-                # Write the output file as utf-8 in chunks because decoding the
-                # whole data in one shot becomes really slow with big files.
-                content = text_stream.read(READ_CHUNK_BYTES)
-                while content:
-                    outfile.write(content)
-                    content = text_stream.read(READ_CHUNK_BYTES)
         # always return full source file (but don't parse if deltas generated)
         return_list = [(outfile_name, s3_object_key, {})]
+        # index rows, so that the next deltas need not download this file
+        row_index = RowIndex.from_file(outfile_name) if source_format == "CSV" else None
         # attempt to generate deltas files
         deltas_add_file_name, deltas_del_file_name = generate_deltas(
             env,
@@ -486,8 +1199,15 @@ def retrieve_content(env, source_id, upload_id, url, source_format,
             bucket,
             source_id,
             source_format,
-            sort_sources=True
+            sort_sources=True,
+            latest_index=row_index
         )
+        if row_index is not None:
+            row_index.save(bucket, (
+                f"{source_id}"
+                f"{today.strftime(TIME_FILEPART_FORMAT)}"
+                f"{ROW_INDEX_FILENAME}"
+            ))
         if deltas_add_file_name:
             s3_deltas_add_object_key = (
                 f"{source_id}"
@@ -514,7 +1234,7 @@ def retrieve_content(env, source_id, upload_id, url, source_format,
     except requests.exceptions.RequestException as e:
         upload_error = (
             common_lib.UploadError.SOURCE_CONTENT_NOT_FOUND
-            if e.response.status_code == 404 else
+            if e.response is not None and e.response.status_code == 404 else
             common_lib.UploadError.SOURCE_CONTENT_DOWNLOAD_ERROR)
         common_lib.complete_with_error(
             e, env, upload_error, source_id, upload_id,
@@ -536,11 +1256,12 @@ def upload_to_s3(
             api_headers, cookies)
 
 
-def invoke_parser(
-    env, parser_module, source_id, upload_id, api_headers, cookies, s3_object_key,
-        source_url, date_filter, parsing_date_range, deltas=None):
+def parser_event(
+        env, source_id, upload_id, cookies, s3_object_key, source_url, date_filter,
+        parsing_date_range, deltas=None):
+    """Returns the event with which parsers are invoked on the source content."""
     auth = {"email": os.getenv("EPID_INGESTION_EMAIL", "")} if cookies else None
-    payload = {
+    return {
         "env": env,
         "s3Bucket": OUTPUT_BUCKET,
         "sourceId": source_id,
@@ -552,11 +1273,55 @@ def invoke_parser(
         "auth": auth,
         "deltas": deltas,
     }
+
+
+def invoke_parser(
+    env, parser_module, source_id, upload_id, api_headers, cookies, s3_object_key,
+        source_url, date_filter, parsing_date_range, deltas=None):
+    payload = parser_event(
+        env, source_id, upload_id, cookies, s3_object_key, source_url, date_filter,
+        parsing_date_range, deltas)
     logger.info(f"Invoking parser ({parser_module})")
     sys.path.append(str(Path(__file__).parent.parent))  # ingestion/functions
     importlib.import_module(parser_module).event_handler(payload)
 
 
+def resume_upload(env, source_id, upload_id, api_headers, cookies):
+    """
+    Resumes an interrupted upload from the last checkpoint saved by the parser.
+
+    If the parser spooled all the cases of the upload, they are uploaded from
+    the spool, see parsing_lib.replay_spool. Otherwise the parser is invoked
+    again on the source content of the upload.
+    """
+    try:
+        obj = s3_client.get_object(
+            Bucket=OUTPUT_BUCKET, Key=common_lib.checkpoint_key(source_id, upload_id))
+        event = json.load(obj["Body"])["event"]
+    except Exception as e:
+        common_lib.complete_with_error(
+            e, env, common_lib.UploadError.INTERNAL_ERROR, source_id, upload_id,
+            api_headers, cookies)
+    logger.info(f"Resuming upload {upload_id} of s3://{OUTPUT_BUCKET}/{event['s3Key']}")
+    import parsing_lib  # on the path along with common_lib
+    if parsing_lib.CaseSpool.load(OUTPUT_BUCKET, source_id, upload_id):
+        parsing_lib.replay_spool(parser_event(
+            env, source_id, upload_id, cookies, event["s3Key"], event["sourceUrl"],
+            event.get("dateFilter"), event.get("dateRange"), event.get("deltas")))
+    else:
+        _, _, parser, _, _, _ = get_source_details(
+            env, source_id, upload_id, api_headers, cookies)
+        invoke_parser(
+            env, common_lib.get_parser_module(parser), source_id, upload_id,
+            api_headers, cookies, event["s3Key"], event["sourceUrl"],
+            event.get("dateFilter"), event.get("dateRange"), event.get("deltas"))
+    return {
+        "bucket": OUTPUT_BUCKET,
+        "key": event["s3Key"],
+        "upload_id": [upload_id],
+    }
+
+
 def get_today():
     """Return today's datetime, just here for easier mocking."""
     return datetime.today()
@@ -592,6 +1357,23 @@ def format_source_url(url: str) -> str:
     return re.sub(r'(.*)::daysbefore=.*', r'\1', url)
 
 
+class HostSlots:
+    """Semaphores limiting how many sources are downloaded from each host at a time."""
+
+    def __init__(self, per_host: int = SOURCES_PER_HOST):
+        self.per_host = per_host
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, url: str) -> threading.BoundedSemaphore:
+        """Returns the semaphore of the host of url (the bucket of S3 URLs)."""
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.per_host)
+            return self._semaphores[host]
+
+
 def run_retrieval(tempdir=TEMP_PATH):
     """Global ingestion retrieval function.
 
@@ -612,31 +1394,112 @@ def run_retrieval(tempdir=TEMP_PATH):
     tempdir: str, optional
         Temporary folder to store retrieve content in
 
+    If EPID_INGESTION_SOURCE_IDS is set to a comma-separated list of source
+    IDs, all of them are retrieved and parsed by this process instead of
+    EPID_INGESTION_SOURCE_ID, see retrieve_sources.
+
+    If EPID_INGESTION_RESUME_UPLOAD_ID is set, the content of that upload is
+    parsed again from its last checkpoint instead of retrieving new content.
+
+    If the content is the same as at the last successful retrieval, the
+    parser has not changed since, and the source has no date filter or parsing
+    date range, the upload is marked as unchanged and nothing is parsed, see
+    EPID_INGESTION_SKIP_UNCHANGED and parser_version.
+
     Returns
     ------
     JSON object containing the bucket and key at which the retrieved data was
     uploaded to S3. For more information on return types, see:
       https://docs.aws.amazon.com/lambda/latest/dg/python-handler.html
+    With several sources, such an object for each source ID.
     """
 
     env = os.environ["EPID_INGESTION_ENV"]
-    source_id = os.environ["EPID_INGESTION_SOURCE_ID"]
+    source_ids = [source_id.strip()
+                  for source_id in os.getenv("EPID_INGESTION_SOURCE_IDS", "").split(",")
+                  if source_id.strip()]
+    source_id = None if source_ids else os.environ["EPID_INGESTION_SOURCE_ID"]
     parsing_date_range = os.getenv("EPID_INGESTION_PARSING_DATE_RANGE", {})
     if isinstance(parsing_date_range, str):  # date range specified with comma
         parsing_date_range = dict(zip(["start", "end"], parsing_date_range.split(",")))
     local_email = os.getenv("EPID_INGESTION_EMAIL", "")
 
-    auth_headers = None
     cookies = None
     if local_email and env in ["local", "locale2e"]:
         cookies = common_lib.login(local_email)
-    else:
-        auth_headers = common_lib.obtain_api_credentials(s3_client)
+    if source_ids:
+        return retrieve_sources(env, source_ids, cookies, parsing_date_range, tempdir)
+    if resume_upload_id := os.getenv("EPID_INGESTION_RESUME_UPLOAD_ID"):
+        return resume_upload(
+            env, source_id, resume_upload_id, get_auth_headers(cookies), cookies)
+    return retrieve_source(env, source_id, cookies, parsing_date_range, tempdir)
+
+
+def get_auth_headers(cookies):
+    """
+    Returns the headers authenticating requests to the G.h API, or None when
+    logged in to a local instance with cookies.
+
+    Credentials are cached by common_lib and refreshed before they expire,
+    so this is called before each request rather than once per job.
+    """
+    return None if cookies else common_lib.obtain_api_credentials(s3_client)
+
+
+def retrieve_sources(env: str, source_ids: List[str], cookies,
+                     parsing_date_range: dict, tempdir: str = TEMP_PATH,
+                     workers: int = SOURCE_WORKERS,
+                     per_host: int = SOURCES_PER_HOST) -> Dict[str, dict]:
+    """
+    Retrieves and parses several sources concurrently in this process.
+
+    Sources share the cached credentials, the HTTP session to the G.h API and
+    the S3 client, instead of each paying for a job of its own. At most workers
+    sources are ingested at a time, and at most per_host of them download
+    their content from the same host at a time.
+
+    A source failing does not stop the others. Once they are all done, a
+    RuntimeError lists the sources that failed, if any; their uploads are
+    marked as failed as usual.
+    """
+    logger.info(f"Retrieving {len(source_ids)} sources, {workers} at a time")
+    host_slots = HostSlots(per_host)
+    results, errors = {}, {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(retrieve_source, env, source_id, cookies,
+                            parsing_date_range, tempdir, host_slots): source_id
+            for source_id in source_ids}
+        for future in concurrent.futures.as_completed(futures):
+            source_id = futures[future]
+            try:
+                results[source_id] = future.result()
+            except Exception as e:
+                logger.error(f"Retrieval of source {source_id} failed: {e!r}")
+                errors[source_id] = e
+    if errors:
+        raise RuntimeError(
+            f"Retrieval failed for {len(errors)} of {len(source_ids)} sources: "
+            + ", ".join(sorted(errors)))
+    return results
+
+
+def retrieve_source(env: str, source_id: str, cookies,
+                    parsing_date_range: dict, tempdir: str = TEMP_PATH,
+                    host_slots: HostSlots | None = None) -> dict:
+    """
+    Retrieves the content of a source, uploads it to S3 and parses it.
+
+    If host_slots is given, the content is only downloaded while holding the
+    semaphore of its host. Sources may wait for their turn, and download and
+    parse for longer than credentials last, so credentials are obtained
+    again before each step, see get_auth_headers.
+    """
     upload_id = common_lib.create_upload_record(
-        env, source_id, auth_headers, cookies)
+        env, source_id, get_auth_headers(cookies), cookies)
     (url, source_format, parser, date_filter, stable_identifiers,
      uploads_history) = get_source_details(
-         env, source_id, upload_id, auth_headers, cookies)
+         env, source_id, upload_id, get_auth_headers(cookies), cookies)
 
     if not stable_identifiers:
         logger.info(f"Source {source_id} does not have stable identifiers\n"
@@ -644,13 +1507,33 @@ def run_retrieval(tempdir=TEMP_PATH):
         date_filter = {}
         parsing_date_range = {}
     url = format_source_url(url)
-    file_names_s3_object_keys = retrieve_content(
-        env, source_id, upload_id, url, source_format, auth_headers, cookies,
-        tempdir=tempdir, uploads_history=uploads_history)
+    state = load_retrieval_state(OUTPUT_BUCKET, source_id)
+    # date filters and ranges select different cases from the same content
+    # depending on the day, so unchanged content is only skipped without them,
+    # and only if it was parsed by the same version of the parser
+    version = parser_version(common_lib.get_parser_module(parser)) if parser else None
+    skip_unchanged = (SKIP_UNCHANGED and not date_filter and not parsing_date_range
+                      and state.get("parser_version") == version)
+    try:
+        with host_slots(url) if host_slots else contextlib.nullcontext():
+            file_names_s3_object_keys = retrieve_content(
+                env, source_id, upload_id, url, source_format, get_auth_headers(cookies), cookies,
+                tempdir=tempdir, uploads_history=uploads_history, state=state,
+                skip_unchanged=skip_unchanged)
+    except SourceUnchanged as e:
+        logger.info(f"{e}, skipping ingestion")
+        common_lib.finalize_upload(
+            env, source_id, upload_id, get_auth_headers(cookies), cookies, unchanged=True)
+        return {
+            "bucket": OUTPUT_BUCKET,
+            "key": None,
+            "upload_id": [upload_id],
+            "unchanged": True,
+        }
     file_opts = {}
     for file_name, s3_object_key, *opts in file_names_s3_object_keys:
         upload_to_s3(file_name, s3_object_key, env,
-                     source_id, upload_id, auth_headers, cookies)
+                     source_id, upload_id, get_auth_headers(cookies), cookies)
         # parse options while we're here
         key = s3_object_key
         file_opts[s3_object_key] = {}
@@ -678,23 +1561,26 @@ def run_retrieval(tempdir=TEMP_PATH):
                 if (both_deltas_present and deltas == "Del"):
                     # create new uploadId so that it doesn't clash with Add
                     second_upload_id = [common_lib.create_upload_record(
-                        env, source_id, auth_headers, cookies)]
+                        env, source_id, get_auth_headers(cookies), cookies)]
                     invoke_parser(
                         env, parser_module, source_id, second_upload_id[0],
-                        auth_headers, cookies, s3_object_key, url, date_filter,
+                        get_auth_headers(cookies), cookies, s3_object_key, url, date_filter,
                         parsing_date_range, deltas)
                 else:
                     invoke_parser(
                         env, parser_module, source_id, upload_id,
-                        auth_headers, cookies, s3_object_key, url, date_filter,
+                        get_auth_headers(cookies), cookies, s3_object_key, url, date_filter,
                         parsing_date_range, deltas)
 
     else:
         common_lib.complete_with_error(
             ValueError(f"No parser set for {source_id}"),
             env, common_lib.UploadError.SOURCE_CONFIGURATION_ERROR, source_id, upload_id,
-            auth_headers, cookies)
+            get_auth_headers(cookies), cookies)
 
+    # remember the content parsed successfully, and by which parser, for the next retrieval
+    state["parser_version"] = version
+    save_retrieval_state(OUTPUT_BUCKET, source_id, state)
     return {
         "bucket": OUTPUT_BUCKET,
         "key": s3_object_key,
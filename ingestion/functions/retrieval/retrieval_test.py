@@ -1,9 +1,17 @@
 import boto3
+import bz2
 import datetime
+import gzip
+import hashlib
+import io
+import itertools
 import json
+import lzma
 import os
 import pytest
 import tempfile
+import threading
+import time
 import sys
 import zipfile
 import shutil
@@ -79,9 +87,11 @@ def setup_e2e(mock_source_api_url_fixture, valid_event, requests_mock):
     requests_mock.get(origin_url, json={"data": "yes"})
 
     # Mock/stub retrieving credentials, invoking the parser, and S3.
+    # Credentials are still obtained through the cache of obtain_api_credentials.
     common_lib = mock_source_api_url_fixture
-    common_lib.obtain_api_credentials = MagicMock(
-        name="obtain_api_credentials", return_value={})
+    common_lib.set_api_credentials(None)
+    credentials = patch.object(common_lib, "ApiCredentials", name="ApiCredentials")
+    credentials.start().return_value.headers.return_value = {}
 
     # Set up mock request values used in multiple requests.
     # TODO: Complete removal of URL env var.
@@ -94,6 +104,8 @@ def setup_e2e(mock_source_api_url_fixture, valid_event, requests_mock):
     )
     os.environ["SOURCE_API_URL"] = _SOURCE_API_URL
     yield requests_mock, common_lib
+    credentials.stop()
+    common_lib.set_api_credentials(None)
 
 
 @pytest.fixture()
@@ -146,7 +158,8 @@ def test_e2e(source, valid_event, mock_source_api_url_fixture, setup_e2e, tempdi
 
     response = retrieval.run_retrieval(tempdir=tempdir)
 
-    common_lib.obtain_api_credentials.assert_called_once()
+    # each step obtains credentials, but they are only fetched once for the source
+    common_lib.ApiCredentials.assert_called_once_with(retrieval.s3_client)
     retrieval.invoke_parser.assert_called_once_with(
         valid_event["env"],
         "parsing.example.example",
@@ -393,6 +406,365 @@ def test_retrieve_content_raises_error_if_other_errors_getting_source_content(
     assert not "Should have raised an exception."
 
 
+def test_retrieve_content_transcodes_csv_while_downloading(requests_mock):
+    from retrieval import retrieval  # Import locally to avoid superseding mock
+    content_url = "http://foo.bar/"
+    content = "name,city\nJosé,São Paulo\nZoë,Zürich\n" * 100
+    requests_mock.get(content_url, content=content.encode("utf-16"))
+    files_s3_keys = retrieval.retrieve_content(
+        "env", "id", "upload_id", content_url, "CSV", {}, {},
+        chunk_bytes=1001, tempdir="/tmp")
+    with open(files_s3_keys[0][0], "rb") as f:
+        assert f.read() == content.encode("utf-8")
+
+
+@pytest.mark.parametrize("detect_bytes", [1, 7, 1 << 20])
+def test_utf8_sink_transcodes_across_chunk_boundaries(detect_bytes):
+    from retrieval import retrieval
+    content = "name,city\nJosé,São Paulo\nZoë,Zürich\n" * 100
+    for encoding in ["utf-16", "utf-8", "ascii"]:
+        data = (content.encode(encoding) if encoding != "ascii"
+                else b"a,b\n" * 1000 + "é".encode("utf-8"))
+        out = io.BytesIO()
+        sink = retrieval.Utf8Sink(out, detect_bytes)
+        for i in range(0, len(data), 3):
+            sink.write(data[i:i + 3])
+        sink.finish()
+        assert out.getvalue() == data.decode(
+            "utf-8" if encoding == "ascii" else encoding).encode("utf-8")
+        assert sink.received == len(data)
+
+
+def test_utf8_sink_raises_error_on_content_invalid_in_detected_encoding():
+    from retrieval import retrieval
+    sink = retrieval.Utf8Sink(io.BytesIO(), detect_bytes=4)
+    sink.write("résumé\n".encode("utf-8"))
+    with pytest.raises(UnicodeDecodeError):
+        sink.write(b"\xff\xfe")
+        sink.finish()
+
+
+def ranged_content(content, truncate=(), accept_ranges=True):
+    """
+    requests_mock callback serving content, or its range requested, with
+    responses to the requests numbered in truncate cut short.
+    """
+    requests = []
+
+    def callback(request, context):
+        requests.append(request)
+        start, end = 0, len(content)
+        context.headers["ETag"] = '"v1"'
+        if accept_ranges:
+            context.headers["Accept-Ranges"] = "bytes"
+        if accept_ranges and "Range" in request.headers:
+            first, last = request.headers["Range"].removeprefix("bytes=").split("-")
+            start, end = int(first), int(last or len(content) - 1) + 1
+            context.status_code = 206
+        context.headers["Content-Length"] = str(end - start)
+        body = content[start:end]
+        return body[:len(body) // 2] if len(requests) in truncate else body
+    return callback, requests
+
+
+@pytest.mark.parametrize("accept_ranges", [True, False])
+def test_download_file_stream_resumes_incomplete_download(requests_mock, accept_ranges):
+    from retrieval import retrieval
+    content = bytes(range(256)) * 4
+    callback, requests = ranged_content(content, truncate=[1], accept_ranges=accept_ranges)
+    requests_mock.get("http://foo.bar/", content=callback)
+    file_name = retrieval.download_file_stream(
+        "http://foo.bar/", {}, "/tmp", sleeptime=0, connections=1)
+    with open(file_name, "rb") as f:
+        assert f.read() == content
+    assert len(requests) == 2
+    if accept_ranges:
+        assert requests[1].headers["Range"] == "bytes=512-"
+        assert requests[1].headers["If-Range"] == '"v1"'
+    else:
+        assert "Range" not in requests[1].headers
+
+
+def test_download_file_stream_downloads_parts_over_several_connections(requests_mock):
+    from retrieval import retrieval
+    content = os.urandom(10000)
+    callback, requests = ranged_content(content, truncate=[3])
+    requests_mock.get("http://foo.bar/", content=callback)
+    file_name = retrieval.download_file_stream(
+        "http://foo.bar/", {}, "/tmp", sleeptime=0, connections=3, part_bytes=1024,
+        sink_class=retrieval.RawSink)
+    with open(file_name, "rb") as f:
+        assert f.read() == content
+    ranges = sorted(r.headers["Range"] for r in requests[1:])
+    assert len(ranges) == 11  # 10 parts, one of which was resumed
+    assert "bytes=9216-9999" in ranges
+    assert all(r.headers["If-Range"] == '"v1"' for r in requests[1:])
+
+
+def test_detect_encoding_only_runs_chardet_if_need_be():
+    from retrieval import retrieval
+    latin_1 = "name,city\nJosé,São Paulo\n".encode("latin-1") * 1000
+    with patch("retrieval.retrieval.detect") as detect:
+        detect.return_value = {"encoding": "ISO-8859-1"}
+        assert retrieval.detect_encoding("é\n".encode("utf-16")) == "utf-16"
+        assert retrieval.detect_encoding("é\n".encode("utf-8-sig")) == "utf-8-sig"
+        assert retrieval.detect_encoding("José\n".encode("utf-8")) == "utf-8"
+        assert retrieval.detect_encoding(latin_1, "cp1252") == "cp1252"
+        detect.assert_not_called()
+        assert retrieval.detect_encoding(latin_1, "ascii") == "ISO-8859-1"
+        assert retrieval.detect_encoding("a,b\n".encode("utf-16-le")) == "ISO-8859-1"
+        assert detect.call_count == 2
+        assert len(detect.call_args_list[0].args[0]) <= retrieval.DETECT_SAMPLE_BYTES
+
+
+def test_stride_sample_takes_chunks_across_data_from_line_starts():
+    from retrieval import retrieval
+    data = b"".join(b"%05d\n" % i for i in range(1000))
+    assert retrieval.stride_sample(data, len(data)) == data
+    sample = retrieval.stride_sample(data, 60, 3)
+    assert sample == data[:20] + b"00499\n00500\n00501\n00" + data[-18:]
+
+
+def test_retrieve_content_extracts_largest_zip_member_in_utf8(requests_mock):
+    from retrieval import retrieval  # Import locally to avoid superseding mock
+    content_url = "http://foo.bar/content.zip"
+    content = "name,city\nJosé,São Paulo\nZoë,Zürich\n" * 100
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("README.txt", "not this one")
+        zf.writestr("data/content.csv", content.encode("utf-16"))
+    requests_mock.get(content_url, content=archive.getvalue())
+    state = {}
+    files_s3_keys = retrieval.retrieve_content(
+        "env", "id", "upload_id", content_url, "CSV", {}, {},
+        chunk_bytes=1001, tempdir="/tmp", state=state)
+    with open(files_s3_keys[0][0], "rb") as f:
+        assert f.read() == content.encode("utf-8")
+    assert state["encoding"] == "utf-16"
+    assert state["validators"]["sha256"] == hashlib.sha256(archive.getvalue()).hexdigest()
+
+
+@pytest.mark.parametrize("suffix,compress", [
+    (".csv.gz", gzip.compress), (".csv.bz2", bz2.compress), (".csv.xz", lzma.compress)])
+def test_retrieve_content_decompresses_sources_while_downloading(
+        requests_mock, suffix, compress):
+    from retrieval import retrieval  # Import locally to avoid superseding mock
+    content_url = f"http://foo.bar/content{suffix}"
+    content = "name,city\nJosé,São Paulo\nZoë,Zürich\n" * 100
+    # concatenated streams, as compressed in parallel
+    data = content.encode("latin-1")
+    requests_mock.get(content_url, content=compress(data[:1000]) + compress(data[1000:]))
+    files_s3_keys = retrieval.retrieve_content(
+        "env", "id", "upload_id", content_url, "CSV", {}, {},
+        chunk_bytes=101, tempdir="/tmp")
+    with open(files_s3_keys[0][0], "rb") as f:
+        assert f.read() == content.encode("utf-8")
+
+
+def test_decompressing_sink_passes_on_uncompressed_content():
+    from retrieval import retrieval
+    out = io.BytesIO()
+    sink = retrieval.DecompressingSink(retrieval.RawSink(out), "gzip")
+    sink.write(b"a,b\n")
+    sink.finish()
+    assert out.getvalue() == b"a,b\n"
+
+
+def test_decompressing_sink_raises_on_truncated_content():
+    from retrieval import retrieval
+    sink = retrieval.DecompressingSink(retrieval.RawSink(io.BytesIO()), "xz")
+    sink.write(lzma.compress(b"a,b\n" * 100)[:-10])
+    with pytest.raises(ValueError, match="Truncated xz"):
+        sink.finish()
+
+
+def test_retrieve_content_remembers_source_encoding(requests_mock):
+    from retrieval import retrieval  # Import locally to avoid superseding mock
+    content_url = "http://foo.bar/"
+    content = "name,city\nJosé,São Paulo\n".encode("cp1252")
+    requests_mock.get(content_url, content=content)
+    state = {"encoding": "cp1252"}
+    with patch("retrieval.retrieval.detect") as detect:
+        files_s3_keys = retrieval.retrieve_content(
+            "env", "id", "upload_id", content_url, "CSV", {}, {}, tempdir="/tmp",
+            state=state)
+    detect.assert_not_called()
+    assert state["encoding"] == "cp1252"
+    with open(files_s3_keys[0][0], "rb") as f:
+        assert f.read() == content.decode("cp1252").encode("utf-8")
+
+
+def test_retrieve_content_records_validators_and_skips_unchanged_content(requests_mock):
+    from retrieval import retrieval  # Import locally to avoid superseding mock
+    content_url = "http://foo.bar/"
+    requests_mock.get(content_url, content=b"foo,bar\nbaz,quux\n",
+                      headers={"ETag": '"v1"', "Content-Length": "16"})
+    state = {}
+    retrieval.retrieve_content(
+        "env", "id", "upload_id", content_url, "CSV", {}, {}, tempdir="/tmp",
+        state=state, skip_unchanged=True)
+    assert state["validators"] == {
+        "etag": '"v1"', "contentLength": 16, "url": content_url,
+        "sha256": hashlib.sha256(b"foo,bar\nbaz,quux\n").hexdigest()}
+    # The server does not support conditional requests, but the content is unchanged
+    with pytest.raises(retrieval.SourceUnchanged):
+        retrieval.retrieve_content(
+            "env", "id", "upload_id", content_url, "CSV", {}, {}, tempdir="/tmp",
+            state=state, skip_unchanged=True)
+    assert requests_mock.request_history[-1].headers["If-None-Match"] == '"v1"'
+    # The server replies that the content is not modified
+    requests_mock.get(content_url, status_code=304)
+    with pytest.raises(retrieval.SourceUnchanged):
+        retrieval.retrieve_content(
+            "env", "id", "upload_id", content_url, "CSV", {}, {}, tempdir="/tmp",
+            state=state, skip_unchanged=True)
+    # Unchanged content is only skipped if asked to
+    requests_mock.get(content_url, content=b"foo,bar\nbaz,quux\n")
+    retrieval.retrieve_content(
+        "env", "id", "upload_id", content_url, "CSV", {}, {}, tempdir="/tmp",
+        state=state)
+    assert "If-None-Match" not in requests_mock.request_history[-1].headers
+
+
+def test_run_retrieval_marks_upload_unchanged_without_parsing(mock_source_api_url_fixture):
+    from retrieval import retrieval  # Import locally to avoid superseding mock
+    env = {"EPID_INGESTION_ENV": "env", "EPID_INGESTION_SOURCE_ID": "source_id"}
+    with patch.dict(os.environ, env), \
+            patch("retrieval.retrieval.common_lib") as mock_common_lib, \
+            patch("retrieval.retrieval.get_source_details") as mock_source_details, \
+            patch("retrieval.retrieval.load_retrieval_state") as load_state, \
+            patch("retrieval.retrieval.save_retrieval_state") as save_state, \
+            patch("retrieval.retrieval.retrieve_content") as retrieve_content, \
+            patch("retrieval.retrieval.parser_version", return_value="v1"), \
+            patch("retrieval.retrieval.invoke_parser") as invoke_parser:
+        os.environ.pop("EPID_INGESTION_PARSING_DATE_RANGE", None)
+        os.environ.pop("EPID_INGESTION_RESUME_UPLOAD_ID", None)
+        mock_common_lib.create_upload_record.return_value = upload_id
+        mock_source_details.return_value = (
+            origin_url, "CSV", "example.example", {}, True, [])
+        state = {"validators": {"sha256": "0"}, "parser_version": "v1"}
+        load_state.return_value = state
+        retrieve_content.side_effect = retrieval.SourceUnchanged("unchanged")
+        result = retrieval.run_retrieval()
+    assert retrieve_content.call_args.kwargs["skip_unchanged"]
+    assert retrieve_content.call_args.kwargs["state"] == state
+    mock_common_lib.finalize_upload.assert_called_once_with(
+        "env", "source_id", upload_id, mock_common_lib.obtain_api_credentials.return_value,
+        None, unchanged=True)
+    invoke_parser.assert_not_called()
+    save_state.assert_not_called()
+    assert result["unchanged"] and result["upload_id"] == [upload_id]
+
+
+def test_run_retrieval_parses_unchanged_content_with_new_parser(mock_source_api_url_fixture):
+    from retrieval import retrieval  # Import locally to avoid superseding mock
+    env = {"EPID_INGESTION_ENV": "env", "EPID_INGESTION_SOURCE_ID": "source_id"}
+    with patch.dict(os.environ, env), \
+            patch("retrieval.retrieval.common_lib") as mock_common_lib, \
+            patch("retrieval.retrieval.get_source_details") as mock_source_details, \
+            patch("retrieval.retrieval.load_retrieval_state") as load_state, \
+            patch("retrieval.retrieval.save_retrieval_state") as save_state, \
+            patch("retrieval.retrieval.retrieve_content") as retrieve_content, \
+            patch("retrieval.retrieval.parser_version", return_value="v2"), \
+            patch("retrieval.retrieval.invoke_parser") as invoke_parser:
+        os.environ.pop("EPID_INGESTION_PARSING_DATE_RANGE", None)
+        os.environ.pop("EPID_INGESTION_RESUME_UPLOAD_ID", None)
+        mock_common_lib.create_upload_record.return_value = upload_id
+        mock_source_details.return_value = (
+            origin_url, "CSV", "example.example", {}, True, [])
+        load_state.return_value = {"validators": {"sha256": "0"}, "parser_version": "v1"}
+        retrieve_content.return_value = [("content.csv", "source_id/content.csv", {})]
+        retrieval.run_retrieval()
+    assert not retrieve_content.call_args.kwargs["skip_unchanged"]
+    invoke_parser.assert_called_once()
+    assert save_state.call_args.args[2]["parser_version"] == "v2"
+
+
+def test_parser_version_changes_with_parser():
+    from retrieval import retrieval  # Import locally to avoid superseding mock
+    colombia = retrieval.parser_version("parsing.colombia.colombia")
+    assert colombia == retrieval.parser_version("parsing.colombia.colombia")
+    assert colombia != retrieval.parser_version("parsing.brazil_srag.srag")
+
+
+def test_run_retrieval_retrieves_several_sources_isolating_errors(mock_source_api_url_fixture):
+    from retrieval import retrieval  # Import locally to avoid superseding mock
+    env = {"EPID_INGESTION_ENV": "env", "EPID_INGESTION_SOURCE_IDS": "a, b,c"}
+
+    def retrieve_source(env, source_id, *args):
+        if source_id == "b":
+            raise ValueError("no parser")
+        return {"upload_id": [source_id]}
+    with patch.dict(os.environ, env), \
+            patch("retrieval.retrieval.common_lib") as mock_common_lib, \
+            patch("retrieval.retrieval.retrieve_source") as mock_retrieve_source:
+        mock_retrieve_source.side_effect = retrieve_source
+        with pytest.raises(RuntimeError, match="1 of 3 sources: b"):
+            retrieval.run_retrieval()
+    # each source obtains its credentials, and the other sources are still retrieved
+    mock_common_lib.obtain_api_credentials.assert_not_called()
+    assert sorted(c.args[1] for c in mock_retrieve_source.call_args_list) == ["a", "b", "c"]
+
+
+def test_retrieve_sources_limits_downloads_per_host():
+    from retrieval import retrieval  # Import locally to avoid superseding mock
+    hosts = {"a": "foo.bar", "b": "foo.bar", "c": "foo.bar", "d": "baz.bar"}
+    downloading = {"foo.bar": 0, "baz.bar": 0}
+    most_downloading = dict(downloading)
+    lock = threading.Lock()
+
+    def retrieve_content(env, source_id, *args, **kwargs):
+        with lock:
+            downloading[hosts[source_id]] += 1
+            most_downloading[hosts[source_id]] = max(
+                most_downloading[hosts[source_id]], downloading[hosts[source_id]])
+        time.sleep(0.05)
+        with lock:
+            downloading[hosts[source_id]] -= 1
+        return [("content.csv", f"{source_id}/content.csv", {})]
+    with patch("retrieval.retrieval.common_lib") as mock_common_lib, \
+            patch("retrieval.retrieval.get_source_details") as mock_source_details, \
+            patch("retrieval.retrieval.load_retrieval_state") as load_state, \
+            patch("retrieval.retrieval.save_retrieval_state"), \
+            patch("retrieval.retrieval.retrieve_content") as mock_retrieve_content, \
+            patch("retrieval.retrieval.upload_to_s3"), \
+            patch("retrieval.retrieval.invoke_parser") as invoke_parser:
+        mock_common_lib.create_upload_record.side_effect = lambda env, source_id, *args: source_id
+        # a new token each time, as if they expired while sources wait for their turn
+        mock_common_lib.obtain_api_credentials.side_effect = (
+            {"Authorization": f"Bearer {i}"} for i in itertools.count())
+        mock_source_details.side_effect = lambda env, source_id, *args: (
+            f"http://{hosts[source_id]}/{source_id}.csv", "CSV", "example.example", {}, True, [])
+        load_state.return_value = {}
+        mock_retrieve_content.side_effect = retrieve_content
+        results = retrieval.retrieve_sources(
+            "env", list(hosts), None, {}, workers=4, per_host=2)
+    assert most_downloading["foo.bar"] == 2
+    # parsers are given the credentials obtained last, not those of the start of the job
+    tokens = [c.args[4]["Authorization"] for c in invoke_parser.call_args_list]
+    assert not set(tokens) & {
+        c.args[2]["Authorization"]
+        for c in mock_common_lib.create_upload_record.call_args_list}
+    assert {source_id: r["upload_id"] for source_id, r in results.items()} == {
+        source_id: [source_id] for source_id in hosts}
+    assert invoke_parser.call_count == 4
+
+
+def test_generate_deltas_ignores_uploads_of_unchanged_content():
+    from retrieval import retrieval
+    uploads = [{"_id": "1", "status": "SUCCESS", "created": "2021-01-01 00:00:00"},
+               {"_id": "2", "status": "SUCCESS", "created": "2021-01-02 00:00:00",
+                "unchanged": True}]
+    with patch("retrieval.retrieval.find_source_name_in_ingestion_queue") as in_queue, \
+            patch("retrieval.retrieval.s3_client") as mock_s3:
+        in_queue.return_value = False
+        mock_s3.download_file.side_effect = lambda bucket, key, file_name: shutil.copyfile(
+            "./parsing/diff_test/file1_initial.csv", file_name)
+        retrieval.generate_deltas(
+            "test", "./parsing/diff_test/file2_add4.csv", uploads, "bucket", "source_id", "CSV")
+    assert mock_s3.download_file.call_args.args[1] == "source_id/2021/01/01/0000/content.csv"
+
+
 @pytest.mark.skipif(not os.environ.get("DOCKERIZED", False),
                     reason="Running integration tests outside of mock environment disabled")
 def test_upload_to_s3_writes_indicated_file_to_key():
@@ -434,6 +806,49 @@ def test_upload_to_s3_raises_error_on_s3_error(
     assert not "Should have raised an exception."
 
 
+def test_resume_upload_invokes_parser_on_checkpointed_content():
+    from retrieval import retrieval  # Import locally to avoid superseding mock
+    source_id = "source_id"
+    event = {"s3Key": "source_id/2021/01/01/0000/content.csv", "sourceUrl": origin_url,
+             "dateFilter": date_filter, "dateRange": {}, "deltas": None}
+    checkpoint = json.dumps({"event": event, "batches": 1, "cases": 250, "counts": {}})
+    with patch("retrieval.retrieval.s3_client") as mock_s3, \
+            patch("retrieval.retrieval.get_source_details") as mock_source_details, \
+            patch("retrieval.retrieval.invoke_parser") as mock_invoke_parser, \
+            patch("parsing_lib.CaseSpool.load", return_value=None):
+        mock_s3.get_object.return_value = {"Body": io.BytesIO(checkpoint.encode())}
+        mock_source_details.return_value = (
+            origin_url, "CSV", "example.example", date_filter, True, [])
+        result = retrieval.resume_upload("env", source_id, upload_id, {}, None)
+    mock_s3.get_object.assert_called_once_with(
+        Bucket=retrieval.OUTPUT_BUCKET, Key=f"source_id/checkpoints/{upload_id}.json")
+    mock_invoke_parser.assert_called_once_with(
+        "env", "parsing.example.example", source_id, upload_id, {}, None,
+        event["s3Key"], origin_url, date_filter, {}, None)
+    assert result == {"bucket": retrieval.OUTPUT_BUCKET, "key": event["s3Key"],
+                      "upload_id": [upload_id]}
+
+
+def test_resume_upload_replays_complete_spool():
+    from retrieval import retrieval  # Import locally to avoid superseding mock
+    source_id = "source_id"
+    event = {"s3Key": "source_id/2021/01/01/0000/content.csv", "sourceUrl": origin_url,
+             "dateFilter": date_filter, "dateRange": {}, "deltas": None}
+    checkpoint = json.dumps({"event": event, "batches": 1, "cases": 250, "counts": {}})
+    with patch("retrieval.retrieval.s3_client") as mock_s3, \
+            patch("retrieval.retrieval.invoke_parser") as mock_invoke_parser, \
+            patch("parsing_lib.CaseSpool.load") as mock_load_spool, \
+            patch("parsing_lib.replay_spool") as mock_replay_spool:
+        mock_s3.get_object.return_value = {"Body": io.BytesIO(checkpoint.encode())}
+        result = retrieval.resume_upload("env", source_id, upload_id, {}, None)
+    mock_load_spool.assert_called_once_with(retrieval.OUTPUT_BUCKET, source_id, upload_id)
+    mock_replay_spool.assert_called_once_with(retrieval.parser_event(
+        "env", source_id, upload_id, None, event["s3Key"], origin_url, date_filter, {}))
+    mock_invoke_parser.assert_not_called()
+    assert result == {"bucket": retrieval.OUTPUT_BUCKET, "key": event["s3Key"],
+                      "upload_id": [upload_id]}
+
+
 def test_raw_content_unzips():
     from retrieval import retrieval
     # Creating a fake zip file with one file in it.
@@ -441,11 +856,12 @@ def test_raw_content_unzips():
     _, name = tempfile.mkstemp()
     with zipfile.ZipFile(name, 'w') as zf:
         zf.writestr('somefile', 'foo')
+        zf.writestr('smallerfile', 'fo')
 
     url = 'http://mock/url.zip'
     with open(name, "rb") as f:
         wrappedBytes = retrieval.raw_content(url, f.read(), tempdir="/tmp")
-        # Content should be the content of the first file in the zip.
+        # Content should be the content of the largest file in the zip.
         assert wrappedBytes.read() == b'foo'
 
 
@@ -543,7 +959,7 @@ def test_generate_deltas():
         s3_bucket = 's3_bucket'  # only used for download_file (mocked above)
         source_id = 'source_id'  # only used for download_file (mocked above)
         source_format = 'CSV'  # only CSV supported (others tested below)
-        sort_sources = True  # (default); unsorted results are machine dependent on 'comm'
+        sort_sources = True  # (default)
 
         # ### Test normal process ###
         #
@@ -608,3 +1024,91 @@ def test_generate_deltas():
         assert retrieval.generate_deltas(
             env, latest_filename, uploads, s3_bucket, source_id, source_format,
             sort_sources=sort_sources) == reject_deltas
+
+
+@pytest.mark.parametrize("memory_bytes", [1024 ** 3, 1])
+def test_write_deltas_compares_rows_as_multiset(memory_bytes):
+    from retrieval import retrieval
+    with tempfile.TemporaryDirectory() as tempdir:
+        early = os.path.join(tempdir, "early.csv")
+        later = os.path.join(tempdir, "later.csv")
+        with open(early, "w") as f:
+            f.write("id,value\n3,c\n1,a\n2,b\n2,b\n4,d")
+        with open(later, "w") as f:
+            f.write("id,value\n5,e\n2,b\n1,a\n1,a\n4,d\n")
+        add_file, del_file = io.BytesIO(), io.BytesIO()
+        assert retrieval.write_deltas(
+            early, later, add_file, del_file, memory_bytes) == (2, 2)
+    assert add_file.getvalue() == b"1,a\n5,e\n"
+    assert del_file.getvalue() == b"2,b\n3,c\n"
+
+
+def test_partition_rows_puts_equal_rows_in_same_partition():
+    from retrieval import retrieval
+    with tempfile.TemporaryDirectory() as tempdir:
+        file_names = []
+        for name, rows in [("a.csv", ["x", "y", "z"]), ("b.csv", ["z", "y", "w"])]:
+            file_names.append(os.path.join(tempdir, name))
+            with open(file_names[-1], "w") as f:
+                f.write("header\n" + "\n".join(rows) + "\n")
+        partitions = [retrieval.partition_rows(name, 3, tempdir) for name in file_names]
+        contents = [[set(open(p, "rb").read().splitlines()) for p in names]
+                    for names in partitions]
+    assert set().union(*contents[0]) == {b"x", b"y", b"z"}
+    for a, b in zip(*contents):
+        assert {b"y", b"z"} & a == {b"y", b"z"} & b
+
+
+def test_row_index_round_trips_and_changed_rows_compares_rows_as_multiset():
+    from retrieval import retrieval
+    with tempfile.TemporaryDirectory() as tempdir:
+        early = os.path.join(tempdir, "early.csv")
+        later = os.path.join(tempdir, "later.csv")
+        with open(early, "w") as f:
+            f.write("id,value\n3,c\n1,a\n2,b\n2,b\n4,d")
+        with open(later, "w") as f:
+            f.write("id,value\n5,e\n2,b\n1,a\n1,a\n4,d\n")
+        early_index = retrieval.RowIndex.from_bytes(
+            retrieval.RowIndex.from_file(early).to_bytes())
+        later_index = retrieval.RowIndex.from_file(later)
+        assert early_index.header == b"id,value\n"
+        assert early_index.size == os.path.getsize(early)
+        assert retrieval.changed_rows(early_index, later_index) == ([0, 2], [0, 2])
+        no_duplicates = retrieval.RowIndex.from_file(
+            "./parsing/diff_test/file2_add4.csv")
+        assert retrieval.changed_rows(early_index, no_duplicates)[1] == [0, 1, 2, 3, 4]
+        assert retrieval.read_spans(later, later_index.spans([0, 2])) == [b"5,e", b"1,a"]
+        assert retrieval.read_spans(early, early_index.spans([2, 4])) == [b"2,b", b"4,d"]
+
+
+def test_coalesce_spans_merges_close_rows():
+    from retrieval import retrieval
+    assert retrieval.coalesce_spans([(10, 5), (20, 5), (100, 10)], 10) == [(10, 15), (100, 10)]
+
+
+def test_generate_deltas_from_row_index_fetches_only_removed_rows():
+    from retrieval import retrieval
+    uploads = [{"_id": "1", "status": "SUCCESS", "created": "2021-01-01 00:00:00"}]
+    previous = "./parsing/diff_test/file2_add4.csv"
+    with open(previous, "rb") as f:
+        previous_content = f.read()
+
+    def get_object(Bucket, Key, Range=None):
+        if Key.endswith(retrieval.ROW_INDEX_FILENAME):
+            return {"Body": io.BytesIO(retrieval.RowIndex.from_file(previous).to_bytes())}
+        start, end = map(int, Range.removeprefix("bytes=").split("-"))
+        return {"Body": io.BytesIO(previous_content[start:end + 1])}
+
+    with patch("retrieval.retrieval.find_source_name_in_ingestion_queue") as in_queue, \
+            patch("retrieval.retrieval.s3_client") as mock_s3:
+        in_queue.return_value = False
+        mock_s3.get_object.side_effect = get_object
+        latest = "./parsing/diff_test/file3_rem3.csv"
+        file_add, file_del = retrieval.generate_deltas(
+            "test", latest, uploads, "bucket", "source_id", "CSV",
+            latest_index=retrieval.RowIndex.from_file(latest))
+    mock_s3.download_file.assert_not_called()
+    assert file_del and not file_add
+    assert compare_files(file_del, "./parsing/diff_test/file3_rem3_mindiff.csv")
+    for call in mock_s3.get_object.call_args_list:
+        assert call.kwargs["Key"].startswith("source_id/2021/01/01/0000/")